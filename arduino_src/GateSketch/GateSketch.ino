@@ -1,24 +1,40 @@
 // vim: filetype=cpp
 /*Arduino code to communicate with the RPi over serial.
 Information shared with RPi includes analog pin voltages and other inputs that trigger the gate.
-All analog readings will be smoothed and converted to voltages (floats)
+The ADC runs continuously in the background, each conversion is stored by an interrupt in a ring of
+recent samples for its pin. Voltages are the median of the most recent samples (the oversampling
+depth) converted to volts (floats), so a request is answered without waiting for any readings.
 
 Serial communication contract as follows:
 
 Handshake:
-    Arduino sends 'A', RPi responds with 'A'
+    Arduino sends 'A' followed by its firmware hash, RPi responds with 'A'
+Firmware Hash:
+    RPi sends 'F', Arduino responds with 'F' followed by its firmware hash
 Button Pin Negotiation:
     Arduino sends 'B', RPi sends pin numbers as chars for each button pin, then 'B' when it's finished.
 Analog Voltages:
     RPi sends 'V', Arduino responds with 'V' followed by voltages[] and then a checksum
+Oversampling:
+    RPi sends 'D' followed by "<number of samples>\n", the median of that many samples is used for
+    each voltage (at most maxOversampling)
 Gate Trigger:
     Arduino sends 'O', followed by a trigger message, RPi doesn't respond.
+Hit Detection:
+    RPi sends 'T' followed by "<analog pin> <threshold volts> <blanking ms>\n" when the motor starts,
+    Arduino sends 'H' followed by the voltage as soon as the pin goes over the threshold (after the
+    blanking time), once per 'T'. RPi sends 'X' when the motor stops.
 
 */
 #include <SPI.h>
 #include <QuickMedianLib.h>
 #include <Servo.h>
 
+// Hash of the sketch, set by upload.sh when compiling so the RPi can tell which sketch is running
+#ifndef FIRMWARE_HASH
+#define FIRMWARE_HASH "unknown"
+#endif
+
 // Configurable Parameters 
 const int noOfAnalogPins = 6;
 const int voltageDecimalPlaces = 4;
@@ -35,6 +51,28 @@ Servo servo;
 byte servoPos;
 const int servoPin = 9;
 
+// Background sampling, a ring of the most recent samples for each analog pin
+const byte maxOversampling = 32;
+byte oversampling = 21;
+volatile int samples[noOfAnalogPins][maxOversampling];
+volatile byte sampleIndex[noOfAnalogPins] = {0};
+// Channel selected for the next conversion and the channel of the conversion in progress
+volatile byte muxChannel = 0;
+volatile byte convertingChannel = 0;
+
+// Hit detection, armed by the RPi while the motor runs and checked by the ADC interrupt
+bool hitArmed = false;
+unsigned long hitArmedAt;
+unsigned long hitBlanking;
+volatile bool hitWatching = false;
+volatile bool hitDetected = false;
+volatile byte hitPin;
+volatile int hitThresholdCounts;
+volatile int hitValue;
+volatile byte hitSamplesOver = 0;
+// Consecutive samples over the threshold needed for a hit, so a single noisy sample isn't one
+const byte hitSamples = 3;
+
 // Button pins are given by RPi, presume less than 10 buttons will be used
 int buttonPins[10] = {0};
 unsigned long lastButtonPress = 0;
@@ -43,11 +81,13 @@ unsigned long debounceDelay = 1000;
 
 void setup()
 {
-    // Use external analog reference and put a jumper between pins 3.3V and AREF
-    analogReference(EXTERNAL);
+    // Uses the external analog reference, put a jumper between pins 3.3V and AREF
+    startAdc();
     servo.attach(servoPin);
     // start serial at 115200bps
     Serial.begin(115200);
+    // Timeout for reading the numbers of a hit detection command
+    Serial.setTimeout(100);
     serialHandshake();
     // Get button pins and initialize them
     pinMode(LED_BUILTIN, OUTPUT);
@@ -80,7 +120,32 @@ void loop()
             // RPi is sending a servo position update
             updateServo();
         }
+        else if (incomingByte == 'T')
+        {
+            // Motor started, watch for a hit
+            armHitDetection();
+        }
+        else if (incomingByte == 'X')
+        {
+            // Motor stopped, drop a hit detected before the 'X' arrived so it isn't reported
+            // against the next motor run
+            hitArmed = false;
+            hitWatching = false;
+            hitDetected = false;
+        }
+        else if (incomingByte == 'D')
+        {
+            // RPi is setting the oversampling depth
+            oversampling = constrain(Serial.parseInt(), 1, maxOversampling);
+        }
+        else if (incomingByte == 'F')
+        {
+            // RPi is asking which firmware is running
+            Serial.println('F');
+            Serial.println(FIRMWARE_HASH);
+        }
     }
+    checkForHit();
     // Check if buttons have been pressed
     if ((millis() - lastButtonPress) > debounceDelay)
     {
@@ -127,34 +192,94 @@ void sendAnalogVoltages()
     Serial.println(checksum, voltageDecimalPlaces);
 }
 
-void updateAnalogVoltages()
+void startAdc()
 {
-    // Update the global voltages array
-    
-    // Take multiple readings and then apply median
-    int noSamples = 21;
-    int analogVals[noOfAnalogPins][noSamples];
-    
-    // Take samples over noSamples*delay() seconds
-    for(int s=0; s<noSamples; s++)
+    // External reference (AREF), right adjusted result, channel 0
+    ADMUX = 0;
+    // Free running mode
+    ADCSRB = 0;
+    // Enable with auto trigger and the interrupt, prescaler 128 for a 125kHz ADC clock, that is
+    // about 9600 conversions per second shared between the pins
+    ADCSRA = _BV(ADEN) | _BV(ADATE) | _BV(ADIE) | _BV(ADPS2) | _BV(ADPS1) | _BV(ADPS0);
+    ADCSRA |= _BV(ADSC);
+}
+
+ISR(ADC_vect)
+{
+    int value = ADC;
+    // The next conversion has already started, so a new channel only applies to the one after it
+    byte channel = convertingChannel;
+    convertingChannel = muxChannel;
+    muxChannel = (muxChannel + 1) % noOfAnalogPins;
+    ADMUX = muxChannel;
+
+    samples[channel][sampleIndex[channel]] = value;
+    sampleIndex[channel] = (sampleIndex[channel] + 1) % maxOversampling;
+
+    if (hitWatching && channel == hitPin)
     {
-        for(int i=0; i<noOfAnalogPins; i++)
+        if (value <= hitThresholdCounts)
+        {
+            hitSamplesOver = 0;
+        }
+        else if (++hitSamplesOver >= hitSamples)
         {
-            analogVals[i][s] = analogRead(i);
+            hitValue = value;
+            hitDetected = true;
+            hitWatching = false;
         }
-        delay(1);
     }
+}
 
-    // Get median for each pin
-    for(int i=0; i<noOfAnalogPins; i++)
+void armHitDetection()
+{
+    hitWatching = false;
+    hitPin = Serial.parseInt();
+    hitThresholdCounts = int(Serial.parseFloat() * (1023.0 / 3.3));
+    hitBlanking = Serial.parseInt();
+    hitArmedAt = millis();
+    hitSamplesOver = 0;
+    hitDetected = false;
+    hitArmed = true;
+}
+
+void checkForHit()
+{
+    // Ignore the current spike while the motor starts
+    if (hitArmed && !hitWatching && (millis() - hitArmedAt) >= hitBlanking)
     {
-        voltages[i] = float(QuickMedian<int>::GetMedian(&analogVals[i][0], noSamples));
+        hitSamplesOver = 0;
+        hitWatching = true;
     }
+    if (hitDetected)
+    {
+        // Only one hit per motor run, and none once the motor has stopped
+        hitDetected = false;
+        if (hitArmed)
+        {
+            hitArmed = false;
+            Serial.println('H');
+            Serial.println(hitValue * (3.3 / 1023.0), voltageDecimalPlaces);
+        }
+    }
+}
 
-    // Multiply by 3.3/1023 to get voltage
+void updateAnalogVoltages()
+{
+    // Update the global voltages array from the median of the most recent samples of each pin
+    int recent[maxOversampling];
     for(int i=0; i<noOfAnalogPins; i++)
     {
-        voltages[i] = (voltages[i]) * (3.3 / 1023.0);
+        // Copy the samples without the interrupt changing them part way through
+        noInterrupts();
+        byte newest = sampleIndex[i] + maxOversampling - 1;
+        for(int s=0; s<oversampling; s++)
+        {
+            recent[s] = samples[i][(newest - s) % maxOversampling];
+        }
+        interrupts();
+        // Multiply by 3.3/1023 to get voltage
+        voltages[i] = float(QuickMedian<int>::GetMedian(recent, oversampling)) * (3.3 / 1023.0);
     }
 
     // Calculate the checksum
@@ -172,6 +297,7 @@ void serialHandshake()
     while (Serial.available() <= 0)
     {
         Serial.println('A');
+        Serial.println(FIRMWARE_HASH);
         delay(200);
     }
     flushSerialInputBuffer();
@@ -202,8 +328,8 @@ void getButtonPins()
             Serial.println("Got all pins");
             break;
         }
-        // Check if value is valid
-        if (incomingChar < '1')
+        // Check if value is valid, anything else is left over from the handshake
+        if (incomingChar < '1' || incomingChar > '9')
         {
             continue;
         }
@@ -1,7 +1,36 @@
 #!/bin/bash
+# Usage: upload.sh [--build-only] [port]
+# Builds are cached by the hash of the sketch, so the sketch is only compiled when it has changed.
+# The hash is compiled into the sketch, which reports it in the handshake so the gate can tell if
+# the Arduino is running the bundled sketch.
+set -e
 
 relative_path_to_this_script=`dirname $0`
+sketch=$relative_path_to_this_script/GateSketch
 
-# Compile, upload and cleanup
-arduino-cli compile -v --verify --upload -p /dev/ttyUSB0 -b arduino:avr:uno $relative_path_to_this_script/GateSketch
-rm $relative_path_to_this_script/GateSketch/build -r
+build_only=false
+if [ "$1" == "--build-only" ]
+then
+    build_only=true
+    shift
+fi
+port=${1:-/dev/ttyUSB0}
+
+# Must match firmware.sketch_hash in rpi_src/firmware.py
+hash=$(sha256sum $sketch/GateSketch.ino | cut -c1-16)
+build_dir=${SMART_GATE_FIRMWARE_CACHE:-$HOME/.cache/smart-gate/firmware}/$hash
+
+if [ -f $build_dir/GateSketch.ino.hex ]
+then
+    echo "Using cached build of firmware $hash"
+else
+    echo "Compiling firmware $hash"
+    arduino-cli compile -v --verify -b arduino:avr:uno \
+        --build-property "compiler.cpp.extra_flags=-DFIRMWARE_HASH=\"$hash\"" \
+        --output-dir $build_dir $sketch
+fi
+
+if [ $build_only == false ]
+then
+    arduino-cli upload -v --verify -p $port -b arduino:avr:uno --input-dir $build_dir $sketch
+fi
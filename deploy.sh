@@ -41,9 +41,9 @@ cd rpi_src
 python -c "from db import DB; DB.deploy()"
 cd ..
 
-# Compile and upload arduino code
+# Compile the arduino code, the gate uploads it when the Arduino is running a different sketch
 bash arduino_src/install_and_configure_arduino-cli.sh
-bash arduino_src/upload.sh
+bash arduino_src/upload.sh --build-only
 
 #Insall crontab to run run-smart-gate every minute
 crontab -u $VALID_USER - <<EOF
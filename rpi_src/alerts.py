@@ -0,0 +1,261 @@
+""" Module for email alerts.
+Alerts are de-duplicated, critical alerts are emailed straight away and warnings are collected into
+a digest. Emails are sent from a separate thread over a reused SMTP session, and any that fail to
+send are spooled to disk and retried later. Emails the server rejects outright are moved out of the
+spool so they don't block the ones behind them.
+"""
+import email.message
+import glob
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+
+logger = logging.getLogger("root")
+
+
+class AlertHandler(logging.Handler):
+    """ Logging handler that emails alerts without blocking the thread that emits them
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials, spool_dir, **kwargs):
+        """ Keyword arguments:
+            dedupe_window - seconds to suppress repeats of an identical alert
+            digest_interval - seconds between sending digests of the non urgent alerts
+            immediate_level - alerts at or above this level are emailed straight away
+            idle_timeout - seconds before an unused SMTP session is closed
+            smtp_factory - class used to create the SMTP session (smtplib.SMTP)
+            spool_limit - most unsent emails kept, the oldest are deleted beyond this
+        """
+        super().__init__()
+        self.mailhost = mailhost
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.spool_dir = spool_dir
+        self.dedupe_window = kwargs.get("dedupe_window", 600)
+        self.digest_interval = kwargs.get("digest_interval", 900)
+        self.immediate_level = kwargs.get("immediate_level", logging.CRITICAL)
+        self.idle_timeout = kwargs.get("idle_timeout", 60)
+        self.smtp_factory = kwargs.get("smtp_factory", smtplib.SMTP)
+        self.spool_limit = kwargs.get("spool_limit", 100)
+        self.rejected_dir = os.path.join(self.spool_dir, "rejected")
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        self._smtp = None
+        self._last_used = 0
+        self._last_sent = {}
+        self._suppressed = {}
+        self._digest = []
+        self._digest_due = None
+        self._spool_count = 0
+        self._alert_lock = threading.Lock()
+        self._outbox = queue.Queue()
+        self._thread = threading.Thread(target=self._send_loop, daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        """ Queue an alert for sending, suppressing repeats within the dedupe window
+        """
+        try:
+            text = self.format(record)
+            message = record.getMessage()
+            now = time.monotonic()
+            with self._alert_lock:
+                last_sent = self._last_sent.get(message)
+                if last_sent is not None and now - last_sent < self.dedupe_window:
+                    self._suppressed[message] = self._suppressed.get(message, 0) + 1
+                    # The repeats are reported in the next digest, even if only critical alerts
+                    # were sent since the last one
+                    if self._digest_due is None:
+                        self._digest_due = now + self.digest_interval
+                    return
+                self._last_sent[message] = now
+                if record.levelno >= self.immediate_level:
+                    self._outbox.put((self.subject, text))
+                    return
+                self._digest.append(text)
+                if self._digest_due is None:
+                    self._digest_due = now + self.digest_interval
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+    def flush(self):
+        """ Send the digest now instead of waiting for the digest interval
+        """
+        with self._alert_lock:
+            self._digest_due = time.monotonic()
+        self._outbox.put(None)
+
+    def close(self):
+        """ Send any waiting alerts then stop the sending thread
+        """
+        self.flush()
+        self._outbox.put(False)
+        self._thread.join(timeout=30)
+        super().close()
+
+    def _take_digest(self):
+        """ Build the digest email if it is due, returns None otherwise
+        """
+        with self._alert_lock:
+            if self._digest_due is None or time.monotonic() < self._digest_due:
+                return None
+            lines = list(self._digest)
+            for message, count in self._suppressed.items():
+                lines.append("Repeated {} more times: {}".format(count, message))
+            self._digest = []
+            self._suppressed = {}
+            self._digest_due = None
+            # Forget old alerts so the dedupe history does not grow forever
+            cutoff = time.monotonic() - self.dedupe_window
+            self._last_sent = {message: sent for message, sent in self._last_sent.items()
+                               if sent >= cutoff}
+        if not lines:
+            return None
+        return ("{} ({} alerts)".format(self.subject, len(lines)), "\n".join(lines))
+
+    def _send_loop(self):
+        """ Thread that sends alerts and digests, retrying any that were spooled
+        """
+        running = True
+        while running:
+            with self._alert_lock:
+                due = self._digest_due
+            timeout = self.idle_timeout if due is None else max(0, due - time.monotonic())
+            try:
+                job = self._outbox.get(timeout=timeout)
+                if job is False:
+                    running = False
+                elif job is not None:
+                    self._send_or_spool(*job)
+            except queue.Empty:
+                self._retry_pending()
+            digest = self._take_digest()
+            if digest is not None:
+                self._send_or_spool(*digest)
+            if self._smtp is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                self._disconnect()
+        self._disconnect()
+
+    def _build(self, subject, body):
+        """ Create an email message
+        """
+        message = email.message.EmailMessage()
+        message["From"] = self.fromaddr
+        message["To"] = ", ".join(self.toaddrs)
+        message["Subject"] = subject
+        message.set_content(body)
+        return message.as_bytes()
+
+    def _send_or_spool(self, subject, body):
+        """ Send an email after any spooled ones, spooling it to disk if it can not be sent
+        """
+        raw = self._build(subject, body)
+        self._retry_pending()
+        try:
+            self._send(raw)
+        except (OSError, smtplib.SMTPException) as err:
+            if self._rejected(err):
+                self._keep(raw, self.rejected_dir)
+                # Do not log at warning or above, it would create another alert
+                logger.info("Email alert rejected by the server: %s", err)
+                return
+            self._disconnect()
+            self._keep(raw, self.spool_dir)
+            logger.info("Email alert spooled, it could not be sent: %s", err)
+
+    def _retry_pending(self):
+        """ Retry any spooled emails while the thread is otherwise idle
+        """
+        if not self._spooled(self.spool_dir):
+            return
+        try:
+            self._retry_spool()
+        except (OSError, smtplib.SMTPException):
+            self._disconnect()
+
+    @staticmethod
+    def _rejected(err):
+        """ Whether the server refused the email itself, so sending it again would fail again
+        """
+        if isinstance(err, smtplib.SMTPRecipientsRefused):
+            return True
+        return (isinstance(err, (smtplib.SMTPDataError, smtplib.SMTPSenderRefused))
+                and err.smtp_code >= 500)
+
+    @staticmethod
+    def _spooled(directory):
+        """ Paths of the emails in a spool directory, oldest first
+        """
+        return sorted(glob.glob(os.path.join(directory, "*.eml")), key=os.path.getmtime)
+
+    def _keep(self, raw, directory):
+        """ Write an email to the spool or rejected directory, deleting the oldest beyond the limit
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._spool_count += 1
+        path = os.path.join(directory, "{}-{}.eml".format(
+            time.strftime("%Y%m%d-%H%M%S"), self._spool_count))
+        with open(path, "wb") as spool_file:
+            spool_file.write(raw)
+        spooled = self._spooled(directory)
+        for old_path in spooled[:max(0, len(spooled) - self.spool_limit)]:
+            os.remove(old_path)
+            logger.info("Deleted the unsent email alert %s, over the spool limit", old_path)
+
+    def _retry_spool(self):
+        """ Send spooled emails, oldest first. Emails the server rejects are moved to the rejected
+        directory. Raises if the SMTP server is unavailable
+        """
+        for path in self._spooled(self.spool_dir):
+            with open(path, "rb") as spool_file:
+                raw = spool_file.read()
+            try:
+                self._send(raw)
+            except smtplib.SMTPException as err:
+                if not self._rejected(err):
+                    raise
+                self._keep(raw, self.rejected_dir)
+                logger.info("Spooled email alert rejected by the server: %s", err)
+            os.remove(path)
+
+    def _send(self, raw):
+        """ Send an email over the existing SMTP session, connecting if there isn't one
+        """
+        if self._smtp is None:
+            self._connect()
+        else:
+            try:
+                self._smtp.noop()
+            except (OSError, smtplib.SMTPException):
+                self._disconnect()
+                self._connect()
+        self._smtp.sendmail(self.fromaddr, self.toaddrs, raw)
+        self._last_used = time.monotonic()
+
+    def _connect(self):
+        """ Open and authenticate an SMTP session
+        """
+        host, port = self.mailhost
+        self._smtp = self.smtp_factory(host, port, timeout=30)
+        self._smtp.ehlo()
+        self._smtp.starttls()
+        self._smtp.ehlo()
+        if self.credentials:
+            self._smtp.login(*self.credentials)
+        self._last_used = time.monotonic()
+
+    def _disconnect(self):
+        """ Close the SMTP session if it is open
+        """
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (OSError, smtplib.SMTPException):
+            pass
+        self._smtp = None
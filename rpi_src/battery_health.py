@@ -0,0 +1,139 @@
+""" Module to track the internal resistance of the battery.
+Every motor run puts a known load on the battery. The gate reads the shunt and battery voltages in
+the same request, so each pair is a synchronised (current, voltage) point and the slope of the
+battery voltage against the current (dV/dI) is the internal resistance of the battery. It is
+estimated for every run and kept as a trend, and an alert is raised when it rises, which happens
+well before the battery fails.
+"""
+import collections
+import logging
+import statistics
+import threading
+import time
+
+from config import Config as config
+from events import EventBus
+
+logger = logging.getLogger("root")
+
+
+class LoadFit:
+    """ Incremental least squares fit of battery voltage against motor current for one run
+    """
+    __slots__ = ("count", "_sum_i", "_sum_v", "_sum_ii", "_sum_iv", "min_current", "max_current")
+    # Runs where the current varied less than this (amps) can't give a meaningful slope
+    MIN_CURRENT_SPREAD = 0.5
+
+    def __init__(self):
+        self.count = 0
+        self._sum_i = 0.0
+        self._sum_v = 0.0
+        self._sum_ii = 0.0
+        self._sum_iv = 0.0
+        self.min_current = None
+        self.max_current = None
+
+    def add(self, current, voltage):
+        """ Add a (current, battery voltage) point
+        """
+        self.count += 1
+        self._sum_i += current
+        self._sum_v += voltage
+        self._sum_ii += current * current
+        self._sum_iv += current * voltage
+        self.min_current = current if self.min_current is None else min(self.min_current, current)
+        self.max_current = current if self.max_current is None else max(self.max_current, current)
+
+    def add_reading(self, shunt_analog, battery_analog):
+        """ Add a point from the raw analog voltages of the shunt and battery pins
+        """
+        self.add(shunt_analog / config.SHUNT_RESISTANCE,
+                 battery_analog * config.BATTERY_VOLTAGE_CORRECTION_FACTOR)
+
+    def resistance(self):
+        """ Internal resistance in ohms, None if the current did not vary enough
+        """
+        if self.count < 2 or self.max_current - self.min_current < self.MIN_CURRENT_SPREAD:
+            return None
+        spread = self.count * self._sum_ii - self._sum_i ** 2
+        if spread <= 0:
+            return None
+        slope = (self.count * self._sum_iv - self._sum_i * self._sum_v) / spread
+        # The voltage drops as the current rises
+        return -slope
+
+
+class BatteryHealth:
+    """ Trend of the internal resistance estimated for each motor run
+    """
+    # The median of this many recent runs is compared against the median of the older runs
+    RECENT_RUNS = 10
+    history = collections.deque(maxlen=200)
+    pending = []
+    db = None
+    alerted = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def initialize(cls, db=None):
+        """ Give access to the db and load the stored trend
+        """
+        cls.db = db
+        cls.history.clear()
+        cls.pending = []
+        cls.alerted = False
+        if db is not None:
+            cls.history.extend(db.resistance_history(cls.history.maxlen))
+
+    @classmethod
+    def record(cls, phase, fit):
+        """ Record the resistance estimated from a motor run, called from the gate thread so it
+        only updates the trend in memory
+        """
+        resistance = fit.resistance()
+        if resistance is None:
+            logger.debug("Not enough current variation to estimate battery resistance")
+            return
+        resistance = round(resistance, 5)
+        with cls._lock:
+            cls.history.append(resistance)
+            cls.pending.append((time.time(), phase, resistance, fit.count))
+        EventBus.publish("resistance", phase=phase, resistance=resistance, samples=fit.count)
+        cls.check_trend()
+
+    @classmethod
+    def trend(cls):
+        """ (baseline, recent) median resistances, None until there are enough runs
+        """
+        with cls._lock:
+            history = list(cls.history)
+        if len(history) < 2 * cls.RECENT_RUNS:
+            return None
+        return (statistics.median(history[:-cls.RECENT_RUNS]),
+                statistics.median(history[-cls.RECENT_RUNS:]))
+
+    @classmethod
+    def check_trend(cls):
+        """ Alert once when the recent resistance has risen past the baseline, re-armed when it
+        falls back
+        """
+        trend = cls.trend()
+        if trend is None:
+            return
+        baseline, recent = trend
+        rising = recent > baseline * (1 + config.RESISTANCE_ALERT_RISE)
+        if rising and not cls.alerted:
+            logger.warning("Battery internal resistance has risen from %.4f to %.4f ohms, "
+                           "the battery may be failing", baseline, recent)
+            EventBus.publish("resistance_alert", baseline=baseline, resistance=recent)
+        cls.alerted = rising
+
+    @classmethod
+    def flush(cls):
+        """ Scheduled job that writes the pending estimates to the db
+        """
+        with cls._lock:
+            pending, cls.pending = cls.pending, []
+        if cls.db is not None:
+            for timestamp, phase, resistance, samples in pending:
+                cls.db.log_resistance(timestamp, phase, resistance, samples)
@@ -1,69 +1,169 @@
-""" Module to log battery voltage every hour
+""" Module to sample and log the battery voltage.
+The battery is sampled every few seconds into a ring buffer of recent samples, so alerts are raised
+within seconds. Each logging window is summarised incrementally (min, max, mean and standard
+deviation) and only the summary is written to the log file and the DB.
 """
+import collections
 import logging
-import threading
-import time
-
-import schedule
+import math
 
 from config import Config as config
-from serial_analog import ArduinoInterface
-
-# Hide schedule logging messages
-logging.getLogger("schedule").setLevel(logging.CRITICAL)
+from events import EventBus
+from log_storage import LogStorage
+from serial_analog import ArduinoInterface, ArduinoInterfaceError
 
 root_logger = logging.getLogger("root")
 
 
-class BatteryVoltageLog:
-    """Logs the battery voltage every hour to file"""
+class VoltageWindow:
+    """ Running statistics of the samples in a logging window (Welford's algorithm)
+    """
+    __slots__ = ("count", "mean", "_m2", "minimum", "maximum")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        """ Add a sample to the window
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def stddev(self):
+        """ Population standard deviation of the samples
+        """
+        return math.sqrt(self._m2 / self.count) if self.count else 0.0
 
-    def __init__(self, path, analog_pin, db=None):
+    def to_dict(self, decimals=2):
+        """ Rounded summary of the window
+        """
+        return {"voltage": round(self.mean, decimals),
+                "min": round(self.minimum, decimals),
+                "max": round(self.maximum, decimals),
+                "stddev": round(self.stddev(), decimals + 1),
+                "samples": self.count}
+
+
+class BatteryVoltageLog:  # pylint: disable=too-many-instance-attributes
+    """Samples the battery voltage and logs a summary of every window to file and the db"""
+
+    def __init__(self, path, analog_pin, db=None, gate=None):
         # Create voltage logger
         log_format = "%(levelname)s %(asctime)s : %(message)s"
         self.bat_logger = logging.getLogger(__name__)
         self.bat_logger.setLevel(logging.INFO)
-        file_handler = logging.handlers.TimedRotatingFileHandler(path, when="W0", backupCount=50)
-        file_handler.setLevel(logging.INFO)
-        file_handler.setFormatter(logging.Formatter(log_format))
-        self.bat_logger.addHandler(file_handler)
+        if not self.bat_logger.handlers:
+            self.bat_logger.addHandler(LogStorage.file_handler(path, logging.INFO, log_format))
 
         # Setup analog read for battery pin
         self.battery_pin = analog_pin
 
-        # Schedule job
-        schedule.every(1).hour.at(":00").do(self.scheduled_job)
-
-        if db is not None:
-            self.database = db
+        self.database = db
+        # Samples taken while the gate is moving are under motor load
+        self.gate = gate
+        # Most recent samples, alerts are based on their mean so a single noisy read or the sag
+        # while the motor starts doesn't raise an alert
+        self.recent = collections.deque(maxlen=config.BATTERY_ALERT_SAMPLES)
+        self.window = VoltageWindow()
+        self.alert_level = logging.INFO
+        # Set by the power profile, which also batches writes by summarising several windows at once
+        self.estimator = None
+        self.sample_job = None
+        self.windows_per_write = 1
+        self._windows = 0
 
     @staticmethod
     def analog_to_battery_voltage(analog_voltage, decimals=1):
         """Calculates battery voltage from the 0-3.3v analog voltage"""
         return round(analog_voltage * config.BATTERY_VOLTAGE_CORRECTION_FACTOR, decimals)
 
-    def scheduled_job(self):
-        """scheduled job"""
-        bat_volt = self.analog_to_battery_voltage(
-            ArduinoInterface.get_analog_voltages(self.battery_pin)
-        )
-        self.database.log_voltage(bat_volt)
-        if config.BATTERY_LOWER_ALERT <= bat_volt <= config.BATTERY_UPPER_ALERT:
-            self.bat_logger.info("%.1fv", bat_volt)
-        elif config.BATTERY_LOWER_ALERT-0.5 < bat_volt < config.BATTERY_LOWER_ALERT:
-            self.bat_logger.warning("%.1fv", bat_volt)
-            root_logger.warning("Battery voltage: %sv", bat_volt)
-        else:
-            self.bat_logger.critical("%.1fv", bat_volt)
-            root_logger.critical("Battery voltage: %sv", bat_volt)
-
-    def start(self):
-        """Start logging job"""
-        threading.Thread(target=self.schedule_check_loop, daemon=True).start()
+    @classmethod
+    def read_battery_voltage(cls, decimals=1):
+        """Read the current battery voltage from the Arduino"""
+        return cls.analog_to_battery_voltage(
+            ArduinoInterface.get_analog_voltages(config.BATTERY_VOLTAGE_PIN), decimals)
 
     @staticmethod
-    def schedule_check_loop():
-        """Threaded loop to check schedule"""
-        while 1:
-            schedule.run_pending()
-            time.sleep(1)
+    def alert_level_of(bat_volt):
+        """Logging level for a battery voltage"""
+        if config.BATTERY_LOWER_ALERT <= bat_volt <= config.BATTERY_UPPER_ALERT:
+            return logging.INFO
+        if config.BATTERY_LOWER_ALERT-0.5 < bat_volt < config.BATTERY_LOWER_ALERT:
+            return logging.WARNING
+        return logging.CRITICAL
+
+    def sample(self):
+        """Scheduled job that takes a battery sample.
+        Voltages the gate read within the last sample interval are reused, otherwise the arduino is
+        asked for them. Readings the gate took before the motor stopped are not reused.
+        """
+        idle = self.gate.motor_idle_time() if self.gate is not None else float("inf")
+        max_age = config.BATTERY_SAMPLE_INTERVAL if idle is None else \
+            min(idle, config.BATTERY_SAMPLE_INTERVAL)
+        voltages = ArduinoInterface.recent_voltages(max_age)
+        try:
+            analog = voltages[self.battery_pin] if voltages is not None else \
+                    ArduinoInterface.get_analog_voltages(self.battery_pin)
+        except ArduinoInterfaceError as err:
+            root_logger.debug("Battery sample skipped: %s", err)
+            return
+        self.add_sample(self.analog_to_battery_voltage(analog, 2), loaded=idle is None)
+
+    def add_sample(self, bat_volt, loaded=False):
+        """Add a battery voltage sample to the window and raise an alert if needed.
+        Samples taken under motor load only go to the charge estimator, which tracks the sag.
+        """
+        if self.estimator is not None:
+            self.estimator.add_sample(bat_volt)
+        if loaded:
+            return
+        self.window.add(bat_volt)
+        self.recent.append(bat_volt)
+        if len(self.recent) < self.recent.maxlen:
+            return
+        average = round(sum(self.recent) / len(self.recent), 1)
+        level = self.alert_level_of(average)
+        # Only alert when the level gets worse, it is re-armed once the voltage is normal again
+        if level > self.alert_level:
+            root_logger.log(level, "Battery voltage: %sv", average)
+            self.bat_logger.log(level, "%.1fv", average)
+            EventBus.publish("battery_alert", voltage=average)
+        if level > self.alert_level or level == logging.INFO:
+            self.alert_level = level
+
+    def scheduled_job(self):
+        """Scheduled job that writes the summary of the current window and starts a new one"""
+        self._windows += 1
+        if self._windows < self.windows_per_write:
+            return
+        self._windows = 0
+        window, self.window = self.window, VoltageWindow()
+        if not window.count:
+            root_logger.warning("No battery voltage samples were taken this window")
+            return
+        summary = window.to_dict()
+        if self.database is not None:
+            self.database.log_voltage(summary["voltage"], summary["min"], summary["max"],
+                                      summary["stddev"], summary["samples"])
+        EventBus.publish("battery", **summary)
+        self.bat_logger.log(self.alert_level_of(round(window.mean, 1)),
+                            "%.1fv (min %.2fv, max %.2fv, stddev %.3fv, %d samples)",
+                            window.mean, summary["min"], summary["max"], summary["stddev"],
+                            window.count)
+
+    def start(self, scheduler):
+        """Schedule the sampling job and the logging job at the start of every window"""
+        self.sample_job = scheduler.every(config.BATTERY_SAMPLE_INTERVAL, self.sample,
+                                          name="battery sample", missed="skip")
+        if config.BATTERY_LOG_INTERVAL == 60:
+            return scheduler.cron(self.scheduled_job, minute=0, name="battery voltage log")
+        return scheduler.every(config.BATTERY_LOG_INTERVAL * 60, self.scheduled_job,
+                               name="battery voltage log")
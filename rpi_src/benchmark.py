@@ -0,0 +1,392 @@
+""" Module to benchmark the gate's hot paths and catch performance regressions.
+Every benchmark runs against mock hardware or the Arduino emulator, so it can run on any Linux
+machine. Results are compared with the baseline stored for the machine type and a benchmark that is
+worse than its baseline by more than its tolerance is a regression.
+
+    python benchmark.py                 compare against the baseline, exits 1 on a regression
+    python benchmark.py --update        store the results as the baseline for this machine type
+    python benchmark.py --report-only   compare without failing, for shared CI machines
+"""
+import argparse
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+
+from config import Config as config
+from db import DB
+from emulator import ArduinoEmulator, MotorModel, pin_direction
+from events import EventBus
+from gate import Gate
+from job_queue import JobQueue
+from log_queue import BoundedQueueHandler
+import main
+from serial_analog import ArduinoInterface
+from tracing import Tracer
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "benchmark_baseline.json")
+
+# Name to (function, unit, higher_is_better, tolerance), in the order they run
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, unit, higher_is_better=True, tolerance=0.3):
+    """ Register a benchmark, the function is called with the scale of the run (1 for a full run)
+    and returns the measured value. tolerance is the fraction the value can be worse than the
+    baseline by before it is a regression
+    """
+    def register(function):
+        BENCHMARKS[name] = (function, unit, higher_is_better, tolerance)
+        return function
+    return register
+
+
+@contextlib.contextmanager
+def patched(obj, **values):
+    """ Temporarily set attributes of obj
+    """
+    original = {name: getattr(obj, name) for name in values}
+    for name, value in values.items():
+        setattr(obj, name, value)
+    try:
+        yield obj
+    finally:
+        for name, value in original.items():
+            setattr(obj, name, value)
+
+
+@contextlib.contextmanager
+def mock_gate():
+    """ Gate on mock pins with its job queue, the job queue's pipe is in a temporary directory
+    """
+    Device.pin_factory = MockFactory()
+    directory = tempfile.mkdtemp()
+    job_q = JobQueue(config.COMMANDS + config.MODES, os.path.join(directory, "pipe"))
+    try:
+        with patched(config, SAVED_MODE_FILE=os.path.join(directory, "mode.txt")):
+            yield Gate(job_q)
+    finally:
+        job_q.cleanup()
+        Device.pin_factory.close()
+        shutil.rmtree(directory)
+
+
+class FrameSource:
+    """ Serial port that sends the same voltage frame over and over
+    """
+    def __init__(self, voltages):
+        lines = ["{:.4f}".format(voltage) for voltage in voltages]
+        lines.append("{:.4f}".format(round(sum(voltages), 4)))
+        self.lines = [line.encode() + b"\r\n" for line in lines]
+        self.timeout = 1
+        self._index = 0
+
+    def readline(self):
+        """ Next line of the frame """
+        line = self.lines[self._index]
+        self._index = (self._index + 1) % len(self.lines)
+        return line
+
+    def write(self, data):
+        """ Requests are not answered """
+
+    def flushInput(self):  # pylint: disable=invalid-name
+        """ Nothing is buffered """
+
+
+@benchmark("serial_frames_per_second", "frames/s")
+def serial_frames(scale):
+    """ Voltage frames parsed and checked by _arduino_receive_voltages
+    """
+    # pylint: disable=protected-access
+    frames = max(100, int(50000 * scale))
+    ArduinoInterface.initialize()
+    ArduinoInterface.ser = FrameSource([0.0032, 0.0, 1.2345, 3.3, 0.5, 2.4298])
+    start = time.perf_counter()
+    for frame in range(frames):
+        ArduinoInterface._arduino_receive_voltages()
+        if frame % 1000 == 0:
+            ArduinoInterface.arduino_queue.queue.clear()
+    elapsed = time.perf_counter() - start
+    ArduinoInterface.initialize()
+    return frames / elapsed
+
+
+@benchmark("shunt_samples_per_second", "samples/s", tolerance=0.4)
+def shunt_samples(scale):
+    """ Shunt readings the gate takes while opening, over the serial path to the emulator
+    """
+    # pylint: disable=protected-access
+    directory = tempfile.mkdtemp()
+    link = os.path.join(directory, "ttyGATE")
+    with mock_gate() as gate, patched(config, SERIAL_PORT=link, SHUNT_READ_DELAY=0.05):
+        emulator = ArduinoEmulator(link, motor=MotorModel(max(0.5, 2 * scale), inrush_time=0.02),
+                                   motor_direction=pin_direction(gate), seed=0).start()
+        try:
+            ArduinoInterface.initialize(gate, gate.job_q)
+            gate.open()
+        finally:
+            ArduinoInterface.stop()
+            emulator.stop()
+            shutil.rmtree(directory)
+        if gate.current_state != "opened":
+            raise RuntimeError("The gate did not open: {}".format(gate.current_state))
+        return gate._shunt_samples / gate._run_time
+
+
+def wait_for_cycle(subscription, timeout=5):
+    """ Events up to and including the end of the gate cycle, or all of them if it doesn't end
+    within timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    events = []
+    while time.monotonic() < deadline:
+        events.extend(subscription.get(max(0, deadline - time.monotonic())))
+        if any(event.event_type == "cycle" for event in events):
+            break
+    return events
+
+
+@benchmark("trigger_to_motor_on_ms", "ms", higher_is_better=False, tolerance=1.0)
+def trigger_latency(scale):
+    """ Median time from an open trigger being queued until the motor is on, through the job queue
+    and main_loop
+    """
+    cycles = max(10, int(200 * scale))
+    ArduinoInterface.initialize()
+    # Every reading is over the threshold, so each cycle ends as soon as it starts
+    ArduinoInterface.mock_voltages[config.SHUNT_PIN] = config.SHUNT_THRESHOLD * 10
+    latencies = []
+    with mock_gate() as gate, patched(config, SHUNT_READ_DELAY=0, HOLD_OPEN_TIME=0,
+                                      MIN_TIME_TO_OPEN_CLOSE=0):
+        gate.current_mode = "normal_home"
+        subscription = EventBus.subscribe()
+        # main_loop uses the gate and job queue made when main.py is run
+        main.gate, main.job_q = gate, gate.job_q
+        worker = threading.Thread(target=lambda: [main.main_loop() for _ in range(cycles)],
+                                  daemon=True)
+        worker.start()
+        for _ in range(cycles):
+            Tracer.trigger("benchmark")
+            gate.job_q.validate_and_put("open")
+            if not any(event.event_type == "cycle" for event in wait_for_cycle(subscription)):
+                raise RuntimeError("The gate cycle did not finish")
+            spans = Tracer.export(last=1)[0]["spans"]
+            latencies.append(next(span["start"] for span in spans
+                                  if span["name"] == "open:motor_on"))
+        worker.join(timeout=5)
+        EventBus.unsubscribe(subscription)
+    ArduinoInterface.mock_voltages[config.SHUNT_PIN] = 0
+    return statistics.median(latencies) * 1000
+
+
+@benchmark("job_queue_jobs_per_second", "jobs/s")
+def job_queue(scale):
+    """ Jobs through the job queue from producers that each put bursts of jobs
+    """
+    producers, bursts, burst_size = 4, max(2, int(50 * scale)), 50
+    total = producers * bursts * burst_size
+    directory = tempfile.mkdtemp()
+    job_q = JobQueue(config.COMMANDS, os.path.join(directory, "pipe"))
+
+    def produce():
+        for _ in range(bursts):
+            for _ in range(burst_size):
+                job_q.validate_and_put("open")
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=produce) for _ in range(producers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for _ in range(total):
+        job_q.get()
+    elapsed = time.perf_counter() - start
+    for thread in threads:
+        thread.join()
+    job_q.cleanup()
+    shutil.rmtree(directory)
+    return total / elapsed
+
+
+class StubConnection:
+    """ DB connection and cursor that accept every statement
+    """
+    closed = 0
+
+    def execute(self, sql, values=None):
+        """ Nothing is executed """
+
+    def commit(self):
+        """ Nothing to commit """
+
+
+@benchmark("db_inserts_per_second", "inserts/s", tolerance=0.5)
+def db_inserts(scale):
+    """ Entries and battery voltages logged through add_entry and log_voltage. The connection is a
+    stub, so this is the gate's side of each insert rather than the time postgres takes
+    """
+    inserts = max(100, int(20000 * scale))
+    database = DB.__new__(DB)
+    database.connection = database.cursor = StubConnection()
+    database.db_running = True
+    entry_dt = datetime.datetime.now()
+    start = time.perf_counter()
+    for insert in range(inserts):
+        if insert % 2:
+            database.add_entry("outside", entry_dt)
+        else:
+            database.log_voltage(26.1, 25.9, 26.3, 0.05, 30)
+    return inserts / (time.perf_counter() - start)
+
+
+@benchmark("log_record_overhead_us", "us/record", higher_is_better=False, tolerance=0.75)
+def log_overhead(scale):
+    """ Time the logging thread spends on each record put on the bounded log queue, the
+    listener formats and writes them on its own thread
+    """
+    records = max(100, int(20000 * scale))
+    bench_logger = logging.getLogger("benchmark")
+    bench_logger.propagate = False
+    bench_logger.setLevel(logging.DEBUG)
+    handler = BoundedQueueHandler(capacity=2 * records)
+    with open(os.devnull, "w") as devnull:
+        stream_handler = logging.StreamHandler(devnull)
+        stream_handler.setFormatter(logging.Formatter(config.LOG_FORMAT))
+        listener = logging.handlers.QueueListener(handler.queue, stream_handler)
+        bench_logger.addHandler(handler)
+        disabled = logging.root.manager.disable
+        logging.disable(logging.NOTSET)
+        listener.start()
+        try:
+            start = time.perf_counter()
+            for record in range(records):
+                bench_logger.info("Shunt voltage %s at %d", 0.0032, record)
+            elapsed = time.perf_counter() - start
+        finally:
+            listener.stop()
+            logging.disable(disabled)
+            bench_logger.removeHandler(handler)
+    return elapsed / records * 1e6
+
+
+def run(scale=1.0, names=None, repeats=3):
+    """ Run the benchmarks (all of them if names is None), returns name to the best value of the
+    repeats, as other work on the machine can only make a result worse
+    """
+    results = collections.OrderedDict()
+    for name, (function, _, higher_is_better, _) in BENCHMARKS.items():
+        if names is None or name in names:
+            values = [function(scale) for _ in range(repeats)]
+            results[name] = max(values) if higher_is_better else min(values)
+    return results
+
+
+def machine():
+    """ Key of the baselines for this type of machine
+    """
+    return platform.machine() or "unknown"
+
+
+def load_baseline(path=BASELINE_FILE):
+    """ Baseline results for this type of machine, empty if there are none
+    """
+    try:
+        with open(path, "r") as baseline_file:
+            return json.load(baseline_file).get(machine(), {})
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(results, path=BASELINE_FILE):
+    """ Store results as the baseline for this type of machine
+    """
+    try:
+        with open(path, "r") as baseline_file:
+            baselines = json.load(baseline_file)
+    except FileNotFoundError:
+        baselines = {}
+    baselines[machine()] = {name: round(value, 3) for name, value in results.items()}
+    with open(path, "w") as baseline_file:
+        json.dump(baselines, baseline_file, indent=4, sort_keys=True)
+        baseline_file.write("\n")
+
+
+def compare(results, baseline):
+    """ Names of the results that are worse than their baseline by more than the tolerance
+    """
+    regressions = []
+    for name, value in results.items():
+        _, _, higher_is_better, tolerance = BENCHMARKS[name]
+        if name not in baseline:
+            continue
+        if higher_is_better and value < baseline[name] * (1 - tolerance):
+            regressions.append(name)
+        elif not higher_is_better and value > baseline[name] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def report(results, baseline, regressions):
+    """ Table of the results against the baseline
+    """
+    lines = ["{:<28} {:>12} {:<10} {:>12} {:>8}".format(
+        "benchmark", "result", "", "baseline", "change")]
+    for name, value in results.items():
+        unit = BENCHMARKS[name][1]
+        if name in baseline:
+            change = "{:+.0%}".format(value / baseline[name] - 1) if baseline[name] else ""
+            line = "{:<28} {:>12.3f} {:<10} {:>12.3f} {:>8}".format(
+                name, value, unit, baseline[name], change)
+        else:
+            line = "{:<28} {:>12.3f} {:<10} {:>12}".format(name, value, unit, "none")
+        lines.append(line + ("  REGRESSION" if name in regressions else ""))
+    return "\n".join(lines)
+
+
+def cli():
+    """ Run the benchmarks from the command line
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the gate's hot paths")
+    parser.add_argument("--update", action="store_true",
+                        help="store the results as the baseline for this machine type")
+    parser.add_argument("--report-only", action="store_true",
+                        help="report regressions without failing, the baseline may be from "
+                             "another machine of the same type")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="fraction of the full number of iterations to run")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="times each benchmark is run, the best result is kept")
+    parser.add_argument("names", nargs="*", choices=[[]] + list(BENCHMARKS),
+                        help="benchmarks to run (default all)")
+    args = parser.parse_args()
+    # The gate's own logging would be part of what is measured
+    logging.disable(logging.CRITICAL)
+    results = run(args.scale, args.names or None, args.repeats)
+    baseline = load_baseline()
+    regressions = compare(results, baseline)
+    print("Benchmarks on {}".format(machine()))
+    print(report(results, baseline, regressions))
+    if args.update:
+        save_baseline(dict(baseline, **results))
+        print("Baseline updated in {}".format(BASELINE_FILE))
+        return 0
+    return 1 if regressions and not args.report_only else 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
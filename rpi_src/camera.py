@@ -2,11 +2,12 @@
 the smart-gate
 """
 import os
-import time
 import logging
 import queue
 import threading
+from clock import SYSTEM_CLOCK
 from config import Config as config
+from metrics import Metrics
 from serial_analog import ArduinoInterface
 
 logger = logging.getLogger('root')
@@ -17,14 +18,19 @@ except OSError:
     # Camera module only works on RPi, ensure it is disabled
     config.CAMERA_ENABLED = False
 
+CAPTURE_TIME = Metrics.histogram("camera_capture_seconds", "Time taken to capture a picture")
+
 class Camera():
     """ Class to handle operations of the camera """
-    def __init__(self, entry_db):
+    def __init__(self, entry_db, clock=None):
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
         # setup camera queue and start a thread to read it and handle the camera
         self.camera_q = queue.Queue()
         threading.Thread(target=self._read_queue, daemon=True).start()
         logger.debug("Camera class has been initialized")
         self.entry_db = entry_db
+        # Pictures can be turned off at runtime to save power
+        self.enabled = True
 
     @staticmethod
     def move_servo(position):
@@ -50,16 +56,19 @@ class Camera():
         logger.debug("Taking a picture: %s", filepath)
 
         # Create camera objects
+        start = self.clock.monotonic()
         camera = PiCamera()
         camera.resolution = (2592, 1944)
 
         camera.start_preview()
-        time.sleep(5)
+        self.clock.sleep(5)
         camera.capture(filename)
         camera.close()
+        CAPTURE_TIME.observe(self.clock.monotonic() - start)
 
         # Update db with filename
-        self.entry_db.add_media_filename(now, filename)
+        if self.entry_db is not None:
+            self.entry_db.add_media_filename(now, filename)
 
     def _read_queue(self):
         """ Method that monitors camera queue and takes pictures when requested
@@ -74,7 +83,9 @@ class Camera():
             if job == 'kill':
                 logger.warning('received kill command on camera queue')
                 return
-            if job == 'inside':
+            if job in ('inside', 'outside') and not self.enabled:
+                logger.debug("Camera is disabled, not taking a picture")
+            elif job == 'inside':
                 self.move_servo(config.CAMERA_INSIDE_ANGLE)
                 self.take_picture(entry_dt)
             elif job == 'outside':
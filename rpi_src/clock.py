@@ -0,0 +1,141 @@
+""" Module for the clocks the gate's timing logic runs on.
+The system clock is real time. The virtual clock only moves forward when it is advanced or when code
+running on it sleeps, polls or waits, so tests and simulations can run hours of gate activity in
+moments. Timers set on the virtual clock run as it passes their time, in place of the threads that
+would otherwise put jobs on the queue or change readings at the right moment.
+"""
+import heapq
+import itertools
+import time
+
+
+class ClockIdle(Exception):
+    """ Waiting on the virtual clock for something that no timer will ever do
+    """
+
+
+class SystemClock:
+    """ Real time, waits block on the caller's own primitive
+    """
+    virtual = False
+
+    @staticmethod
+    def monotonic():
+        """ Monotonic time in seconds """
+        return time.monotonic()
+
+    @staticmethod
+    def time():
+        """ Wall clock time in seconds since the epoch """
+        return time.time()
+
+    @staticmethod
+    def sleep(seconds):
+        """ Block for seconds """
+        time.sleep(seconds)
+
+    @staticmethod
+    def poll():
+        """ Called on every pass of a polling loop, real time passes on its own """
+
+    @staticmethod
+    def wait_until(_predicate, _timeout=None):
+        """ Returns False, the caller blocks on its own primitive in real time """
+        return False
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+class VirtualClock:
+    """ Clock that only moves when told to.
+    poll_interval: the time a pass of a polling loop takes, the serial round trip on the gate
+    """
+    virtual = True
+
+    def __init__(self, wall=None, poll_interval=0.01):
+        self._monotonic = 0.0
+        self._wall = time.time() if wall is None else wall
+        self.poll_interval = poll_interval
+        self._timers = []
+        self._counter = itertools.count()
+        self._listeners = []
+
+    def monotonic(self):
+        """ Virtual monotonic time in seconds """
+        return self._monotonic
+
+    def time(self):
+        """ Virtual wall clock time in seconds since the epoch """
+        return self._wall
+
+    def call_at(self, when, function, *args):
+        """ Run function(*args) once the clock reaches the monotonic time when
+        """
+        heapq.heappush(self._timers, (when, next(self._counter), function, args))
+
+    def call_later(self, delay, function, *args):
+        """ Run function(*args) once the clock has moved on by delay seconds
+        """
+        self.call_at(self._monotonic + delay, function, *args)
+
+    def pending(self):
+        """ Number of timers still to run """
+        return len(self._timers)
+
+    def add_listener(self, function):
+        """ Call function with no arguments every time the clock moves
+        """
+        self._listeners.append(function)
+
+    def remove_listener(self, function):
+        """ Stop calling function when the clock moves
+        """
+        if function in self._listeners:
+            self._listeners.remove(function)
+
+    def advance(self, seconds):
+        """ Move the clock forward, running the timers that fall due on the way in order
+        """
+        self.advance_to(self._monotonic + seconds)
+
+    def advance_to(self, when):
+        """ Move the clock to the monotonic time when, running the timers due by then
+        """
+        while self._timers and self._timers[0][0] <= when:
+            due, _, function, args = heapq.heappop(self._timers)
+            self._move(due)
+            function(*args)
+        self._move(when)
+
+    def _move(self, when):
+        if when <= self._monotonic:
+            return
+        self._wall += when - self._monotonic
+        self._monotonic = when
+        for listener in list(self._listeners):
+            listener()
+
+    def sleep(self, seconds):
+        """ Move the clock forward by seconds """
+        self.advance(seconds)
+
+    def poll(self):
+        """ Move the clock forward by the time a pass of a polling loop takes """
+        self.advance(self.poll_interval)
+
+    def wait_until(self, predicate, timeout=None):
+        """ Run timers until predicate() is true or timeout seconds have passed, returns True as
+        the waiting has been done on the clock. Raises ClockIdle if waiting forever with nothing
+        left that could make predicate() true
+        """
+        deadline = None if timeout is None else self._monotonic + timeout
+        while not predicate():
+            if self._timers and (deadline is None or self._timers[0][0] <= deadline):
+                self.advance_to(self._timers[0][0])
+            elif deadline is None:
+                raise ClockIdle("Waiting forever with no timers left to run")
+            else:
+                self.advance_to(deadline)
+                break
+        return True
@@ -0,0 +1,166 @@
+""" Module for the Unix domain socket command server.
+Clients send one command per line and receive one JSON line in response, in the same order the
+commands were sent, so several commands can be pipelined on a single connection.
+"""
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+
+from config import Config as config
+from battery_voltage_log import BatteryVoltageLog
+from recorder import Recorder
+from status import StatusSnapshot
+from tracing import Tracer
+
+logger = logging.getLogger("root")
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    """ Handles a single client connection
+    """
+    def handle(self):
+        """ Respond to each line sent by the client until it disconnects
+        """
+        for line in self.rfile:
+            response = CommandServer.handle_command(line.decode(errors="replace"))
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class CommandServer:
+    """ Line oriented command server for controlling the gate.
+    Job commands (open, close and the modes) are put on the job queue, then the server waits
+    briefly for the gate to act on them so the response includes the resulting state.
+    """
+    socket_path = None
+    server = None
+    gate = None
+    job_q = None
+    # Maximum time to wait for the gate to act on a command before responding (seconds)
+    ack_timeout = 1.0
+    commands = {}
+
+    @classmethod
+    def initialize(cls, gate, job_q):
+        """ Give the server access to the gate and its job queue and register the commands
+        """
+        cls.gate = gate
+        cls.job_q = job_q
+        cls.add_command("status", cls._snapshot, "current gate status snapshot")
+        cls.add_command("battery", cls._battery, "read the battery voltage")
+        cls.add_command("traces", cls._traces, "recent gate cycle timelines, optionally the last N")
+        cls.add_command("help", cls._help, "list the available commands")
+
+    @classmethod
+    def add_command(cls, name, callback, description):
+        """ Register a command. callback is called with the list of arguments that followed the
+        command and returns a dictionary that is merged into the response
+        """
+        cls.commands[name] = (callback, description)
+
+    @classmethod
+    def start(cls, socket_path):
+        """ Start serving on socket_path in a daemon thread
+        """
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        cls.socket_path = socket_path
+        cls.server = socketserver.ThreadingUnixStreamServer(socket_path, _CommandHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        logger.info("Command server listening on %s", socket_path)
+
+    @classmethod
+    def stop(cls):
+        """ Stop the server and remove the socket
+        """
+        if cls.server is not None:
+            cls.server.shutdown()
+            cls.server.server_close()
+            cls.server = None
+            os.remove(cls.socket_path)
+
+    @classmethod
+    def handle_command(cls, line):
+        """ Run a single command line and return the response dictionary
+        """
+        words = line.split()
+        if not words:
+            return {"ok": False, "error": "empty command"}
+        command, args = words[0], words[1:]
+        logger.debug("Received message via command socket: %s", line.strip())
+        try:
+            if cls.job_q is not None and command in cls.job_q.valid_commands:
+                response = cls._job(command)
+            elif command in cls.commands:
+                response = cls.commands[command][0](args)
+            else:
+                return {"ok": False, "command": command, "error": "unknown command"}
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warning("Command %s failed: %s", command, err)
+            return {"ok": False, "command": command, "error": str(err)}
+        return dict({"ok": True, "command": command}, **response)
+
+    @classmethod
+    def _job(cls, command):
+        """ Put a job on the queue and wait for the gate to act on it
+        """
+        Recorder.command(command)
+        if command == "open":
+            Tracer.trigger("socket")
+        cls.job_q.validate_and_put(command)
+        deadline = time.monotonic() + cls.ack_timeout
+        while not cls._applied(command) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return dict(cls._status([]), applied=cls._applied(command))
+
+    @classmethod
+    def _applied(cls, command):
+        """ Check if the gate has acted on a job command
+        """
+        if command in config.MODES:
+            return cls.gate.current_mode == command
+        if command == "open":
+            return cls.gate.current_state in ("opening", "opened", "holding")
+        return cls.gate.current_state in ("closing", "closed")
+
+    @classmethod
+    def _status(cls, _args):
+        """ Current state and mode of the gate
+        """
+        return {"state": cls.gate.current_state, "mode": cls.gate.current_mode,
+                "queued": cls.job_q.qsize()}
+
+    @staticmethod
+    def _snapshot(_args):
+        """ In memory status snapshot
+        """
+        return StatusSnapshot.render()
+
+    @staticmethod
+    def _battery(_args):
+        """ Read the battery voltage from the Arduino
+        """
+        return {"battery_voltage": BatteryVoltageLog.read_battery_voltage(2)}
+
+    @staticmethod
+    def _traces(args):
+        """ Recent gate cycle timelines
+        """
+        last = int(args[0]) if args else None
+        return {"traces": Tracer.export(last)}
+
+    @classmethod
+    def _help(cls, _args):
+        """ Describe the available commands
+        """
+        commands = {name: description for name, (_, description) in cls.commands.items()}
+        if cls.job_q is not None:
+            for job in cls.job_q.valid_commands:
+                commands[job] = "put {} on the gate job queue".format(job)
+        return {"commands": commands}
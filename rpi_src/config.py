@@ -5,18 +5,34 @@ import json
 import logging
 import logging.handlers
 import os
-from queue import Queue
 import configparser
 import subprocess
+import threading
 from pathlib import Path
 
-from jsonschema import validate
+from alerts import AlertHandler
+from events import AlertEventHandler
+from log_queue import BoundedQueueHandler
+from log_storage import LogStorage
+from metrics import Metrics
 
 
 class Config:
     """ Config class, manages the logging and initialization of all the necesarry globals.
     Every module in smart-gate imports this config object
     """
+    # Settings that are only read at start up, changing them in conf.ini needs a restart
+    RESTART_SETTINGS = (
+        "MOTORPIN0", "MOTORPIN1", "BUTTON_OUTSIDE_PIN", "BUTTON_INSIDE_PIN", "BUTTON_BOX_PIN",
+        "SHUNT_PIN", "BATTERY_VOLTAGE_PIN", "DB_PASSWORD", "CAMERA_ENABLED", "CAMERA_SAVE_PATH",
+        "BATTERY_SAMPLE_INTERVAL", "BATTERY_ALERT_SAMPLES", "BATTERY_LOG_INTERVAL",
+        "JOURNAL_CAPACITY", "HTTP_API_HOST", "HTTP_API_PORT", "ADC_OVERSAMPLING", "SERIAL_PORT",
+        "RECORD_FILE", "RECORD_MAX_BYTES",
+    )
+    LOG_FORMAT = "%(levelname)s %(asctime)s : %(message)s"
+    # Held while the gate is moving, so reloaded settings are only swapped in between cycles
+    reload_lock = threading.Lock()
+
     @classmethod
     def init_conf(cls):
         """ This is the entry point for the class and running this will setup the smart-gate
@@ -49,16 +65,30 @@ class Config:
         # Arduino Log path
         cls.ARDUINO_LOG = os.path.join(str(Path.home()), "arduino.log")
 
+        # Gate cycle timelines exported on request
+        cls.TRACE_FILE = os.path.join(str(Path.home()), "gate_traces.json")
+
+        # Recent event journal, kept between restarts
+        cls.JOURNAL_FILE = os.path.join(str(Path.home()), ".local/share/smart-gate/journal.bin")
+
         # Named pipe
         cls.FIFO_FILE = os.path.join(str(Path.home()), "pipe")
 
+        # Unix socket for the command server
+        cls.COMMAND_SOCKET = os.path.join(str(Path.home()), "gate.sock")
+
+        # Emails that could not be sent are kept here to be retried
+        cls.ALERT_SPOOL_PATH = os.path.join(cls.CONFIG_PATH, "alert_spool")
+
         # Store gate mode incase of restart
         cls.SAVED_MODE_FILE = os.path.join(cls.CONFIG_PATH, "saved_mode.txt")
 
+        # Gate state, position, counters and calibration incase of restart
+        cls.STATE_FILE = os.path.join(cls.CONFIG_PATH, "gate_state.json")
+
     @classmethod
     def gate_globals(cls):
         """ Sets all the smart-gate globals such as pin values, and parameters """
-
         # Get globals from environment
         try:
             cls.VERSION = os.environ["SMART_GATE_VERSION"]
@@ -72,7 +102,25 @@ class Config:
 
         # Read from config file
         config = cls.read_write_config(os.path.join(cls.CONFIG_PATH, "conf.ini"))
+        # Kept to compare against when reloading, some globals are changed at runtime
+        cls.load_settings(config)
+        cls.file_settings = cls.read_settings(config)
+
+        # Commands that the gate needs to be able to handle on the job queue
+        cls.COMMANDS = ["open", "close"]
+
+        # Valid modes for gate operation (First mode is default incase case of error on start up)
+        cls.MODES = ["normal_home", "normal_away", "lock_closed", "lock_open"]
+
+        os.makedirs(cls.CAMERA_SAVE_PATH, exist_ok=True)
+        cls.apply_logging_settings()
 
+    @classmethod
+    def load_settings(cls, config):
+        """ Read and validate every setting in conf.ini.
+        Raises ValueError or configparser.Error if the file is invalid
+        """
+        # pylint: disable=too-many-statements
         # Board Pin numbers
         cls.MOTORPIN0 = config.getint("raspberry_pins", "motor_pin_0")
         cls.MOTORPIN1 = config.getint("raspberry_pins", "motor_pin_1")
@@ -84,10 +132,16 @@ class Config:
         # Arduino analog pins
         cls.SHUNT_PIN = config.getint("arduino_pins", "shunt")
         cls.BATTERY_VOLTAGE_PIN = config.getint("arduino_pins", "battery_voltage")
+        # Serial device of the arduino, wildcards match the first device that exists
+        cls.SERIAL_PORT = config.get("arduino_pins", "serial_port", fallback="/dev/ttyUSB*")
 
         # Parameters
         cls.SHUNT_THRESHOLD = config.getfloat("parameters", "shunt_threshold")
         cls.SHUNT_READ_DELAY = config.getfloat("parameters", "shunt_read_delay")
+        cls.SHUNT_STALE_TIME = config.getfloat("parameters", "shunt_stale_time", fallback=1.0)
+        cls.ADC_OVERSAMPLING = config.getint("parameters", "adc_oversampling", fallback=21)
+        if not 1 <= cls.ADC_OVERSAMPLING <= 32:
+            raise ValueError("adc_oversampling is not between 1 and 32")
         cls.EXPECTED_TIME_TO_OPEN_CLOSE = config.getint("parameters", "expected_time_to_open_close")
         cls.MAX_TIME_TO_OPEN_CLOSE = cls.EXPECTED_TIME_TO_OPEN_CLOSE * 1.2
         cls.MIN_TIME_TO_OPEN_CLOSE = cls.EXPECTED_TIME_TO_OPEN_CLOSE * 0.8
@@ -97,12 +151,15 @@ class Config:
         )
         cls.BATTERY_UPPER_ALERT = config.getfloat("parameters", "upper_battery_voltage_alert")
         cls.BATTERY_LOWER_ALERT = config.getfloat("parameters", "lower_battery_voltage_alert")
-
-        # Commands that the gate needs to be able to handle on the job queue
-        cls.COMMANDS = ["open", "close"]
-
-        # Valid modes for gate operation (First mode is default incase case of error on start up)
-        cls.MODES = ["normal_home", "normal_away", "lock_closed", "lock_open"]
+        cls.BATTERY_SAMPLE_INTERVAL = config.getfloat(
+            "parameters", "battery_sample_interval", fallback=2)
+        cls.BATTERY_ALERT_SAMPLES = config.getint("parameters", "battery_alert_samples", fallback=5)
+        cls.BATTERY_LOG_INTERVAL = config.getint("parameters", "battery_log_interval", fallback=60)
+        cls.POWER_SAVER_SOC = config.getfloat("parameters", "power_saver_soc", fallback=50)
+        cls.POWER_CRITICAL_SOC = config.getfloat("parameters", "power_critical_soc", fallback=25)
+        cls.SHUNT_RESISTANCE = config.getfloat("parameters", "shunt_resistance", fallback=0.01)
+        cls.RESISTANCE_ALERT_RISE = config.getfloat(
+            "parameters", "resistance_alert_rise", fallback=0.3)
 
         # 8 Character password that the arduino 433MHz is looking for, if 433MHz receiver is used
         cls.RADIO_KEY = config.get("keys", "radio_key")
@@ -124,24 +181,96 @@ class Config:
         cls.CAMERA_OUTSIDE_ANGLE = config.getint("camera", "outside_button_angle")
         if not ((0 <= cls.CAMERA_INSIDE_ANGLE <= 180) and (0 <= cls.CAMERA_OUTSIDE_ANGLE <= 180)):
             raise ValueError("Camera servo angle is not between 0 and 180")
-        os.makedirs(cls.CAMERA_SAVE_PATH, exist_ok=True)
+
+        # Log storage
+        cls.LOG_MAX_BYTES = config.getint("logging", "max_log_size_kb", fallback=1024) * 1024
+        cls.LOG_MAX_AGE = config.getfloat("logging", "max_log_age_days", fallback=7) * 24 * 60 * 60
+        cls.LOG_FLUSH_INTERVAL = config.getfloat("logging", "flush_interval", fallback=5)
+        cls.LOG_BUDGET_BYTES = config.getint("logging", "log_budget_mb", fallback=50) * 1024 * 1024
+        cls.ARDUINO_LOG_LEVEL = config.get("logging", "arduino_log_level", fallback="INFO")
+        if not isinstance(logging.getLevelName(cls.ARDUINO_LOG_LEVEL), int):
+            raise ValueError("Invalid arduino_log_level: {}".format(cls.ARDUINO_LOG_LEVEL))
+        cls.LOG_QUEUE_CAPACITY = config.getint(
+            "logging", "log_queue_capacity", fallback=1000)
+        cls.JOURNAL_CAPACITY = config.getint("logging", "journal_capacity", fallback=4096)
+        cls.RECORD_FILE = config.get("logging", "record_file", fallback="")
+        cls.RECORD_MAX_BYTES = config.getint("logging", "record_max_mb", fallback=50) * 1024 * 1024
+
+        # Local HTTP API (metrics and status endpoints)
+        cls.HTTP_API_HOST = config.get("api", "http_host", fallback="127.0.0.1")
+        cls.HTTP_API_PORT = config.getint("api", "http_port", fallback=9180)
+
+        if cls.BATTERY_LOWER_ALERT >= cls.BATTERY_UPPER_ALERT:
+            raise ValueError("Lower battery voltage alert is not below the upper alert")
+        if cls.POWER_CRITICAL_SOC > cls.POWER_SAVER_SOC:
+            raise ValueError("Power critical state of charge is above the saver state of charge")
+
+    @classmethod
+    def read_settings(cls, config):
+        """ Dictionary of global name to value of the settings in conf.ini, read without changing
+        the current globals
+        """
+        snapshot = type("ConfigSnapshot", (cls,), {})
+        snapshot.load_settings(config)
+        return {name: value for name, value in vars(snapshot).items() if name.isupper()}
+
+    @classmethod
+    def reload(cls):
+        """ Re-read conf.ini and swap in the settings that changed, waiting for the gate cycle in
+        progress to finish. Nothing is applied if the new file is invalid or changes a setting that
+        needs a restart. Returns a report of what was applied or why it was rejected
+        """
+        try:
+            settings = cls.read_settings(
+                cls.read_write_config(os.path.join(cls.CONFIG_PATH, "conf.ini")))
+        except (ValueError, configparser.Error) as err:
+            cls.logger.error("Config reload rejected, conf.ini is invalid: %s", err)
+            return {"applied": {}, "rejected": str(err)}
+        changed = {name: value for name, value in settings.items()
+                   if cls.file_settings.get(name) != value}
+        restart = [name for name in changed if name in cls.RESTART_SETTINGS]
+        if restart:
+            reason = "{} can only be changed with a restart".format(", ".join(
+                "{} ({} to {})".format(name, cls.file_settings.get(name), changed[name])
+                for name in restart))
+            cls.logger.error("Config reload rejected, %s", reason)
+            return {"applied": {}, "rejected": reason}
+        with cls.reload_lock:
+            for name, value in changed.items():
+                setattr(cls, name, value)
+            cls.apply_logging_settings()
+        cls.file_settings = settings
+        if changed:
+            cls.logger.info("Config reloaded: %s", changed)
+        return {"applied": changed, "rejected": None}
+
+    @classmethod
+    def apply_logging_settings(cls):
+        """ Apply the logging settings to the existing log handlers
+        """
+        LogStorage.configure(
+            max_bytes=cls.LOG_MAX_BYTES,
+            max_age=cls.LOG_MAX_AGE,
+            flush_interval=cls.LOG_FLUSH_INTERVAL,
+            budget_bytes=cls.LOG_BUDGET_BYTES,
+        )
+        cls.log_queue_handler.capacity = cls.LOG_QUEUE_CAPACITY
+        logging.getLogger("serial_analog").setLevel(cls.ARDUINO_LOG_LEVEL)
 
     @classmethod
     def root_logger(cls):
         """ Creates the root logger that every other module will use.
         The root logger is threaded, and has a stdout, file and email handler.
+        The email handler is served by its own listener so a slow SMTP server can't block the
+        others.
         """
         # Create root logger
-        log_format = "%(levelname)s %(asctime)s : %(message)s"
+        log_format = cls.LOG_FORMAT
         cls.logger = logging.getLogger("root")
         cls.logger.setLevel(logging.DEBUG)
 
-        # Log to file, rotate logs every Monday
-        file_handler = logging.handlers.TimedRotatingFileHandler(
-            cls.GATE_LOG, when="W0", backupCount=50
-        )
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(logging.Formatter(log_format))
+        # Log to file, rotated by size and age then compressed (see log_storage.py)
+        file_handler = LogStorage.file_handler(cls.GATE_LOG, logging.DEBUG, log_format)
 
         # Log to stdout as well
         stream_handler = logging.StreamHandler()
@@ -150,34 +279,79 @@ class Config:
 
         # Log to email
         cls.email_conf()
-        if cls.EMAIL_LOGGING:
-            email_handler = logging.handlers.SMTPHandler(
-                mailhost=(cls.SMTP, cls.PORT),
-                fromaddr=cls.FROMADDR,
-                toaddrs=cls.TOADDRS,
-                subject=cls.SUBJECT,
-                credentials=(cls.USER_ID, cls.USER_KEY),
-                secure=(),
-            )
-            email_handler.setFormatter(logging.Formatter(log_format))
-            email_handler.setLevel(logging.WARNING)
-        else:
-            # No email conf has been provided. Set to NullHandler for the QueueListener
-            email_handler = logging.NullHandler()
+        email_handler = cls.email_handler()
 
-        # Log everything to a Queue to avoid each handler from blocking (especially email handler)
-        log_q = Queue()
-        queue_handler = logging.handlers.QueueHandler(log_q)
-        cls.logger.addHandler(queue_handler)
+        # Log everything to a bounded Queue to avoid each handler from blocking, when the queue
+        # fills up DEBUG records are dropped first and CRITICAL records are never dropped
+        cls.log_queue_handler = BoundedQueueHandler(capacity=1000)
+        cls.logger.addHandler(cls.log_queue_handler)
+        Metrics.gauge("log_queue_depth", "Log records waiting for the log listener").set_function(
+            cls.log_queue_handler.queue.qsize)
 
-        # Listen for log messages on log_q and forward them to the file, stream and email handlers
+        # Listen for log messages on the queue and forward them to the file and stream handlers
         cls.log_listener = logging.handlers.QueueListener(
-            log_q, file_handler, stream_handler, email_handler, respect_handler_level=True
+            cls.log_queue_handler.queue, file_handler, stream_handler, respect_handler_level=True
         )
         cls.log_listener.start()
+
+        # The email handler gets its own queue and listener so it can never stall file logging
+        cls.alert_queue_handler = BoundedQueueHandler(capacity=100)
+        cls.alert_queue_handler.setLevel(logging.WARNING)
+        cls.logger.addHandler(cls.alert_queue_handler)
+        # Alerts are also published to the status event stream
+        alert_event_handler = AlertEventHandler()
+        alert_event_handler.setLevel(logging.WARNING)
+        cls.alert_listener = logging.handlers.QueueListener(
+            cls.alert_queue_handler.queue, email_handler, alert_event_handler,
+            respect_handler_level=True
+        )
+        cls.alert_listener.start()
         if cls.EMAIL_LOGGING is False:
             cls.logger.warning("No email config json found")
 
+    @classmethod
+    def email_handler(cls):
+        """ Create the email alert handler from the email config """
+        if not cls.EMAIL_LOGGING:
+            # No email conf has been provided. Set to NullHandler for the QueueListener
+            return logging.NullHandler()
+        # Warnings are sent as a digest, critical alerts are sent straight away
+        email_handler = AlertHandler(
+            mailhost=(cls.SMTP, cls.PORT),
+            fromaddr=cls.FROMADDR,
+            toaddrs=cls.TOADDRS,
+            subject=cls.SUBJECT,
+            credentials=(cls.USER_ID, cls.USER_KEY),
+            spool_dir=cls.ALERT_SPOOL_PATH,
+            dedupe_window=cls.ALERT_DEDUPE_WINDOW,
+            digest_interval=cls.ALERT_DIGEST_INTERVAL,
+        )
+        email_handler.setFormatter(logging.Formatter(cls.LOG_FORMAT))
+        email_handler.setLevel(logging.WARNING)
+        return email_handler
+
+    @classmethod
+    def reload_email(cls):
+        """ Re-read email_keys.json and replace the email handler. The current handler is kept if
+        the new file is invalid. Returns a report like reload
+        """
+        # Read into a subclass, so an invalid file doesn't leave the globals half changed
+        snapshot = type("EmailSnapshot", (cls,), {})
+        try:
+            snapshot.email_conf()
+        except Exception as err:  # pylint: disable=broad-except
+            # Invalid json or json that doesn't match the schema
+            cls.logger.error("Email config reload rejected: %s", err)
+            return {"applied": {}, "rejected": str(err)}
+        for name, value in vars(snapshot).items():
+            if name.isupper():
+                setattr(cls, name, value)
+        old_handler = cls.alert_listener.handlers[0]
+        cls.alert_listener.handlers = (cls.email_handler(),) + cls.alert_listener.handlers[1:]
+        old_handler.close()
+        cls.logger.info("Email config reloaded")
+        return {"applied": {"EMAIL_LOGGING": cls.EMAIL_LOGGING}, "rejected": None}
+
     @classmethod
     def email_conf(cls):
         """ Loads the email config from file for the email logging handler """
@@ -185,7 +359,8 @@ class Config:
         try:
             with open(cls.EMAIL_KEY_JSON, "r") as json_file:
                 json_data = json.load(json_file)
-            # Validate the json schema
+            # Validate the json schema, jsonschema is slow to import so only import it when needed
+            from jsonschema import validate  # pylint: disable=import-outside-toplevel
             json_schema = {
                 "type": "object",
                 "properties": {
@@ -194,6 +369,8 @@ class Config:
                     "fromaddr": {"type": "string"},
                     "toaddrs": {"type": "array", "minItems": 1},
                     "subject": {"type": "string"},
+                    "dedupe_window": {"type": "number"},
+                    "digest_interval": {"type": "number"},
                     "credentials": {
                         "type": "object",
                         "properties": {"id": {"type": "string"}, "key": {"type": "string"}},
@@ -208,6 +385,9 @@ class Config:
             cls.SUBJECT = json_data["subject"]
             cls.USER_ID = json_data["credentials"]["id"]
             cls.USER_KEY = json_data["credentials"]["key"]
+            # Optional alert rate limiting (seconds)
+            cls.ALERT_DEDUPE_WINDOW = json_data.get("dedupe_window", 600)
+            cls.ALERT_DIGEST_INTERVAL = json_data.get("digest_interval", 900)
             cls.EMAIL_LOGGING = True
         except FileNotFoundError:
             cls.EMAIL_LOGGING = False
@@ -237,6 +417,9 @@ class Config:
                 "button_inside": "4",
                 "# Optional pin for debugging or mounted on control box": None,
                 "button_debug": "2",
+                "# Serial device the Arduino is plugged into, wildcards match the first device "
+                "found. Set to the link made by emulator.py to run without an Arduino": None,
+                "serial_port": "/dev/ttyUSB*",
             }
 
             config["parameters"] = {
@@ -251,6 +434,13 @@ class Config:
                 "# Delay before reading shunt voltage, due to motor startup current spike (seconds)"
                 : None,
                 "shunt_read_delay": "0.5",
+                "# Stop the motor when no shunt voltage has been read for this long. After a "
+                "failed read the gate is stopped at the expected time to open/close (seconds)"
+                : None,
+                "shunt_stale_time": "1.0",
+                "# Number of recent samples the Arduino takes the median of for each voltage "
+                "(1 to 32)": None,
+                "adc_oversampling": "21",
                 "# Correction factor for battery voltage input. Gets multiplied to the arduinos "
                 "voltage reading on the battery voltage pin": None,
                 "battery_voltage_correction_factor": "10.7",
@@ -258,6 +448,25 @@ class Config:
                 "these values (volts)": None,
                 "upper_battery_voltage_alert": "29.6",
                 "lower_battery_voltage_alert": "24.5",
+                "# Seconds between battery voltage samples": None,
+                "battery_sample_interval": "2",
+                "# Alerts use the average of this many recent samples, so the sag while the motor "
+                "starts doesn't raise an alert": None,
+                "battery_alert_samples": "5",
+                "# Minutes between writing the battery voltage summary (min, max, mean, standard "
+                "deviation) to the log and db": None,
+                "battery_log_interval": "60",
+                "# Battery state of charge (percent) below which the gate saves power by sampling "
+                "and logging less": None,
+                "power_saver_soc": "50",
+                "# and below which it also stops taking pictures": None,
+                "power_critical_soc": "25",
+                "# Resistance of the motor current shunt, to convert its voltage to current (ohms)"
+                : None,
+                "shunt_resistance": "0.01",
+                "# Alert when the battery internal resistance measured during motor runs rises by "
+                "this fraction over its longer term level": None,
+                "resistance_alert_rise": "0.3",
             }
 
             config["camera"] = {
@@ -277,6 +486,41 @@ class Config:
                 "outside_button_angle": "170",
             }
 
+            config["logging"] = {
+                "# Log files are rotated and compressed when they reach this size (kilobytes)"
+                : None,
+                "max_log_size_kb": "1024",
+                "# or when they reach this age (days)": None,
+                "max_log_age_days": "7",
+                "# Total disk space for all logs, the oldest rotated logs are deleted first (MB)"
+                : None,
+                "log_budget_mb": "50",
+                "# Seconds between writing buffered logs to disk, warnings are written at once"
+                : None,
+                "flush_interval": "5",
+                "# Level for the arduino.log serial message log (DEBUG includes every message)"
+                : None,
+                "arduino_log_level": "INFO",
+                "# Maximum log records waiting to be written. When full, DEBUG records are dropped "
+                "first and CRITICAL records are never dropped": None,
+                "log_queue_capacity": "1000",
+                "# Number of recent events (entries, cycles, hits, mode changes...) kept in the "
+                "event journal": None,
+                "journal_capacity": "4096",
+                "# Record the Arduino messages, commands and triggers to this file for replay.py, "
+                "leave empty to not record": None,
+                "record_file": "",
+                "# Size of the record file before it is moved to <record_file>.1, replacing the "
+                "previous one, and a new one is started": None,
+                "record_max_mb": "50",
+            }
+
+            config["api"] = {
+                "# Address and port for the local HTTP API that serves metrics and status": None,
+                "http_host": "127.0.0.1",
+                "http_port": "9180",
+            }
+
             config["keys"] = {
                 "# Secret key to use for 433MHz radio, if being used. Must be 8 characters": None,
                 "radio_key": "8CharSec",
@@ -0,0 +1,138 @@
+""" Module to watch the config files for changes.
+inotify is used through ctypes, so there are no extra dependencies, watching the directory rather
+than the files so editors that save by renaming a new file into place are noticed. Where inotify
+is not available the files' modification times are polled instead.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+logger = logging.getLogger("root")
+
+# inotify event masks from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+# struct inotify_event header: watch descriptor, mask, cookie, length of the name that follows
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class ConfigWatcher:
+    """ Calls a callback when a watched file in a directory is written or replaced
+    """
+    POLL_INTERVAL = 2
+    # Wait for this long after a change before calling the callback, so a file written in several
+    # steps is only read once it's complete
+    SETTLE_TIME = 0.5
+
+    def __init__(self, directory, callbacks):
+        """ callbacks: dictionary of file name to the function to call when it changes
+        """
+        self.directory = directory
+        self.callbacks = callbacks
+        self._running = False
+        self._thread = None
+        self._fd = None
+
+    def start(self):
+        """ Start watching in a daemon thread
+        """
+        self._fd = self._inotify()
+        self._running = True
+        target = self._watch_inotify if self._fd is not None else self._watch_polling
+        self._thread = threading.Thread(target=target, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop watching
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _inotify(self):
+        """ Create an inotify watch on the directory, returns its file descriptor or None if
+        inotify is not available
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as err:
+            logger.debug("inotify not available, polling the config files: %s", err)
+            return None
+        if fd < 0:
+            logger.debug("inotify_init1 failed, polling the config files: %s",
+                         os.strerror(ctypes.get_errno()))
+            return None
+        if libc.inotify_add_watch(fd, self.directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            logger.debug("inotify_add_watch failed, polling the config files: %s",
+                         os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return None
+        return fd
+
+    def _read_events(self):
+        """ Names of the watched files in the pending inotify events
+        """
+        names = set()
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            if name in self.callbacks:
+                names.add(name)
+        return names
+
+    def _watch_inotify(self):
+        while self._running:
+            readable, _, _ = select.select([self._fd], [], [], 1)
+            if not readable:
+                continue
+            names = self._read_events()
+            if names:
+                # Collect any further writes to the same files before reading them
+                time.sleep(self.SETTLE_TIME)
+                names |= self._read_events()
+                self._changed(names)
+
+    def _stat(self, name):
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _watch_polling(self):
+        last = {name: self._stat(name) for name in self.callbacks}
+        while self._running:
+            time.sleep(self.POLL_INTERVAL)
+            current = {name: self._stat(name) for name in self.callbacks}
+            changed = {name for name in self.callbacks if current[name] != last[name]}
+            last = current
+            if changed:
+                self._changed(changed)
+
+    def _changed(self, names):
+        """ Call the callback of each changed file
+        """
+        for name in sorted(names):
+            logger.info("Config file %s changed, reloading", name)
+            try:
+                self.callbacks[name]()
+            except Exception as err:  # pylint: disable=broad-except
+                logger.error("Reloading %s failed: %s", name, err)
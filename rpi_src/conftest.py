@@ -0,0 +1,40 @@
+""" Fixtures shared by the test modules
+"""
+import os
+
+import pytest
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+
+from config import Config as config
+from serial_analog import ArduinoInterface
+from gate import Gate
+from job_queue import JobQueue
+
+
+@pytest.fixture(name="gate")
+def fixture_gate(tmp_path, monkeypatch):
+    """ Gate on mock pins with an empty job queue that accepts every command, the mock shunt
+    voltage is high so the gate stops as soon as it reads it
+    """
+    factory = MockFactory()
+    Device.pin_factory = factory
+    factory.reset()
+    monkeypatch.setattr(config, "SAVED_MODE_FILE", os.path.join(str(tmp_path), 'mode.txt'))
+    test_q = JobQueue(config.COMMANDS+config.MODES, os.path.join(str(tmp_path), 'pipe'))
+    ArduinoInterface.initialize()
+    ArduinoInterface.mock_voltages[config.SHUNT_PIN] = 10
+    yield Gate(test_q)
+    test_q.cleanup()
+
+
+@pytest.fixture(name="cycle_timings")
+def fixture_cycle_timings(monkeypatch):
+    """ Gate timings for a motor model that takes 20 seconds to open or close, returns the time
+    """
+    monkeypatch.setattr(config, "EXPECTED_TIME_TO_OPEN_CLOSE", 20)
+    monkeypatch.setattr(config, "MIN_TIME_TO_OPEN_CLOSE", 16)
+    monkeypatch.setattr(config, "MAX_TIME_TO_OPEN_CLOSE", 24)
+    monkeypatch.setattr(config, "HOLD_OPEN_TIME", 10)
+    monkeypatch.setattr(config, "SHUNT_READ_DELAY", 0.5)
+    return config.EXPECTED_TIME_TO_OPEN_CLOSE
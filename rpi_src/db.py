@@ -4,15 +4,24 @@ import time
 import logging
 import subprocess
 import datetime
-import tzlocal
-import psycopg2
+import threading
 from config import Config as config
+from metrics import Metrics
 
 root_logger = logging.getLogger("root")
 
+DB_COMMIT_LATENCY = Metrics.histogram(
+    "db_commit_seconds", "Time taken to execute and commit a write")
+
 class DB:
     """ DB class for managing the connections, tables, insertions
+    psycopg2 and tzlocal are imported when first used, so importing this module is quick at start up
+    The connection is shared by the entry, camera, battery and scheduler threads, so every use of it
+    and reconnecting hold _lock
     """
+    # pylint: disable=import-outside-toplevel
+    _lock = threading.RLock()
+
     @staticmethod
     def deploy():
         """ Deploy the postgres db in docker
@@ -37,24 +46,44 @@ class DB:
             time.sleep(1)
 
     def __init__(self):
-        try:
-            self.connection = psycopg2.connect(
-                database="smart-gate",
-                host="localhost",
-                user="smart-gate",
-                password=str(config.DB_PASSWORD),
-                )
-
-            self.cursor = self.connection.cursor()
-            self.create_entry_table()
-            self.create_batt_voltage_table()
-            self.db_running = True
-            root_logger.info("Connected to db successfully")
-        except psycopg2.OperationalError as err:
-            # Likely the db is not running, so continue without it.
-            self.db_running = False
-            root_logger.warning("DB did not connect (try deploying db), proceeding without db: %s",
-                                err)
+        self.db_running = False
+        self.connect()
+
+    def connect(self):
+        """ Connect to the db and create the tables if needed
+        """
+        import psycopg2
+        with self._lock:
+            try:
+                self.connection = psycopg2.connect(
+                    database="smart-gate",
+                    host="localhost",
+                    user="smart-gate",
+                    password=str(config.DB_PASSWORD),
+                    )
+
+                self.cursor = self.connection.cursor()
+                self.create_entry_table()
+                self.create_batt_voltage_table()
+                self.create_batt_resistance_table()
+                self.db_running = True
+                root_logger.info("Connected to db successfully")
+            except psycopg2.OperationalError as err:
+                # Likely the db is not running, so continue without it.
+                self.db_running = False
+                root_logger.warning(
+                    "DB did not connect (try deploying db), proceeding without db: %s", err)
+
+    def health_check(self):
+        """ Scheduled check that reconnects to the db if the connection was lost
+        """
+        if config.DB_PASSWORD is None:
+            return
+        with self._lock:
+            if self.db_running and self.connection.closed == 0:
+                return
+            root_logger.info("Reconnecting to db")
+            self.connect()
 
     def create_entry_table(self):
         """ Creates entry table in the smart-gate db
@@ -75,17 +104,56 @@ class DB:
             datetime TIMESTAMP NOT NULL UNIQUE, \
             timezone VARCHAR(50) NOT NULL, \
             voltage FLOAT NOT NULL);")
+        # Summary columns of the sampling window, voltage holds the mean
+        self.cursor.execute("ALTER TABLE BattVolt \
+            ADD COLUMN IF NOT EXISTS min_voltage FLOAT, \
+            ADD COLUMN IF NOT EXISTS max_voltage FLOAT, \
+            ADD COLUMN IF NOT EXISTS stddev FLOAT, \
+            ADD COLUMN IF NOT EXISTS samples INTEGER;")
         self.connection.commit()
 
+    def create_batt_resistance_table(self):
+        """ Creates battery internal resistance table in the smart-gate db
+        """
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS BattResistance( \
+            id SERIAL PRIMARY KEY, \
+            datetime TIMESTAMP NOT NULL, \
+            timezone VARCHAR(50) NOT NULL, \
+            phase VARCHAR(10), \
+            resistance FLOAT NOT NULL, \
+            samples INTEGER);")
+        self.connection.commit()
+
+    _timezone = None
+
+    @classmethod
+    def _tzname(cls):
+        """ Name of the local timezone, looked up once as it's stored with every row
+        """
+        if cls._timezone is None:
+            import tzlocal
+            zone = tzlocal.get_localzone()
+            # tzlocal 3+ returns zoneinfo timezones, which are named by key rather than zone
+            cls._timezone = getattr(zone, "zone", None) or getattr(zone, "key", None) or str(zone)
+        return cls._timezone
+
+    def _execute_and_commit(self, sql, values):
+        """ Execute a write and commit it, recording how long it took
+        """
+        with self._lock:
+            start = time.monotonic()
+            self.cursor.execute(sql, values)
+            self.connection.commit()
+            DB_COMMIT_LATENCY.observe(time.monotonic() - start)
+
     def add_entry(self, button, entry_dt, media_filename=None):
         """Add an entry into the db
         """
         if self.db_running:
             sql = "INSERT INTO entrytable(button, datetime, timezone, media_filename) \
                     VALUES (%s, %s, %s, %s)"
-            tzname = tzlocal.get_localzone().zone
-            self.cursor.execute(sql, (button, entry_dt, tzname, media_filename))
-            self.connection.commit()
+            tzname = self._tzname()
+            self._execute_and_commit(sql, (button, entry_dt, tzname, media_filename))
 
     def add_media_filename(self, entry_dt, media_filename):
         """ Add the media_filename to an existing entry
@@ -94,22 +162,55 @@ class DB:
             sql = "UPDATE entrytable \
                     SET media_filename = %s \
                     where datetime = %s"
-            self.cursor.execute(sql, (media_filename, entry_dt))
-            self.connection.commit()
+            self._execute_and_commit(sql, (media_filename, entry_dt))
 
-    def log_voltage(self, voltage):
-        """ Log the battery voltage to the BattVolt table
+    def log_voltage(self, voltage, min_voltage=None, max_voltage=None, stddev=None, samples=None):
+        """ Log the battery voltage to the BattVolt table, with the summary of the samples it is
+        the mean of
         """
         if self.db_running:
-            sql = "INSERT INTO BattVolt(datetime, timezone, voltage) \
-                    VALUES (%s, %s, %s)"
+            sql = "INSERT INTO BattVolt(datetime, timezone, voltage, min_voltage, max_voltage, \
+                    stddev, samples) VALUES (%s, %s, %s, %s, %s, %s, %s)"
             dt_now = datetime.datetime.now()
-            tzname = tzlocal.get_localzone().zone
-            self.cursor.execute(sql, (dt_now, tzname, voltage))
-            self.connection.commit()
+            tzname = self._tzname()
+            self._execute_and_commit(sql, (dt_now, tzname, voltage, min_voltage, max_voltage,
+                                           stddev, samples))
+
+    def voltage_history(self, hours):
+        """ Return the (datetime, voltage) rows logged in the last hours, oldest first
+        """
+        if not self.db_running:
+            return []
+        with self._lock:
+            self.cursor.execute("SELECT datetime, voltage FROM BattVolt \
+                WHERE datetime > %s ORDER BY datetime",
+                                (datetime.datetime.now() - datetime.timedelta(hours=hours),))
+            return self.cursor.fetchall()
+
+    def log_resistance(self, timestamp, phase, resistance, samples):
+        """ Log a battery internal resistance estimate to the BattResistance table
+        """
+        if self.db_running:
+            sql = "INSERT INTO BattResistance(datetime, timezone, phase, resistance, samples) \
+                    VALUES (%s, %s, %s, %s, %s)"
+            tzname = self._tzname()
+            self._execute_and_commit(sql, (datetime.datetime.fromtimestamp(timestamp), tzname,
+                                           phase, resistance, samples))
+
+    def resistance_history(self, limit):
+        """ Return the last limit resistance estimates, oldest first
+        """
+        if not self.db_running:
+            return []
+        with self._lock:
+            self.cursor.execute("SELECT resistance FROM (SELECT datetime, resistance \
+                FROM BattResistance ORDER BY datetime DESC LIMIT %s) AS recent ORDER BY datetime",
+                                (limit,))
+            return [row[0] for row in self.cursor.fetchall()]
 
     def cleanup(self):
         """ Cleanup db by closing connection
         """
-        if self.db_running:
-            self.connection.close()
+        with self._lock:
+            if self.db_running:
+                self.connection.close()
@@ -0,0 +1,524 @@
+""" Module to emulate the Arduino running GateSketch.ino on a pseudo-terminal.
+ArduinoInterface opens the emulator's end of the pty in place of the Arduino's serial device, so the
+whole serial path (handshake, button pin negotiation, voltage frames and their checksums, triggers,
+the radio key and hit detection) runs without the hardware. Replies can be delayed, jittered and
+corrupted, and the shunt and battery voltages come from a model of the motor driving the gate.
+
+To run the gate on any Linux machine start the emulator:
+    python emulator.py --link /tmp/ttyGATE
+set serial_port = /tmp/ttyGATE in conf.ini and start the gate with GPIOZERO_PIN_FACTORY=mock
+"""
+import argparse
+import collections
+import os
+import random
+import select
+import statistics
+import sys
+import threading
+import time
+import tty
+
+from config import Config as config
+import firmware
+from serial_analog import ArduinoInterface
+
+# ADC of the Arduino UNO, 10 bits against the 3.3V reference
+ADC_COUNTS = 1023
+ADC_REFERENCE = 3.3
+
+
+class MotorModel:
+    """ Gate driven by a DC motor, position is 0 closed to 1 open and currents are in amps.
+    The motor draws an inrush current that decays to the running current as it starts, and the
+    stall current once the gate reaches the end of its travel or an obstruction.
+    The default currents put the shunt voltage under the configured threshold while running and
+    over it when stalled.
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, travel_time=None, run_current=None, stall_current=None,
+                 inrush_current=None, inrush_time=0.2, position=0.0):
+        threshold_current = config.SHUNT_THRESHOLD / config.SHUNT_RESISTANCE
+        self.travel_time = travel_time or config.EXPECTED_TIME_TO_OPEN_CLOSE
+        self.run_current = run_current if run_current is not None else 0.5 * threshold_current
+        self.stall_current = stall_current if stall_current is not None else \
+            3 * threshold_current
+        self.inrush_current = inrush_current if inrush_current is not None else \
+            5 * threshold_current
+        self.inrush_time = inrush_time
+        self.position = position
+        # "open", "close" or None when the motor is off
+        self.direction = None
+        self.current = 0.0
+        self._run_time = 0.0
+        # (position, direction) of something the gate hits when moving in direction past position
+        self.obstruction = None
+
+    def start(self, direction):
+        """ Drive the motor in direction, "open" or "close"
+        """
+        if direction != self.direction:
+            self.direction = direction
+            self._run_time = 0.0
+
+    def stop(self):
+        """ Turn the motor off
+        """
+        self.direction = None
+        self.current = 0.0
+
+    def obstruct(self, position, direction="close"):
+        """ Put something in the way of the gate moving in direction past position
+        """
+        self.obstruction = (position, direction)
+
+    def clear(self):
+        """ Remove the obstruction
+        """
+        self.obstruction = None
+
+    def _limit(self):
+        """ Furthest position the gate can move to in its current direction
+        """
+        limit = 1.0 if self.direction == "open" else 0.0
+        if self.obstruction is not None and self.obstruction[1] == self.direction:
+            obstruction = self.obstruction[0]
+            if self.direction == "open" and self.position <= obstruction:
+                limit = min(limit, obstruction)
+            elif self.direction == "close" and self.position >= obstruction:
+                limit = max(limit, obstruction)
+        return limit
+
+    def step(self, elapsed):
+        """ Advance the model by elapsed seconds
+        """
+        if self.direction is None:
+            self.current = 0.0
+            return
+        self._run_time += elapsed
+        limit = self._limit()
+        travel = elapsed / self.travel_time
+        if self.direction == "open":
+            self.position = min(limit, self.position + travel)
+        else:
+            self.position = max(limit, self.position - travel)
+        self.current = self.stall_current if self.position == limit else self.run_current
+        if self._run_time < self.inrush_time:
+            decay = self._run_time / self.inrush_time
+            inrush = self.inrush_current + (self.run_current - self.inrush_current) * decay
+            self.current = max(self.current, inrush)
+
+
+def pin_direction(gate):
+    """ Function returning the direction the gate's motor pins are driving the motor in
+    """
+    def direction():
+        if gate.motor_pin1.value:
+            return "open"
+        return "close" if gate.motor_pin0.value else None
+    return direction
+
+
+def drive_mock_shunt(clock, motor, motor_direction):
+    """ Run the motor model on a virtual clock in place of the emulator, for ArduinoInterface in
+    mock mode. Whenever the clock moves the motor follows motor_direction() and its current is put
+    on the mock shunt voltage. Returns the clock listener
+    """
+    last = [clock.monotonic()]
+
+    def step():
+        now = clock.monotonic()
+        direction = motor_direction()
+        if direction is None:
+            motor.stop()
+        else:
+            motor.start(direction)
+        motor.step(now - last[0])
+        last[0] = now
+        ArduinoInterface.mock_voltages[config.SHUNT_PIN] = \
+            motor.current * config.SHUNT_RESISTANCE
+    clock.add_listener(step)
+    return step
+
+
+class ArduinoEmulator:
+    """ Arduino running GateSketch.ino on the other end of a pseudo-terminal.
+    latency: seconds before each reply is sent, plus up to jitter seconds at random
+    corruption: chance of each line sent having a bit flipped
+    motor_direction: function returning "open", "close" or None from the gate's motor pins, without
+    it the motor is started by the hit detection command ('T') and stopped by 'X', moving away from
+    the end it is at or the opposite way to its last run
+    running: start past the handshake, like an Arduino that kept running while the gate restarted
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    # Loop period of the sketch, also the resolution of the motor model and the reply times
+    TICK = 0.002
+    # Conversions per second of each analog pin, the free running ADC is shared by all 6 pins
+    SAMPLE_RATE = 1600
+    HANDSHAKE_INTERVAL = 0.2
+    # Consecutive samples over the threshold for a hit
+    HIT_SAMPLES = 3
+    MAX_OVERSAMPLING = 32
+    LINE_END = b"\r\n"
+
+    def __init__(self, link=None, latency=0.0, jitter=0.0, corruption=0.0, motor=None,
+                 motor_direction=None, firmware_hash=None, noise=0.001, battery_emf=26.0,
+                 battery_resistance=0.05, number_of_inputs=6, decimals=4, running=False,
+                 seed=None):
+        self.link = link
+        self.latency = latency
+        self.jitter = jitter
+        self.corruption = corruption
+        self.motor = motor if motor is not None else MotorModel()
+        self.motor_direction = motor_direction
+        self.firmware_hash = firmware_hash or firmware.sketch_hash() or "unknown"
+        # Standard deviation of the ADC noise (volts)
+        self.noise = noise
+        self.battery_emf = battery_emf
+        self.battery_resistance = battery_resistance
+        self.number_of_inputs = number_of_inputs
+        self.decimals = decimals
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._input = b""
+        self._output = collections.deque()
+        self._last_due = 0.0
+        self._last_run = None
+        self.frames_sent = 0
+        self.lines_corrupted = 0
+        self.radio_key = None
+        self._key_bytes = None
+        self.phase = None
+        self.button_pins = []
+        self.oversampling = 21
+        self._next_handshake = 0.0
+        self._hit = None
+        self.reset(running)
+
+    def reset(self, running=False):
+        """ Restart the sketch, like the Arduino being reset
+        """
+        with self._lock:
+            self.phase = "running" if running else "handshake"
+            self.button_pins = []
+            self.oversampling = 21
+            self._next_handshake = 0.0
+            self._input = b""
+            self._disarm()
+            if self.motor_direction is None:
+                self.motor.stop()
+
+    @property
+    def device(self):
+        """ The pty device the emulator answers on
+        """
+        return os.ttyname(self._slave)
+
+    @property
+    def port(self):
+        """ Path of the serial device to open
+        """
+        return self.link or self.device
+
+    def start(self):
+        """ Open the pty, link it and start the sketch loop in a daemon thread
+        """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        if self.link is not None:
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(self.device, self.link)
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the sketch and close the pty
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        for descriptor in (self._master, self._slave):
+            if descriptor is not None:
+                os.close(descriptor)
+        self._master = self._slave = None
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def press(self, pin):
+        """ Press the button on pin
+        """
+        with self._lock:
+            self._send("O", str(pin))
+
+    def request_radio_key(self):
+        """ Ask for the 433MHz radio key like the radio receiver does, the 8 characters sent back
+        are kept in radio_key
+        """
+        with self._lock:
+            self._key_bytes = b""
+            self._send("R")
+
+    def analog_voltage(self, pin):
+        """ Voltage on the analog pin without noise
+        """
+        if pin == config.SHUNT_PIN:
+            return self.motor.current * config.SHUNT_RESISTANCE
+        if pin == config.BATTERY_VOLTAGE_PIN:
+            return (self.battery_emf - self.motor.current * self.battery_resistance) / \
+                config.BATTERY_VOLTAGE_CORRECTION_FACTOR
+        return 0.0
+
+    def _sample(self, pin):
+        """ One ADC conversion of the pin in counts
+        """
+        voltage = self._random.gauss(self.analog_voltage(pin), self.noise)
+        return min(ADC_COUNTS, max(0, round(voltage * ADC_COUNTS / ADC_REFERENCE)))
+
+    def _loop(self):
+        last = time.monotonic()
+        while self._running:
+            # Wake up for the next reply that is due, so replies aren't held until the next tick
+            timeout = self.TICK
+            if self._output:
+                timeout = min(timeout, max(0, self._output[0][0] - time.monotonic()))
+            readable, _, _ = select.select([self._master], [], [], timeout)
+            data = b""
+            if readable:
+                try:
+                    data = os.read(self._master, 1024)
+                except OSError:
+                    pass
+            now = time.monotonic()
+            with self._lock:
+                self._input += data
+                if self.motor_direction is not None:
+                    direction = self.motor_direction()
+                    if direction is None:
+                        self.motor.stop()
+                    else:
+                        self.motor.start(direction)
+                self.motor.step(now - last)
+                self._step(now, now - last)
+                self._write(time.monotonic())
+            last = now
+
+    def _step(self, now, elapsed):
+        """ One pass of the sketch's loop
+        """
+        if self.phase == "handshake":
+            if self._input:
+                # serialHandshake and getButtonPins flush whatever was sent
+                self._input = b""
+                self.phase = "buttons"
+                self._send("B", "Getting button pins")
+            elif now >= self._next_handshake:
+                self._send("A", self.firmware_hash)
+                self._next_handshake = now + self.HANDSHAKE_INTERVAL
+            return
+        if self.phase == "buttons":
+            self._read_button_pins()
+        if self.phase == "running":
+            self._read_commands(now)
+            self._check_for_hit(now, elapsed)
+
+    def _read_button_pins(self):
+        while self._input and self.phase == "buttons":
+            char, self._input = self._input[:1], self._input[1:]
+            if char == b"B":
+                self.phase = "running"
+                self._send("Got all pins", *["Initializing input, digital pin number: {}".format(
+                    pin) for pin in self.button_pins])
+            elif b"1" <= char <= b"9" and len(self.button_pins) < 10:
+                self.button_pins.append(int(char))
+                self._send("Got pin: {}".format(int(char)))
+
+    def _read_commands(self, now):
+        while self._input:
+            if self._key_bytes is not None:
+                # The RPi answers 'R' with the key, or 10 'x' if it doesn't have a valid one
+                self._key_bytes += self._input[:1]
+                self._input = self._input[1:]
+                if len(self._key_bytes) == 8:
+                    self.radio_key = self._key_bytes.decode("ascii", errors="replace")
+                    self._key_bytes = None
+                continue
+            command = self._input[:1]
+            # Commands with arguments wait until they are complete, the servo position is a byte
+            if command == b"S":
+                if len(self._input) < 2:
+                    return
+                arguments, self._input = [str(self._input[1])], self._input[2:]
+            elif command in (b"T", b"D"):
+                end = self._input.find(b"\n")
+                if end < 0:
+                    return
+                arguments = self._input[1:end].decode("ascii", errors="replace").split()
+                self._input = self._input[end + 1:]
+            else:
+                arguments, self._input = [], self._input[1:]
+            self._command(command, arguments, now)
+
+    def _command(self, command, arguments, now):
+        if command == b"V":
+            self._send_voltages()
+        elif command == b"F":
+            self._send("F", self.firmware_hash)
+        elif command == b"T":
+            try:
+                self._arm(int(arguments[0]), float(arguments[1]), int(arguments[2]) / 1000, now)
+            except (IndexError, ValueError):
+                self._disarm()
+        elif command == b"X":
+            self._disarm()
+            if self.motor_direction is None:
+                self.motor.stop()
+        elif command == b"D":
+            try:
+                self.oversampling = min(self.MAX_OVERSAMPLING, max(1, int(arguments[0])))
+            except (IndexError, ValueError):
+                self.oversampling = 1
+        elif command == b"S":
+            self._send("Sending servo to position: {}".format(arguments[0]))
+
+    def _send_voltages(self):
+        """ Answer 'V' with the median of the most recent samples of each pin and the checksum
+        """
+        voltages = []
+        for pin in range(self.number_of_inputs):
+            counts = statistics.median_low(self._sample(pin) for _ in range(self.oversampling))
+            voltages.append(round(counts * ADC_REFERENCE / ADC_COUNTS, self.decimals))
+        self.frames_sent += 1
+        self._send("V", *["{:.{}f}".format(value, self.decimals)
+                          for value in voltages + [sum(voltages)]])
+
+    def _arm(self, pin, threshold, blanking, now):
+        self._hit = {"pin": pin, "counts": int(threshold * ADC_COUNTS / ADC_REFERENCE),
+                     "armed_at": now, "blanking": blanking, "watching": False, "over": 0}
+        if self.motor_direction is None:
+            self.motor.start(self._inferred_direction())
+
+    def _disarm(self):
+        self._hit = None
+
+    def _inferred_direction(self):
+        """ Direction of a motor run started by 'T' when the motor pins can't be seen
+        """
+        if self.motor.position >= 1.0:
+            direction = "close"
+        elif self.motor.position <= 0.0:
+            direction = "open"
+        else:
+            direction = "open" if self._last_run == "close" else "close"
+        self._last_run = direction
+        return direction
+
+    def _check_for_hit(self, now, elapsed):
+        hit = self._hit
+        if hit is None:
+            return
+        if not hit["watching"]:
+            # The start up spike is ignored
+            if now - hit["armed_at"] < hit["blanking"]:
+                return
+            hit["watching"] = True
+        for _ in range(max(1, round(elapsed * self.SAMPLE_RATE))):
+            value = self._sample(hit["pin"])
+            hit["over"] = hit["over"] + 1 if value > hit["counts"] else 0
+            if hit["over"] >= self.HIT_SAMPLES:
+                # Only one hit per 'T'
+                self._hit = None
+                self._send("H", "{:.{}f}".format(value * ADC_REFERENCE / ADC_COUNTS,
+                                                 self.decimals))
+                return
+
+    def _send(self, *lines):
+        """ Queue lines to be sent after the latency, replies are never reordered
+        """
+        now = time.monotonic()
+        due = max(self._last_due, now + self.latency + self._random.uniform(0, self.jitter))
+        self._last_due = due
+        data = b""
+        for line in lines:
+            line = str(line).encode()
+            if line and self._random.random() < self.corruption:
+                # Flip a bit of a character, the line end is left alone
+                index = self._random.randrange(len(line))
+                line = line[:index] + bytes([line[index] ^ (1 << self._random.randrange(8))]) \
+                    + line[index + 1:]
+                self.lines_corrupted += 1
+            data += line + self.LINE_END
+        self._output.append((due, data))
+
+    def _write(self, now):
+        while self._output and self._output[0][0] <= now:
+            _, data = self._output.popleft()
+            try:
+                os.write(self._master, data)
+            except BlockingIOError:
+                # Nothing is reading the port and its buffer is full, like a USB serial adapter
+                # the data is lost
+                pass
+            except OSError:
+                return
+
+
+def main():
+    """ Run the emulator until interrupted, reading commands for it from stdin
+    """
+    parser = argparse.ArgumentParser(description="Emulate the gate's Arduino on a pty")
+    parser.add_argument("--link", default="/tmp/ttyGATE", help="symlink to the emulated port")
+    parser.add_argument("--latency", type=float, default=0.002, help="reply latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.001, help="reply jitter (s)")
+    parser.add_argument("--corruption", type=float, default=0.0,
+                        help="chance of each line being corrupted")
+    parser.add_argument("--travel-time", type=float, default=None,
+                        help="time for the gate to open or close (s)")
+    parser.add_argument("--running", action="store_true",
+                        help="start past the handshake, like an Arduino that was already running")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    emulator = ArduinoEmulator(args.link, args.latency, args.jitter, args.corruption,
+                               MotorModel(args.travel_time), running=args.running, seed=args.seed)
+    with emulator:
+        print("Emulating the Arduino on {} -> {}".format(args.link, emulator.device))
+        print("Commands: press <pin>, obstruct <position> [open|close], clear, reset, radio, "
+              "status")
+        for line in sys.stdin:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == "press" and len(words) == 2:
+                emulator.press(words[1])
+            elif words[0] == "obstruct" and len(words) in (2, 3):
+                emulator.motor.obstruct(float(words[1]), *words[2:])
+            elif words[0] == "clear":
+                emulator.motor.clear()
+            elif words[0] == "reset":
+                emulator.reset()
+            elif words[0] == "radio":
+                emulator.request_radio_key()
+            elif words[0] == "status":
+                print("phase {}, buttons {}, position {:.3f}, motor {} {:.3f}A, "
+                      "radio key {}".format(
+                          emulator.phase, emulator.button_pins, emulator.motor.position,
+                          emulator.motor.direction, emulator.motor.current, emulator.radio_key))
+            else:
+                print("Unknown command: {}".format(line.strip()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+""" Module for the status event bus.
+Gate mode and state changes, entries, battery readings and alerts are published as events and
+fanned out to every subscriber. Each subscriber has its own bounded buffer, so a slow subscriber
+only loses its own oldest events and publishing never blocks the gate thread.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+
+from metrics import Metrics
+
+logger = logging.getLogger("root")
+
+DROPPED_EVENTS = Metrics.counter(
+    "events_dropped", "Events discarded because a subscriber was not keeping up")
+
+
+class Event:
+    """ A published event, serialised once when it is published and shared by all subscribers
+    """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ("event_id", "event_type", "timestamp", "data", "encoded")
+
+    def __init__(self, event_id, event_type, data):
+        self.event_id = event_id
+        self.event_type = event_type
+        self.timestamp = time.time()
+        self.data = data
+        self.encoded = json.dumps({"id": event_id, "type": event_type,
+                                   "time": self.timestamp, "data": data}, default=str)
+
+    def to_sse(self):
+        """ Format the event for a Server-Sent Events stream
+        """
+        return "id: {}\nevent: {}\ndata: {}\n\n".format(
+            self.event_id, self.event_type, self.encoded).encode()
+
+
+class Subscription:
+    """ Bounded buffer of events for a single subscriber
+    """
+    def __init__(self, size):
+        self._events = collections.deque(maxlen=size)
+        self._condition = threading.Condition()
+        self.dropped = 0
+
+    def push(self, event):
+        """ Add an event, discarding the oldest one if the buffer is full
+        """
+        with self._condition:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+                DROPPED_EVENTS.inc()
+            self._events.append(event)
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """ Wait for events and return all that are buffered, an empty list on timeout
+        """
+        with self._condition:
+            if not self._events:
+                self._condition.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+        return events
+
+
+class EventBus:
+    """ Publishes events to all subscribers.
+    Listeners are called synchronously by the publishing thread so they must be quick, they are
+    intended for keeping in memory state up to date. A listener that raises is logged and skipped.
+    """
+    subscribers = set()
+    listeners = []
+    _event_count = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def publish(cls, event_type, **data):
+        """ Publish an event to every subscriber
+        """
+        with cls._lock:
+            cls._event_count += 1
+            event_id = cls._event_count
+            subscribers = list(cls.subscribers)
+        event = Event(event_id, event_type, data)
+        for listener in cls.listeners:
+            try:
+                listener(event)
+            except Exception as err:  # pylint: disable=broad-except
+                # Failures on alert events are not warnings, which would publish more alerts
+                logger.log(logging.DEBUG if event_type == "alert" else logging.WARNING,
+                           "Event listener %s failed on a %s event: %s",
+                           getattr(listener, "__qualname__", listener), event_type, err)
+        for subscription in subscribers:
+            subscription.push(event)
+        return event
+
+    @classmethod
+    def add_listener(cls, callback):
+        """ Call callback with every published event
+        """
+        if callback not in cls.listeners:
+            cls.listeners.append(callback)
+
+    @classmethod
+    def remove_listener(cls, callback):
+        """ Stop calling callback with published events
+        """
+        if callback in cls.listeners:
+            cls.listeners.remove(callback)
+
+    @classmethod
+    def subscribe(cls, size=100):
+        """ Create a new subscription
+        """
+        subscription = Subscription(size)
+        with cls._lock:
+            cls.subscribers.add(subscription)
+        return subscription
+
+    @classmethod
+    def unsubscribe(cls, subscription):
+        """ Remove a subscription
+        """
+        with cls._lock:
+            cls.subscribers.discard(subscription)
+
+    @classmethod
+    def sse_stream(cls, keepalive=15):
+        """ Generator of Server-Sent Events for a new subscriber.
+        A comment is sent when there are no events so disconnected clients are noticed.
+        """
+        subscription = cls.subscribe()
+        try:
+            yield b"retry: 2000\n\n"
+            while True:
+                events = subscription.get(timeout=keepalive)
+                if not events:
+                    yield b": keepalive\n\n"
+                for event in events:
+                    yield event.to_sse()
+        finally:
+            cls.unsubscribe(subscription)
+
+
+class AlertEventHandler(logging.Handler):
+    """ Logging handler that publishes alert records as events
+    """
+    def emit(self, record):
+        """ Publish the record as an alert event
+        """
+        try:
+            EventBus.publish("alert", level=record.levelname, message=record.getMessage())
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
@@ -0,0 +1,52 @@
+""" Module to keep the Arduino running the bundled sketch.
+The sketch reports the hash it was compiled with in the handshake. It is only uploaded when that
+differs from the hash of the bundled sketch, and upload.sh caches builds by hash so an unchanged
+sketch is never compiled twice.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+
+logger = logging.getLogger("root")
+
+ARDUINO_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "arduino_src")
+SKETCH = os.path.join(ARDUINO_SRC, "GateSketch", "GateSketch.ino")
+UPLOAD_SCRIPT = os.path.join(ARDUINO_SRC, "upload.sh")
+# Compiling on a Pi can take several minutes when the build isn't cached
+UPLOAD_TIMEOUT = 900
+
+
+def sketch_hash(path=SKETCH):
+    """ Hash of the bundled sketch (as computed by upload.sh), None if it isn't there
+    """
+    try:
+        with open(path, "rb") as sketch:
+            return hashlib.sha256(sketch.read()).hexdigest()[:16]
+    except FileNotFoundError:
+        return None
+
+
+def can_flash():
+    """ Whether the tools to upload the sketch are installed
+    """
+    return os.path.exists(UPLOAD_SCRIPT) and shutil.which("arduino-cli") is not None
+
+
+def flash(port):
+    """ Upload the bundled sketch to the Arduino on port, compiling it if there is no cached
+    build. Returns True if it was uploaded
+    """
+    try:
+        result = subprocess.run(["bash", UPLOAD_SCRIPT, port], capture_output=True,
+                                timeout=UPLOAD_TIMEOUT, check=False)
+    except subprocess.TimeoutExpired:
+        logger.error("Uploading the Arduino sketch timed out")
+        return False
+    output = result.stdout.decode(errors="replace") + result.stderr.decode(errors="replace")
+    logger.debug("upload.sh: %s", output)
+    if result.returncode != 0:
+        logger.error("Uploading the Arduino sketch failed: %s", output.strip()[-500:])
+        return False
+    return True
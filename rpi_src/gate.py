@@ -1,34 +1,101 @@
 """Smart gate class module
 """
 import logging
-import time
 
 import gpiozero
 
+from battery_health import BatteryHealth, LoadFit
+from clock import SYSTEM_CLOCK
 from config import Config as config
-from serial_analog import ArduinoInterface
+from events import EventBus
+from metrics import Metrics
+from serial_analog import ArduinoInterface, ArduinoInterfaceError
+from state_store import StateStore, atomic_write
+from tracing import Tracer
 
 logger = logging.getLogger("root")
 
+SHUNT_SAMPLES = Metrics.counter(
+    "gate_shunt_samples", "Shunt voltage samples read during motor runs")
+SHUNT_SAMPLE_RATE = Metrics.gauge(
+    "gate_shunt_samples_per_second", "Shunt sampling rate achieved during the last motor run")
+ARDUINO_HITS = Metrics.counter(
+    "gate_arduino_hits", "Motor runs stopped by the Arduino seeing the shunt threshold crossed")
+HIT_CROSS_CHECK_MISSES = Metrics.counter(
+    "gate_hit_cross_check_misses",
+    "Threshold crossings the gate's own shunt readings saw before the Arduino reported them")
+SHUNT_STALLS = Metrics.histogram(
+    "gate_shunt_stall_seconds", "Time shunt readings were missing for during a motor run")
+
 
 class Gate:
     """Gate instance
     This keeps track of all the gate methods (functions) and the related status/vaiables
     """
+    # pylint: disable=too-many-instance-attributes
+
+    # States the gate can be left in, these are restored on restart
+    RESTING_STATES = ("closed", "opened")
+    # The estimated position drifts, so the hit window of a partial close is widened by a margin
+    # and never shortened below a floor fraction of the full window
+    PARTIAL_CLOSE_MARGIN = 0.25
+    PARTIAL_CLOSE_FLOOR = 0.5
 
-    def __init__(self, queue):
-        self.current_state = "unknown"
+    def __init__(self, queue, state_store=None, clock=None):
+        # Everything the gate times runs on this clock, a virtual clock in tests and simulations
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.state_store = state_store if state_store is not None else StateStore()
+        saved = self.state_store.state
+        self.position = saved["position"]
+        # Command of the gate cycle in progress, cleared when the cycle completes
+        self.in_flight = saved["in_flight"]
+        self._current_state = None
+        if saved["state"] in self.RESTING_STATES and self.in_flight is None:
+            self.current_state = saved["state"]
+        else:
+            self.current_state = "unknown"
         self.current_mode = self._read_mode()
         self.job_q = queue
         self.setup_pins()
         self.shunt_pin = config.SHUNT_PIN
+        self._motor_start_time = None
+        self._motor_phase = None
+        self._shunt_samples = 0
+        self._load_fit = None
+        self._run_start_position = None
+        self._run_time = None
+        self._motor_stop_time = None
+        # Set when a shunt read fails during a motor run, the end of travel is then timed
+        self.degraded = False
+        # Shunt voltage the Arduino reported crossing the threshold at during this motor run
+        self._arduino_hit = None
+        self._stall_start = None
+        self._stall_failures = 0
+
+    @property
+    def current_state(self):
+        """Current state of the gate, every change is published on the event bus
+        """
+        return self._current_state
+
+    @current_state.setter
+    def current_state(self, state):
+        if state != self._current_state:
+            self._current_state = state
+            self._save_state()
+            EventBus.publish("state", state=state)
+
+    def _save_state(self):
+        """Save the state, position and command in progress so they survive a restart
+        """
+        self.state_store.update(state=self._current_state, position=self.position,
+                                in_flight=self.in_flight)
 
     @staticmethod
     def _write_mode(mode):
         """Save current mode on mode change
         """
-        with open(config.SAVED_MODE_FILE, "w") as saved_mode:
-            saved_mode.write(mode)
+        atomic_write(config.SAVED_MODE_FILE, mode)
 
     @staticmethod
     def _read_mode():
@@ -53,14 +120,43 @@ class Gate:
         if new_mode in config.MODES:
             self.current_mode = new_mode
             self._write_mode(new_mode)
+            EventBus.publish("mode", mode=new_mode)
             logger.info("Changed gate mode to: %s", self.current_mode)
         else:
             logger.warning("Invalid mode_change attempted: %s", new_mode)
 
+    def resume(self):
+        """Finish the gate cycle that was in progress when the gate last stopped running.
+        In the lock modes the mode loop moves the gate into position instead
+        """
+        if self.in_flight is None:
+            logger.info("Resuming with the gate %s", self.current_state)
+            return
+        if not self.current_mode.startswith("normal"):
+            return
+        logger.warning("Resuming the interrupted %s, estimated position: %s",
+                       self.in_flight, self.position)
+        if self.in_flight == "open":
+            # Opening, open or holding, finish the cycle by opening, holding then closing
+            self.job_q.validate_and_put("open")
+        else:
+            self.close()
+
+    def _reached_end(self, phase):
+        """Record that the motor run ended at the end of travel
+        """
+        self.position = 1.0 if phase == "open" else 0.0
+        self.state_store.count("opened" if phase == "open" else "closed")
+        # Only a run across the whole travel gives the travel time, a timed run doesn't measure it
+        if self._run_start_position == 1.0 - self.position and self._run_time \
+                and not self.degraded:
+            self.state_store.calibrate(phase, self._run_time)
+
     def _open(self):
         """Open the gate
         """
         self.current_state = "opening"
+        self._motor_started("open")
         logger.debug("opening gate motor")
         self.motor_pin0.off()
         self.motor_pin1.on()
@@ -70,27 +166,40 @@ class Gate:
         When called it should open the gate and handle when the task is complete,
         or an obstruction has been hit
         """
-        start_time = time.monotonic()
+        start_time = self.clock.monotonic()
         security_time = start_time + config.MAX_TIME_TO_OPEN_CLOSE
+        if self.in_flight != "open":
+            self.in_flight = "open"
+            self._save_state()
+        if not ArduinoInterface.link_up:
+            self._link_error("open", "the Arduino link is down")
+            return
         self._open()
-        time.sleep(config.SHUNT_READ_DELAY)
+        self.clock.sleep(config.SHUNT_READ_DELAY)
         while True:
             # Check shunt voltage
-            shunt_voltage = ArduinoInterface.get_analog_voltages(self.shunt_pin)
-            if shunt_voltage > config.SHUNT_THRESHOLD:
-                logger.debug('Shunt threshold exceeded: %s', shunt_voltage)
+            shunt_voltage = self._checked_shunt()
+            if shunt_voltage is None and self._readings_lost():
+                return
+            if self._end_reached(shunt_voltage, start_time):
                 self._stop()
+                self._reached_end("open")
                 self.current_state = "opened"
                 return
 
             # Check security timer
-            if time.monotonic() > security_time:
+            if self.clock.monotonic() > security_time:
                 logger.critical("Open security timer has elapsed")
-                self.current_state = "Open time error"
+                EventBus.publish("timeout", phase="open",
+                                 elapsed=self.clock.monotonic() - start_time)
+                self.state_store.count("timeouts")
+                self.in_flight = None
                 self._stop()
+                self.current_state = "Open time error"
                 return
             # This will allow for a close request to jump out of opening & skip holding
             job = self.job_q.get_nonblocking()
+            self.clock.poll()
             if job == "close":
                 self._stop()
                 self.current_state = "holding"
@@ -101,13 +210,14 @@ class Gate:
         When called it should hold the gate open for a set duration
         """
         self.current_state = "holding"
-        start_time = time.monotonic()
-        while time.monotonic() < start_time + config.HOLD_OPEN_TIME:
-            time.sleep(0.25)
+        Tracer.mark("hold")
+        start_time = self.clock.monotonic()
+        while self.clock.monotonic() < start_time + config.HOLD_OPEN_TIME:
+            self.clock.sleep(0.25)
             job = self.job_q.get_nonblocking()
             # This will allow a new open request to extend the hold time by reseting it
             if job == "open":
-                start_time = time.monotonic()
+                start_time = self.clock.monotonic()
             # This will allow a close request to skip the rest of the holding time
             if job == "close":
                 return
@@ -116,6 +226,7 @@ class Gate:
         """Close the gate
         """
         self.current_state = "closing"
+        self._motor_started("close")
         logger.debug("closing gate motor")
         self.motor_pin0.on()
         self.motor_pin1.off()
@@ -125,38 +236,60 @@ class Gate:
         When called it should close the gate and handle when the task is complete,
         or an obstruction has been hit
         """
+        self.in_flight = "close"
         self.current_state = "closing"
-        start_time = time.monotonic()
+        start_time = self.clock.monotonic()
         security_time = start_time + config.MAX_TIME_TO_OPEN_CLOSE
-        hit_time = start_time + config.MIN_TIME_TO_OPEN_CLOSE
+        # A gate that is only part way open reaches the end sooner
+        fraction = 1.0 if self.position is None else min(1.0, max(
+            self.position + self.PARTIAL_CLOSE_MARGIN, self.PARTIAL_CLOSE_FLOOR))
+        hit_time = start_time + config.MIN_TIME_TO_OPEN_CLOSE * fraction
+        if not ArduinoInterface.link_up:
+            self._link_error("close", "the Arduino link is down")
+            return
         self._close()
-        time.sleep(config.SHUNT_READ_DELAY)
+        self.clock.sleep(config.SHUNT_READ_DELAY)
         while True:
             # Check shunt voltage
-            shunt_voltage = ArduinoInterface.get_analog_voltages(self.shunt_pin)
-            if shunt_voltage > config.SHUNT_THRESHOLD:
-                logger.debug('Shunt threshold exceeded: %s', shunt_voltage)
+            shunt_voltage = self._checked_shunt()
+            if shunt_voltage is None and self._readings_lost():
+                return
+            end = self._end_reached(shunt_voltage, start_time)
+            if end:
                 self._stop()
-                # Check if gate hit object or is closed
-                if time.monotonic() < hit_time:
+                # Check if gate hit object or is closed, a timed run can't tell
+                if end != "timed" and self.clock.monotonic() < hit_time:
                     # It can be assumed that the gate has hit something closing,
                     logger.warning("Gate has hit something whilst closing")
+                    EventBus.publish("hit", phase="close",
+                                     elapsed=self.clock.monotonic() - start_time)
+                    self.state_store.count("hits")
+                    self.in_flight = "open"
+                    self._save_state()
                     logger.debug("Reopening gate due to hit")
                     self.job_q.validate_and_put('open')
                     return
+                self._reached_end("close")
+                self.in_flight = None
                 self.current_state = "closed"
                 logger.debug("Gate closed")
                 return
             # Check security timer
-            if time.monotonic() > security_time:
+            if self.clock.monotonic() > security_time:
                 logger.critical("Close security timer has elapsed")
-                self.current_state = "Close time error"
+                EventBus.publish("timeout", phase="close",
+                                 elapsed=self.clock.monotonic() - start_time)
+                self.state_store.count("timeouts")
+                self.in_flight = None
                 self._stop()
+                self.current_state = "Close time error"
                 return
             # Allow for open request to jump out of closing
             job = self.job_q.get_nonblocking()
+            self.clock.poll()
             if job == "open":
                 self._stop()
+                self.in_flight = "open"
                 self.current_state = "stopped"
                 self.job_q.validate_and_put('open')
                 return
@@ -167,6 +300,183 @@ class Gate:
         logger.debug("stopping gate motor")
         self.motor_pin0.off()
         self.motor_pin1.off()
+        self._motor_stopped()
+
+    def _checked_shunt(self):
+        """Read the shunt voltage, None if the read failed. The first failure of a motor run
+        switches to degraded mode and each run of failures is reported as a stall
+        """
+        try:
+            shunt_voltage = self._read_shunt()
+        except ArduinoInterfaceError as err:
+            if self._stall_start is None:
+                self._stall_start = self.clock.monotonic()
+                self._stall_failures = 0
+            self._stall_failures += 1
+            if not self.degraded:
+                self.degraded = True
+                logger.warning("Shunt read failed, timing the gate instead: %s", err)
+            return None
+        self._end_stall()
+        return shunt_voltage
+
+    def _end_stall(self):
+        """Report the stall in progress, if any
+        """
+        if self._stall_start is None:
+            return
+        duration = self.clock.monotonic() - self._stall_start
+        self._stall_start = None
+        SHUNT_STALLS.observe(duration)
+        logger.warning("No shunt readings for %.3fs (%d failed reads) while the motor was running",
+                       duration, self._stall_failures)
+        EventBus.publish("stall", phase=self._motor_phase, duration=round(duration, 3),
+                         failures=self._stall_failures)
+
+    def _readings_lost(self):
+        """Stop the gate if the link is down or the shunt readings have been missing for too long,
+        returns True if it was stopped
+        """
+        if ArduinoInterface.link_up:
+            stalled_for = self.clock.monotonic() - self._stall_start
+            if stalled_for <= config.SHUNT_STALE_TIME:
+                return False
+            reason = "no shunt readings for {:.2f}s".format(stalled_for)
+        else:
+            reason = "the Arduino link is down"
+        self._link_error(self._motor_phase, reason)
+        return True
+
+    def arduino_hit(self, voltage):
+        """Called from the serial thread when the Arduino sees the shunt voltage cross the
+        threshold. The motor is stopped straight away, the gate thread handles the rest
+        """
+        # Read once, the gate thread clears it when the motor stops
+        start_time = self._motor_start_time
+        if start_time is None:
+            return
+        if self.clock.monotonic() - start_time < config.SHUNT_READ_DELAY:
+            # The Arduino ignores this run's start up spike, so the hit is left over from the last
+            # run, sent before it was disarmed
+            logger.debug("Ignoring a hit from the previous motor run")
+            return
+        self.motor_pin0.off()
+        self.motor_pin1.off()
+        self._arduino_hit = voltage
+        ARDUINO_HITS.inc()
+        Tracer.mark("{}:arduino_hit".format(self._motor_phase))
+
+    def _end_reached(self, shunt_voltage, start_time):
+        """Why the motor should stop: "arduino" or "threshold" if the Arduino or the shunt reading
+        crossed the threshold, "timed" if in degraded mode the gate has run for the expected time
+        to travel from where it started, otherwise None
+        """
+        if self._arduino_hit is not None:
+            logger.debug('Arduino saw the shunt threshold exceeded: %s', self._arduino_hit)
+            return "arduino"
+        if shunt_voltage is not None and shunt_voltage > config.SHUNT_THRESHOLD:
+            logger.debug('Shunt threshold exceeded: %s', shunt_voltage)
+            Tracer.mark("{}:threshold_crossed".format(self._motor_phase))
+            # Cross check, the Arduino should have reported it first
+            HIT_CROSS_CHECK_MISSES.inc()
+            return "threshold"
+        if not self.degraded:
+            return None
+        if self._run_start_position is None:
+            remaining = 1.0
+        elif self._motor_phase == "open":
+            remaining = 1.0 - self._run_start_position
+        else:
+            remaining = self._run_start_position
+        if self.clock.monotonic() < start_time + config.EXPECTED_TIME_TO_OPEN_CLOSE * remaining:
+            return None
+        logger.warning("Assuming the gate has finished %s after the expected time",
+                       "opening" if self._motor_phase == "open" else "closing")
+        return "timed"
+
+    def _link_error(self, phase, reason):
+        """Stop the gate where it is when the shunt can't be read, the cycle is finished once
+        the link is back
+        """
+        logger.critical("Stopping the gate while %s, no shunt readings: %s",
+                        "opening" if phase == "open" else "closing", reason)
+        self._stop()
+        self.current_state = "{} link error".format(phase.capitalize())
+
+    def _motor_started(self, phase):
+        """Reset the shunt sample count for a new motor run
+        """
+        idle = self.motor_idle_time()
+        self._motor_start_time = self.clock.monotonic()
+        self._motor_phase = phase
+        self._run_start_position = self.position
+        self.degraded = False
+        self._stall_start = None
+        self._arduino_hit = None
+        self._shunt_samples = 0
+        # The battery voltage just before the motor starts is the no load point of the fit, unless
+        # it could be a reading from a run that just ended
+        self._load_fit = LoadFit()
+        rest = None
+        if idle is not None and idle > config.BATTERY_SAMPLE_INTERVAL:
+            rest = ArduinoInterface.recent_voltages(config.BATTERY_SAMPLE_INTERVAL)
+        if rest is not None:
+            self._load_fit.add_reading(0, rest[config.BATTERY_VOLTAGE_PIN])
+        Tracer.mark("{}:motor_on".format(phase))
+        # The Arduino watches the shunt between the gate's own readings
+        ArduinoInterface.arm_hit_detection(self.shunt_pin, config.SHUNT_THRESHOLD,
+                                           config.SHUNT_READ_DELAY)
+
+    def _motor_stopped(self):
+        """Record the shunt sampling rate achieved during the motor run that just ended
+        """
+        if self._motor_start_time is None:
+            return
+        ArduinoInterface.disarm_hit_detection()
+        Tracer.mark("{}:motor_stop".format(self._motor_phase))
+        run_time = self.clock.monotonic() - self._motor_start_time
+        if run_time > 0:
+            SHUNT_SAMPLE_RATE.set(self._shunt_samples / run_time)
+        self._run_time = run_time
+        self._estimate_position(run_time)
+        self._end_stall()
+        BatteryHealth.record(self._motor_phase, self._load_fit)
+        self._motor_stop_time = self.clock.monotonic()
+        self._motor_start_time = None
+
+    def motor_idle_time(self):
+        """Seconds since the motor last stopped, None while it is running and infinite if it
+        hasn't run since the gate started
+        """
+        if self._motor_start_time is not None:
+            return None
+        stop_time = self._motor_stop_time
+        if stop_time is None:
+            return float("inf")
+        return self.clock.monotonic() - stop_time
+
+    def _estimate_position(self, run_time):
+        """Move the estimated position by the fraction of the travel time the motor ran for
+        """
+        if self.position is None:
+            return
+        travel_time = self.state_store.state["calibration"].get(self._motor_phase) or \
+            config.EXPECTED_TIME_TO_OPEN_CLOSE
+        step = run_time / travel_time if self._motor_phase == "open" else -run_time / travel_time
+        self.position = round(min(1.0, max(0.0, self.position + step)), 3)
+
+    def _read_shunt(self):
+        """Read the shunt voltage from the Arduino, along with the battery voltage from the same
+        reading for the internal resistance estimate
+        """
+        voltages = ArduinoInterface.get_analog_voltages()
+        shunt_voltage = voltages[self.shunt_pin]
+        self._load_fit.add_reading(shunt_voltage, voltages[config.BATTERY_VOLTAGE_PIN])
+        if self._shunt_samples == 0:
+            Tracer.mark("{}:first_shunt_read".format(self._motor_phase))
+        self._shunt_samples += 1
+        SHUNT_SAMPLES.inc()
+        return shunt_voltage
 
     def setup_pins(self):
         """Setup for gpio pins
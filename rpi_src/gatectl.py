@@ -0,0 +1,44 @@
+""" Command line client for the smart-gate command socket.
+Each argument is sent as a command and the JSON responses are printed one per line, e.g.
+    python3 gatectl.py open
+    python3 gatectl.py normal_away status
+This only uses the standard library so it can be run without the smart-gate virtual environment.
+"""
+import argparse
+import os
+import socket
+import sys
+from pathlib import Path
+
+
+def send_commands(commands, socket_path, timeout=5):
+    """ Send commands over a single connection and return the response lines
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall("".join(command + "\n" for command in commands).encode())
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile("r") as responses:
+            return [response.rstrip("\n") for response in responses]
+
+
+def main():
+    """ Entry point for the command line client
+    """
+    parser = argparse.ArgumentParser(description="Send commands to the smart-gate")
+    parser.add_argument("commands", nargs="+",
+                        help="commands to send, put arguments in quotes e.g. 'traces 5'")
+    parser.add_argument("--socket", default=os.path.join(str(Path.home()), "gate.sock"),
+                        help="path to the smart-gate command socket")
+    args = parser.parse_args()
+    try:
+        for response in send_commands(args.commands, args.socket):
+            print(response)
+    except OSError as err:
+        print("Could not reach smart-gate: {}".format(err), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+""" Module for the local HTTP API.
+Other modules register routes on the HttpApi class, which serves them from a threaded HTTP server
+bound to localhost.
+"""
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("root")
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """ Dispatches GET requests to the routes registered on HttpApi
+    """
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Handle a GET request
+        """
+        path = self.path.split("?", 1)[0]
+        route = HttpApi.routes.get(path)
+        if route is None:
+            self.send_error(404)
+            return
+        content_type, callback, stream = route
+        if stream:
+            self._stream(content_type, callback())
+            return
+        body = callback()
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, content_type, chunks):
+        """ Write chunks to the client as they are produced until it disconnects
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            chunks.close()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """ Keep requests out of the gate log unless debugging the API
+        """
+        logger.debug("HTTP API: " + format, *args)
+
+
+class HttpApi:
+    """ Local HTTP server for read only status endpoints such as /metrics and /events
+    """
+    routes = {}
+    server = None
+
+    @classmethod
+    def add_route(cls, path, content_type, callback):
+        """ Register callback to produce the body for GET requests to path
+        """
+        cls.routes[path] = (content_type, callback, False)
+
+    @classmethod
+    def add_stream_route(cls, path, content_type, callback):
+        """ Register callback to produce a generator of byte chunks that are streamed to the client
+        """
+        cls.routes[path] = (content_type, callback, True)
+
+    @classmethod
+    def start(cls, host, port):
+        """ Start serving in a daemon thread
+        """
+        try:
+            cls.server = ThreadingHTTPServer((host, port), _RequestHandler)
+        except OSError as err:
+            # The API is for monitoring only, the gate must keep running without it
+            logger.warning("HTTP API could not start on %s:%s: %s", host, port, err)
+            return
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        logger.info("HTTP API listening on %s:%s", host, cls.server.server_port)
+
+    @classmethod
+    def stop(cls):
+        """ Stop the server if it is running
+        """
+        if cls.server is not None:
+            cls.server.shutdown()
+            cls.server.server_close()
+            cls.server = None
@@ -3,11 +3,14 @@
 import logging
 import os
 import queue
-import subprocess
 import threading
+import time
+from clock import SYSTEM_CLOCK
 from config import Config as config
+from metrics import Metrics
 from battery_voltage_log import BatteryVoltageLog
-from serial_analog import ArduinoInterface
+from recorder import Recorder
+from tracing import Tracer
 
 logger = logging.getLogger('root')
 
@@ -17,10 +20,13 @@ class JobQueue(queue.Queue):
     Inheritated from the python queue class with the addition of a method that ensures the
     commands put on the queue are valid
     """
-    def __init__(self, valid_commands, pipe_file):
+    def __init__(self, valid_commands, pipe_file, clock=None):
         super().__init__(maxsize=10)
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
         assert isinstance(valid_commands, list)
         self.valid_commands = valid_commands
+        Metrics.gauge("job_queue_depth", "Jobs waiting on the gate job queue").set_function(
+            self.qsize)
         # Setup FIFO named pipe
         self.pipe_file = pipe_file
         try:
@@ -47,6 +53,14 @@ class JobQueue(queue.Queue):
         else:
             logger.warning('%s is not a valid command for queue', message)
 
+    def get(self, block=True, timeout=None):
+        """Get the next job, on a virtual clock the wait runs the clock's timers until a job is
+        put on the queue instead of blocking
+        """
+        if block and self.clock.wait_until(lambda: not self.empty(), timeout):
+            return super().get(block=False)
+        return super().get(block, timeout)
+
     def get_nonblocking(self):
         """Non-blocking version of the parent classes get() method
         """
@@ -57,8 +71,17 @@ class JobQueue(queue.Queue):
     def cleanup(self):
         """Cleanup method to delete the named pipe and kill thread that was reading it
         """
-        # Send kill command to the child process
-        print(subprocess.run('echo {} > {}'.format('kill', self.pipe_file), shell=True, check=True))
+        # Send kill command to the reading thread. Opening the pipe fails until the thread has
+        # opened it for reading, so retry until it has received the command and exited
+        deadline = time.monotonic() + 1
+        while self.read_thread.is_alive() and time.monotonic() < deadline:
+            try:
+                fifo = os.open(self.pipe_file, os.O_WRONLY | os.O_NONBLOCK)
+                os.write(fifo, b'kill\n')
+                os.close(fifo)
+                self.read_thread.join(timeout=0.1)
+            except OSError:
+                time.sleep(0.01)
         os.remove(self.pipe_file)
 
     def read_fifo(self):
@@ -75,16 +98,29 @@ class JobQueue(queue.Queue):
                     # Cleanup input message
                     job = job.strip().replace('\n', '')
                     logger.debug('Received message via pipe: %s', job)
-
-                    # Check if message is for debugging
-                    if job == 'log_battery':
-                        # log battery voltage and do not put message on queue
-                        bat_voltage = BatteryVoltageLog.analog_to_battery_voltage(
-                            ArduinoInterface.get_analog_voltages(config.BATTERY_VOLTAGE_PIN), 2)
-                        logger.debug("Battery voltage: %.2fv", bat_voltage)
-                        continue
-
-                    self.validate_and_put(job)
-                    if job == 'kill':
+                    Recorder.fifo(job)
+                    if not self.handle_fifo(job):
                         logger.warning('Received kill command on read_fifo thread')
                         return
+
+    def handle_fifo(self, job):
+        """ Act on a command read from the FIFO, returns False if it was the kill command
+        """
+        # Check if message is for debugging
+        if job == 'log_battery':
+            # log battery voltage and do not put message on queue
+            bat_voltage = BatteryVoltageLog.read_battery_voltage(2)
+            logger.debug("Battery voltage: %.2fv", bat_voltage)
+            return True
+
+        # Export the recent gate cycle timelines and do not put message on queue
+        if job == 'dump_traces':
+            Tracer.export_json(config.TRACE_FILE)
+            logger.debug("Gate cycle timelines written to %s", config.TRACE_FILE)
+            return True
+
+        if job == 'open':
+            Tracer.trigger('pipe')
+
+        self.validate_and_put(job)
+        return job != 'kill'
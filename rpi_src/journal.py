@@ -0,0 +1,203 @@
+""" Module for the recent event journal.
+Events are stored as fixed size packed records in a ring buffer backed by an mmap'd file, so the
+recent history survives a restart without a DB query. An in memory index by event type allows
+queries like the last 20 hits or all entries since 08:00 without scanning every record.
+"""
+import collections
+import datetime
+import mmap
+import os
+import struct
+import threading
+
+from events import EventBus
+
+
+class Journal:
+    """ Fixed capacity ring of compact event records mirrored to an mmap'd file
+    """
+    # pylint: disable=unsubscriptable-object,unsupported-assignment-operation
+    # File header: magic, capacity, total number of records ever written
+    HEADER = struct.Struct("<4sIQ")
+    MAGIC = b"SGJ1"
+    # Record: unix time, type code, value, detail text (32 bytes in total)
+    RECORD = struct.Struct("<dBf19s")
+    TYPES = ["trigger", "entry", "cycle", "mode", "hit", "timeout", "battery_alert",
+             "resistance", "link", "stall"]
+
+    path = None
+    capacity = 0
+    _total = 0
+    _mmap = None
+    _index = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, capacity=4096):
+        """ Open the journal file, creating it if it doesn't exist or has a different capacity,
+        and index the records it holds
+        """
+        cls.close()
+        cls.path = path
+        cls.capacity = capacity
+        size = cls.HEADER.size + capacity * cls.RECORD.size
+        fresh = True
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            with open(path, "rb") as journal_file:
+                magic, file_capacity, total = cls.HEADER.unpack(
+                    journal_file.read(cls.HEADER.size))
+            fresh = magic != cls.MAGIC or file_capacity != capacity
+        if fresh:
+            total = 0
+            with open(path, "wb") as journal_file:
+                journal_file.truncate(size)
+        with open(path, "r+b") as journal_file:
+            cls._mmap = mmap.mmap(journal_file.fileno(), size)
+        cls._total = total
+        cls._write_header()
+        cls._rebuild_index()
+        EventBus.add_listener(cls._on_event)
+
+    @classmethod
+    def close(cls):
+        """ Flush and close the journal file
+        """
+        with cls._lock:
+            if cls._mmap is not None:
+                cls._mmap.flush()
+                cls._mmap.close()
+                cls._mmap = None
+
+    @classmethod
+    def _write_header(cls):
+        cls._mmap[:cls.HEADER.size] = cls.HEADER.pack(cls.MAGIC, cls.capacity, cls._total)
+
+    @classmethod
+    def _offset(cls, slot):
+        return cls.HEADER.size + slot * cls.RECORD.size
+
+    @classmethod
+    def _rebuild_index(cls):
+        """ Index the stored records by type, oldest first
+        """
+        cls._index = {code: collections.deque() for code in range(len(cls.TYPES))}
+        for sequence in range(max(0, cls._total - cls.capacity), cls._total):
+            slot = sequence % cls.capacity
+            code = cls._mmap[cls._offset(slot) + 8]
+            if code in cls._index:
+                cls._index[code].append(sequence)
+
+    @classmethod
+    def record(cls, event_type, timestamp, value=0.0, detail=""):
+        """ Append a record, overwriting the oldest once the journal is full
+        """
+        code = cls.TYPES.index(event_type)
+        with cls._lock:
+            if cls._mmap is None:
+                return
+            sequence = cls._total
+            slot = sequence % cls.capacity
+            if sequence >= cls.capacity:
+                # Drop the overwritten record from the index, it is always the oldest of its type
+                old_code = cls._mmap[cls._offset(slot) + 8]
+                if old_code in cls._index and cls._index[old_code]:
+                    cls._index[old_code].popleft()
+            offset = cls._offset(slot)
+            cls._mmap[offset:offset + cls.RECORD.size] = cls.RECORD.pack(
+                timestamp, code, value, detail.encode()[:19])
+            cls._index[code].append(sequence)
+            cls._total += 1
+            cls._write_header()
+
+    @classmethod
+    def _read(cls, sequence):
+        offset = cls._offset(sequence % cls.capacity)
+        timestamp, code, value, detail = cls.RECORD.unpack_from(cls._mmap, offset)
+        return {"time": datetime.datetime.fromtimestamp(timestamp).isoformat(),
+                "type": cls.TYPES[code],
+                "value": round(value, 4),
+                "detail": detail.rstrip(b"\x00").decode(errors="replace")}
+
+    @classmethod
+    def query(cls, event_type=None, limit=None, since=None):
+        """ Return records newest first, optionally filtered by type, limited in number and only
+        those at or after the unix time since
+        """
+        with cls._lock:
+            if cls._mmap is None:
+                return []
+            if event_type is None:
+                sequences = range(cls._total - 1, max(0, cls._total - cls.capacity) - 1, -1)
+            else:
+                sequences = reversed(cls._index[cls.TYPES.index(event_type)])
+            records = []
+            for sequence in sequences:
+                if limit is not None and len(records) >= limit:
+                    break
+                if since is not None:
+                    timestamp = struct.unpack_from(
+                        "<d", cls._mmap, cls._offset(sequence % cls.capacity))[0]
+                    if timestamp < since:
+                        break
+                records.append(cls._read(sequence))
+        return records
+
+    @classmethod
+    def _on_event(cls, event):
+        """ Journal the events from the event bus that are worth keeping
+        """
+        data = event.data
+        if event.event_type == "trigger":
+            cls.record("trigger", event.timestamp, detail=data["source"])
+        elif event.event_type == "entry":
+            cls.record("entry", event.timestamp, detail=data["button"])
+        elif event.event_type == "cycle":
+            cls.record("cycle", event.timestamp, data["duration"], str(data["result"]))
+        elif event.event_type == "mode":
+            cls.record("mode", event.timestamp, detail=data["mode"])
+        elif event.event_type in ("hit", "timeout"):
+            cls.record(event.event_type, event.timestamp, data.get("elapsed", 0.0),
+                       data["phase"])
+        elif event.event_type == "battery_alert":
+            cls.record("battery_alert", event.timestamp, data["voltage"])
+        elif event.event_type == "resistance":
+            cls.record("resistance", event.timestamp, data["resistance"], data["phase"])
+        elif event.event_type == "stall":
+            cls.record("stall", event.timestamp, data["duration"], data["phase"])
+        elif event.event_type == "link":
+            # Down time is recorded when the link comes back
+            cls.record("link", event.timestamp, data.get("downtime", 0.0),
+                       "up" if data["up"] else "down")
+
+    @classmethod
+    def command(cls, args):
+        """ Command server handler: journal [type] [count] [since HH:MM or ISO date time]
+        """
+        event_type, limit, since = None, None, None
+        args = list(args)
+        # Accept the plural of the type as well, e.g. "journal hits 20"
+        names = {name: name for name in cls.TYPES}
+        names.update({name + "s": name for name in cls.TYPES})
+        names["entries"] = "entry"
+        if args and args[0] in names:
+            event_type = names[args.pop(0)]
+        if args and args[0].isdigit():
+            limit = int(args.pop(0))
+        if len(args) == 2 and args[0] == "since":
+            since = cls._parse_since(args[1])
+        elif args:
+            raise ValueError("Usage: journal [type] [count] [since HH:MM]")
+        elif limit is None:
+            limit = 20
+        return {"records": cls.query(event_type, limit, since)}
+
+    @staticmethod
+    def _parse_since(text):
+        """ Convert HH:MM (today) or an ISO date time to a unix time
+        """
+        try:
+            clock = datetime.datetime.strptime(text, "%H:%M").time()
+            since = datetime.datetime.combine(datetime.date.today(), clock)
+        except ValueError:
+            since = datetime.datetime.fromisoformat(text)
+        return since.timestamp()
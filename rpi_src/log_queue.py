@@ -0,0 +1,60 @@
+""" Module for the bounded logging queue.
+Records are only admitted to the queue while it is below the limit for their level, so as the
+queue fills DEBUG records are shed first, then INFO and WARNING. CRITICAL records are never dropped.
+"""
+import logging
+import logging.handlers
+import queue
+
+from metrics import Metrics
+
+DROPPED_RECORDS = Metrics.counter("log_records_dropped", "Log records dropped by a full log queue")
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler that drops records by level when its queue is full instead of growing
+    """
+    # Fraction of the capacity each level may fill, None means the level is never dropped
+    DEFAULT_POLICY = {
+        logging.DEBUG: 0.5,
+        logging.INFO: 0.75,
+        logging.WARNING: 1.0,
+        logging.ERROR: 1.0,
+        logging.CRITICAL: None,
+    }
+
+    def __init__(self, capacity, policy=None):
+        # The queue itself is unbounded so that records that must not be dropped never block,
+        # the capacity is enforced per level in enqueue
+        super().__init__(queue.Queue())
+        self.capacity = capacity
+        self.policy = dict(self.DEFAULT_POLICY if policy is None else policy)
+        self.dropped = {}
+
+    def limit(self, levelno):
+        """ Maximum queue depth at which a record of levelno is still admitted
+        """
+        fraction = self.policy[min(self.policy)]
+        for level in sorted(self.policy):
+            if levelno >= level:
+                fraction = self.policy[level]
+        if fraction is None:
+            return None
+        return int(self.capacity * fraction)
+
+    def emit(self, record):
+        """ Queue the record unless the queue is too full for its level.
+        The check is done before the record is formatted so dropping a record is cheap.
+        """
+        limit = self.limit(record.levelno)
+        if limit is not None and self.queue.qsize() >= limit:
+            self.dropped[record.levelname] = self.dropped.get(record.levelname, 0) + 1
+            DROPPED_RECORDS.inc()
+            return
+        super().emit(record)
+
+    @property
+    def dropped_total(self):
+        """ Total number of records that have been dropped
+        """
+        return sum(self.dropped.values())
@@ -0,0 +1,186 @@
+""" Module for the log file storage backend.
+Log files are rotated when they reach a size limit or age, rotated segments are gzipped in a
+background thread and the oldest segments are deleted to keep all the logs within a disk budget.
+Writes are buffered and only flushed for warnings or after a short interval to reduce SD card wear,
+LogStorage.flush is scheduled every interval so a quiet log doesn't hold records in the buffer.
+"""
+import glob
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+logger = logging.getLogger("root")
+
+
+class CompressedRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """ File handler that rotates on size or age and hands rotated segments to LogStorage for
+    compression
+    """
+    def __init__(self, filename, max_bytes, max_age, flush_interval):
+        super().__init__(filename, "a", delay=True)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        if os.path.exists(self.baseFilename):
+            self.rollover_at = os.stat(self.baseFilename).st_mtime + self.max_age
+        else:
+            self.rollover_at = time.time() + self.max_age
+
+    def shouldRollover(self, record):  # pylint: disable=invalid-name,unused-argument
+        """ Rollover when the file is too large or too old
+        """
+        if time.time() >= self.rollover_at:
+            return True
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.max_bytes
+
+    def doRollover(self):  # pylint: disable=invalid-name
+        """ Move the current file aside and queue it for compression
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            rotated = "{}.{}".format(self.baseFilename, time.strftime("%Y%m%d-%H%M%S"))
+            # Avoid overwriting a segment if two rollovers happen within a second
+            suffix = 1
+            while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+                rotated = "{}.{}-{}".format(self.baseFilename, time.strftime("%Y%m%d-%H%M%S"),
+                                            suffix)
+                suffix += 1
+            os.rename(self.baseFilename, rotated)
+            LogStorage.compress(rotated)
+        self.rollover_at = time.time() + self.max_age
+
+    def emit(self, record):
+        """ Write the record, only flushing for warnings or once the flush interval has passed
+        """
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            now = time.monotonic()
+            if record.levelno >= logging.WARNING or now - self._last_flush >= self.flush_interval:
+                self.stream.flush()
+                self._last_flush = now
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+    def flush(self):
+        """ Write the buffered records to the file
+        """
+        super().flush()
+        self._last_flush = time.monotonic()
+
+
+class LogStorage:
+    """ Creates the log file handlers and manages their rotated segments.
+    The settings are module wide so they can be updated once conf.ini has been read.
+    """
+    max_bytes = 1024 * 1024
+    max_age = 7 * 24 * 60 * 60
+    flush_interval = 5
+    budget_bytes = 50 * 1024 * 1024
+
+    handlers = []
+    _compress_q = queue.Queue()
+    _thread = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def file_handler(cls, path, level, log_format):
+        """ Create a rotating, compressing file handler for path
+        """
+        handler = CompressedRotatingFileHandler(
+            path, cls.max_bytes, cls.max_age, cls.flush_interval)
+        handler.setLevel(level)
+        handler.setFormatter(logging.Formatter(log_format))
+        cls.handlers.append(handler)
+        return handler
+
+    @classmethod
+    def configure(cls, max_bytes, max_age, flush_interval, budget_bytes):
+        """ Update the storage settings for existing and future handlers
+        """
+        cls.max_bytes = max_bytes
+        cls.max_age = max_age
+        cls.flush_interval = flush_interval
+        cls.budget_bytes = budget_bytes
+        for handler in cls.handlers:
+            handler.max_bytes = max_bytes
+            handler.flush_interval = flush_interval
+            if handler.max_age != max_age:
+                handler.rollover_at += max_age - handler.max_age
+                handler.max_age = max_age
+
+    @classmethod
+    def flush(cls):
+        """ Write the buffered records of every handler to their files
+        """
+        for handler in cls.handlers:
+            handler.flush()
+
+    @classmethod
+    def compress(cls, path):
+        """ Queue a rotated segment to be compressed in the background
+        """
+        with cls._lock:
+            if cls._thread is None or not cls._thread.is_alive():
+                cls._thread = threading.Thread(target=cls._compress_loop, daemon=True)
+                cls._thread.start()
+        cls._compress_q.put(path)
+
+    @classmethod
+    def wait(cls):
+        """ Block until every queued segment has been compressed
+        """
+        cls._compress_q.join()
+
+    @classmethod
+    def _compress_loop(cls):
+        """ Compress rotated segments and then enforce the disk budget
+        """
+        while True:
+            path = cls._compress_q.get()
+            try:
+                with open(path, "rb") as source, gzip.open(path + ".gz", "wb") as destination:
+                    shutil.copyfileobj(source, destination)
+                os.remove(path)
+                cls.enforce_budget()
+            except OSError as err:
+                logger.warning("Failed to compress log segment %s: %s", path, err)
+            finally:
+                cls._compress_q.task_done()
+
+    @classmethod
+    def segments(cls):
+        """ Return all the compressed segments of every log, oldest first
+        """
+        paths = []
+        for handler in cls.handlers:
+            paths.extend(glob.glob(glob.escape(handler.baseFilename) + ".*.gz"))
+        return sorted(set(paths), key=os.path.getmtime)
+
+    @classmethod
+    def enforce_budget(cls):
+        """ Delete the oldest segments until all logs fit in the disk budget
+        """
+        total = sum(os.path.getsize(handler.baseFilename) for handler in cls.handlers
+                    if os.path.exists(handler.baseFilename))
+        segments = cls.segments()
+        sizes = [os.path.getsize(segment) for segment in segments]
+        total += sum(sizes)
+        for segment, size in zip(segments, sizes):
+            if total <= cls.budget_bytes:
+                break
+            os.remove(segment)
+            total -= size
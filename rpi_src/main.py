@@ -1,15 +1,34 @@
 """Smart gate module entry point
 """
+import concurrent.futures
+import json
 import logging
+import os
+import time
 
+# Imported first so start up is timed from as early as possible
+from startup import StartupProfiler
 # Smart gate module imports
 from config import Config as config
 from serial_analog import ArduinoInterface
+from battery_health import BatteryHealth
 from battery_voltage_log import BatteryVoltageLog
 from gate import Gate
 from job_queue import JobQueue
-from camera import Camera
+from journal import Journal
+from log_storage import LogStorage
+from command_server import CommandServer
+from config_watch import ConfigWatcher
 from db import DB
+from events import EventBus
+from http_api import HttpApi
+from metrics import Metrics
+from power import ChargeEstimator, PowerProfile
+from recorder import Recorder
+from scheduler import Scheduler
+from state_store import StateStore
+from status import StatusSnapshot
+from tracing import Tracer
 
 logger = logging.getLogger('root')
 
@@ -21,34 +40,45 @@ def main_loop():
         gate.mode_change(job)
         return
     if job == 'open':
+        Tracer.begin()
         gate.current_state = 'opening'
         with job_q.mutex:
             job_q.queue.clear()
-    if gate.current_state == 'opening':
-        gate.open()
-    if gate.current_state == 'opened':
-        gate.hold()
-    if gate.current_state == 'holding':
-        gate.close()
+    # Reloaded config is only applied between cycles
+    with config.reload_lock:
+        if gate.current_state == 'opening':
+            gate.open()
+        if gate.current_state == 'opened':
+            gate.hold()
+        if gate.current_state == 'holding':
+            gate.close()
+    Tracer.end(gate.current_state)
 
 
 def lock_closed_loop(_gate, queue):
     """Loop for when in the lock closed mode
     """
-    # Close the gate
-    _gate.close()
+    # Close the gate, unless it was already left closed
+    if _gate.current_state != 'closed':
+        with config.reload_lock:
+            _gate.close()
     # wait for the mode to change
     while _gate.current_mode == 'lock_closed':
         job = queue.get()
         if job in config.MODES:
             _gate.mode_change(job)
+            # Sending the mode again retries closing a gate that was stopped part way
+            if _gate.current_state != 'closed':
+                return
 
 
 def lock_open_loop(_gate, queue):
     """Loop for when in the lock open mode
     """
-    # Open the gate
-    _gate.open()
+    # Open the gate, unless it was already left open
+    if _gate.current_state != 'opened':
+        with config.reload_lock:
+            _gate.open()
     # wait for the mode to change
     while _gate.current_mode == 'lock_open':
         job = queue.get()
@@ -57,20 +87,93 @@ def lock_open_loop(_gate, queue):
             if job.startswith('normal'):
                 queue.validate_and_put('open')
             _gate.mode_change(job)
+            # Sending the mode again retries opening a gate that was stopped part way
+            if _gate.current_state != 'opened':
+                return
+
+
+def start_camera():
+    """Import and start the camera, picamera is slow to import so this runs alongside the serial
+    handshake
+    """
+    from camera import Camera  # pylint: disable=import-outside-toplevel
+    return Camera(None) if config.CAMERA_ENABLED else None
+
+
+def start_db_services(_db_future, _cam_future, _scheduler):
+    """Start everything that needs the db or the camera once they are ready. The gate can already
+    open by the time this runs
+    """
+    db = _db_future.result()
+    cam = _cam_future.result()
+    if cam is not None:
+        cam.entry_db = db
+    ArduinoInterface.attach(cam, db)
+    StatusSnapshot.initialize(gate, job_q, cam)
+    battery_logger = BatteryVoltageLog(config.BATTERY_VOLTAGE_LOG, config.BATTERY_VOLTAGE_PIN, db,
+                                       gate)
+    battery_logger.start(_scheduler)
+    _scheduler.every(300, db.health_check, name='db health check', jitter=10)
+    charge_estimator = ChargeEstimator(gate)
+    charge_estimator.load_history(db.voltage_history(24))
+    PowerProfile(charge_estimator, battery_logger, _scheduler, cam).start()
+    BatteryHealth.initialize(db)
+    _scheduler.every(60, BatteryHealth.flush, name='battery resistance log')
+
+
+def startup_finished(future):
+    """Log the start up report once the db services have started
+    """
+    if future.exception() is not None:
+        logger.critical('Failed to start the db services: %s', future.exception())
+    logger.info(StartupProfiler.report())
 
 
 if __name__ == '__main__':
+    StartupProfiler.record('interpreter+imports', StartupProfiler.origin, time.monotonic())
     logger.info('Starting smart gate')
     logger.debug('VERSION=%s, CONTAINERIZED=%s',
                  config.VERSION, config.CONTAINERIZED)
-    db = DB()
-    cam = Camera(db) if config.CAMERA_ENABLED else None
-    job_q = JobQueue(config.COMMANDS+config.MODES, config.FIFO_FILE)
-    gate = Gate(job_q)
-    ArduinoInterface.initialize(gate, job_q, cam, db)
-    battery_logger = BatteryVoltageLog(config.BATTERY_VOLTAGE_LOG, config.BATTERY_VOLTAGE_PIN, db)
-    battery_logger.start()
+    # Connecting to the db and starting the camera don't hold up the gate being able to open
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=3, thread_name_prefix='startup')
+    db_future = executor.submit(StartupProfiler.timed, 'db', DB)
+    cam_future = executor.submit(StartupProfiler.timed, 'camera', start_camera)
+    with StartupProfiler.phase('journal'):
+        os.makedirs(os.path.dirname(config.JOURNAL_FILE), exist_ok=True)
+        Journal.open(config.JOURNAL_FILE, config.JOURNAL_CAPACITY)
+        if config.RECORD_FILE:
+            Recorder.start(config.RECORD_FILE, config.RECORD_MAX_BYTES)
+    with StartupProfiler.phase('gpio'):
+        job_q = JobQueue(config.COMMANDS+config.MODES, config.FIFO_FILE)
+        gate = Gate(job_q, StateStore(config.STATE_FILE))
+    with StartupProfiler.phase('serial'):
+        ArduinoInterface.initialize(gate, job_q)
+    StartupProfiler.ready()
+    with StartupProfiler.phase('services'):
+        scheduler = Scheduler()
+        scheduler.start()
+        scheduler.every(config.LOG_FLUSH_INTERVAL, LogStorage.flush, name='log flush')
+        scheduler.every(config.LOG_FLUSH_INTERVAL, Recorder.flush, name='trace recorder flush')
+        HttpApi.add_route('/metrics', 'text/plain; version=0.0.4', Metrics.exposition)
+        HttpApi.add_route('/traces', 'application/json', lambda: json.dumps(Tracer.export()))
+        HttpApi.add_stream_route('/events', 'text/event-stream', EventBus.sse_stream)
+        StatusSnapshot.initialize(gate, job_q)
+        HttpApi.add_route('/status', 'application/json', StatusSnapshot.render_json)
+        HttpApi.start(config.HTTP_API_HOST, config.HTTP_API_PORT)
+        CommandServer.initialize(gate, job_q)
+        CommandServer.add_command(
+            'journal', Journal.command,
+            'recent events e.g. "journal hits 20" or "journal entries since 08:00"')
+        CommandServer.start(config.COMMAND_SOCKET)
+        config_watcher = ConfigWatcher(config.CONFIG_PATH, {'conf.ini': config.reload,
+                                                            'email_keys.json': config.reload_email})
+        config_watcher.start()
+    executor.submit(StartupProfiler.timed, 'db services', start_db_services, db_future,
+                    cam_future, scheduler).add_done_callback(startup_finished)
+    executor.shutdown(wait=False)
     try:
+        with config.reload_lock:
+            gate.resume()
         while 1:
             if gate.current_mode.startswith('normal'):
                 main_loop()
@@ -86,6 +189,15 @@ if __name__ == '__main__':
         logger.critical('Critical Exception: %s', exception)
     finally:
         logger.debug('running cleanup')
-        db.cleanup()
+        config_watcher.stop()
+        ArduinoInterface.stop()
+        Recorder.stop()
+        scheduler.stop()
+        if db_future.done() and db_future.exception() is None:
+            db_future.result().cleanup()
         job_q.cleanup()
+        HttpApi.stop()
+        CommandServer.stop()
+        Journal.close()
+        config.alert_listener.stop()
         config.log_listener.stop()
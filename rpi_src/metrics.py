@@ -0,0 +1,182 @@
+""" Module for a lightweight metrics registry.
+Counters, gauges and fixed bucket histograms are kept in memory and rendered in the Prometheus
+text exposition format when scraped.
+"""
+import bisect
+import threading
+
+
+class Counter:
+    """ Monotonically increasing value, such as the number of serial errors
+    """
+    metric_type = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """ Increment the counter by amount
+        """
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        """ Current value of the counter
+        """
+        return self._value
+
+    def samples(self):
+        """ Return a list of (suffix, labels, value) tuples for exposition
+        """
+        return [("_total", "", self._value)]
+
+
+class Gauge:
+    """ Value that can go up and down, such as a queue depth.
+    A function can be assigned to the gauge so the value is only computed when it is scraped.
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        """ Set the gauge to value
+        """
+        self._value = value
+
+    def set_function(self, function):
+        """ Compute the gauge value by calling function at scrape time
+        """
+        self._function = function
+
+    @property
+    def value(self):
+        """ Current value of the gauge
+        """
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def samples(self):
+        """ Return a list of (suffix, labels, value) tuples for exposition
+        """
+        return [("", "", self.value)]
+
+
+class Histogram:
+    """ Histogram with fixed buckets.
+    The bucket counts are allocated once, observing a value only increments a slot so no memory
+    is allocated per sample.
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # Last slot is the +Inf bucket
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """ Record a single observation
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @property
+    def count(self):
+        """ Number of observations recorded
+        """
+        return self._count
+
+    def samples(self):
+        """ Return a list of (suffix, labels, value) tuples for exposition.
+        Bucket counts are cumulative as required by the Prometheus format.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append(("_bucket", '{{le="{}"}}'.format(bound), cumulative))
+        samples.append(("_bucket", '{le="+Inf"}', count))
+        samples.append(("_sum", "", total))
+        samples.append(("_count", "", count))
+        return samples
+
+
+class Metrics:
+    """ Registry of every metric in smart-gate.
+    Metrics are created once (normally at module import) and then updated from the hot paths.
+    """
+    _registry = {}
+    _lock = threading.Lock()
+
+    # Default buckets in seconds, ranging from a serial round trip to a camera capture
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    @classmethod
+    def _get_or_create(cls, metric_class, name, *args):
+        with cls._lock:
+            metric = cls._registry.get(name)
+            if metric is None:
+                metric = metric_class(name, *args)
+                cls._registry[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric {} is already registered as a {}".format(
+                    name, metric.metric_type))
+            return metric
+
+    @classmethod
+    def counter(cls, name, description):
+        """ Get or create a counter
+        """
+        return cls._get_or_create(Counter, name, description)
+
+    @classmethod
+    def gauge(cls, name, description):
+        """ Get or create a gauge
+        """
+        return cls._get_or_create(Gauge, name, description)
+
+    @classmethod
+    def histogram(cls, name, description, buckets=LATENCY_BUCKETS):
+        """ Get or create a histogram
+        """
+        return cls._get_or_create(Histogram, name, description, buckets)
+
+    @classmethod
+    def get(cls, name):
+        """ Return a registered metric or None
+        """
+        return cls._registry.get(name)
+
+    @classmethod
+    def exposition(cls):
+        """ Render all metrics in the Prometheus text format
+        """
+        lines = []
+        with cls._lock:
+            metrics = sorted(cls._registry.values(), key=lambda metric: metric.name)
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.description))
+            lines.append("# TYPE {} {}".format(metric.name, metric.metric_type))
+            for suffix, labels, value in metric.samples():
+                lines.append("{}{}{} {}".format(metric.name, suffix, labels, value))
+        return "\n".join(lines) + "\n"
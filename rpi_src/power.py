@@ -0,0 +1,181 @@
+""" Module to estimate the battery state of charge and adapt the runtime to it.
+The state of charge is estimated from the battery voltage at rest (the motor is off), the voltage
+sag while the motor runs shows the battery health and the trend of the logged summaries shows
+whether the solar panel is keeping up. When the charge drops the power profile stretches the
+battery sampling, stops taking pictures, writes to the db less often and logs less, then restores
+everything once the battery recovers.
+"""
+import collections
+import logging
+import time
+
+from config import Config as config
+from events import EventBus
+
+logger = logging.getLogger("root")
+
+
+class ChargeEstimator:
+    """ Estimates the state of charge and voltage trend of the 24V lead acid battery
+    """
+    # Resting voltage at each state of charge (percent)
+    REST_VOLTAGE_CURVE = [(21.0, 0), (22.62, 10), (23.16, 20), (23.5, 30), (23.8, 40),
+                          (24.12, 50), (24.4, 60), (24.64, 70), (24.84, 80), (25.0, 90),
+                          (25.4, 100)]
+    MOVING_STATES = ("opening", "closing")
+    # Weight of each new sample in the smoothed rest and sag voltages
+    SMOOTHING = 0.1
+
+    def __init__(self, gate=None, history_size=24):
+        self.gate = gate
+        self.rest_voltage = None
+        self.sag = None
+        # (unix time, mean voltage) of each logged window, used for the trend
+        self.history = collections.deque(maxlen=history_size)
+
+    def load_history(self, rows):
+        """ Seed the trend with (datetime, voltage) rows from the BattVolt table
+        """
+        for logged, voltage in rows:
+            self.history.append((logged.timestamp(), voltage))
+
+    def add_sample(self, voltage):
+        """ Add a battery voltage sample, taken under load if the motor is running
+        """
+        if self.gate is not None and self.gate.current_state in self.MOVING_STATES:
+            if self.rest_voltage is not None:
+                self.sag = self._smooth(self.sag, self.rest_voltage - voltage)
+        else:
+            self.rest_voltage = self._smooth(self.rest_voltage, voltage)
+
+    def _smooth(self, current, value):
+        if current is None:
+            return value
+        return current + self.SMOOTHING * (value - current)
+
+    def add_summary(self, voltage, timestamp=None):
+        """ Add the mean voltage of a logged window to the trend history
+        """
+        self.history.append((timestamp if timestamp is not None else time.time(), voltage))
+
+    def state_of_charge(self):
+        """ Percent state of charge interpolated from the resting voltage, None until sampled
+        """
+        if self.rest_voltage is None:
+            return None
+        curve = self.REST_VOLTAGE_CURVE
+        if self.rest_voltage <= curve[0][0]:
+            return 0.0
+        for (low_volt, low_soc), (high_volt, high_soc) in zip(curve, curve[1:]):
+            if self.rest_voltage <= high_volt:
+                fraction = (self.rest_voltage - low_volt) / (high_volt - low_volt)
+                return round(low_soc + fraction * (high_soc - low_soc), 1)
+        # Higher than the resting voltage of a full battery when charging
+        return 100.0
+
+    def trend(self):
+        """ Least squares slope of the logged voltages in volts per hour, None without history
+        """
+        if len(self.history) < 2:
+            return None
+        origin = self.history[0][0]
+        hours = [(timestamp - origin) / 3600 for timestamp, _ in self.history]
+        voltages = [voltage for _, voltage in self.history]
+        mean_hours = sum(hours) / len(hours)
+        mean_voltage = sum(voltages) / len(voltages)
+        spread = sum((hour - mean_hours) ** 2 for hour in hours)
+        if not spread:
+            return None
+        slope = sum((hour - mean_hours) * (voltage - mean_voltage)
+                    for hour, voltage in zip(hours, voltages)) / spread
+        return round(slope, 4)
+
+    def summary(self):
+        """ Dictionary of the current estimates
+        """
+        return {"state_of_charge": self.state_of_charge(),
+                "rest_voltage": round(self.rest_voltage, 2)
+                                if self.rest_voltage is not None else None,
+                "sag": round(self.sag, 2) if self.sag is not None else None,
+                "trend_per_hour": self.trend()}
+
+
+class PowerProfile:
+    """ Switches the runtime between the normal, saver and critical profiles by state of charge
+    """
+    PROFILES = {
+        "normal": {"sample_factor": 1, "camera": True, "windows_per_write": 1, "log_level": None},
+        "saver": {"sample_factor": 3, "camera": True, "windows_per_write": 2,
+                  "log_level": logging.INFO},
+        "critical": {"sample_factor": 10, "camera": False, "windows_per_write": 6,
+                     "log_level": logging.WARNING},
+    }
+    # A profile is only left once the charge is this many percent past its threshold
+    HYSTERESIS = 10
+
+    def __init__(self, estimator, battery_log, scheduler, cam=None):
+        self.estimator = estimator
+        self.battery_log = battery_log
+        self.scheduler = scheduler
+        self.cam = cam
+        self.profile = "normal"
+        self.normal_log_level = logger.level
+        battery_log.estimator = estimator
+        EventBus.add_listener(self._on_event)
+
+    def _on_event(self, event):
+        """ Add each logged battery summary to the trend
+        """
+        if event.event_type == "battery":
+            self.estimator.add_summary(event.data["voltage"], event.timestamp)
+
+    def select(self, soc):
+        """ Profile for the state of charge. Lower profiles are entered as soon as the charge drops
+        below their threshold but only left once it is HYSTERESIS past it
+        """
+        if soc is None:
+            return self.profile
+        order = ["critical", "saver", "normal"]
+        target = self._by_threshold(soc, 0)
+        if order.index(target) <= order.index(self.profile):
+            return target
+        return order[max(order.index(self.profile),
+                         order.index(self._by_threshold(soc, self.HYSTERESIS)))]
+
+    @staticmethod
+    def _by_threshold(soc, margin):
+        if soc < config.POWER_CRITICAL_SOC + margin:
+            return "critical"
+        if soc < config.POWER_SAVER_SOC + margin:
+            return "saver"
+        return "normal"
+
+    def update(self):
+        """ Scheduled job that switches profile if the state of charge calls for it
+        """
+        profile = self.select(self.estimator.state_of_charge())
+        if profile != self.profile:
+            self.apply(profile)
+
+    def apply(self, profile):
+        """ Apply the settings of a profile
+        """
+        settings = self.PROFILES[profile]
+        previous, self.profile = self.profile, profile
+        job = self.battery_log.sample_job
+        if job is not None:
+            self.scheduler.reschedule(
+                job, config.BATTERY_SAMPLE_INTERVAL * settings["sample_factor"])
+        if self.cam is not None:
+            self.cam.enabled = settings["camera"] and config.CAMERA_ENABLED
+        self.battery_log.windows_per_write = settings["windows_per_write"]
+        logger.setLevel(settings["log_level"] or self.normal_log_level)
+        # Logged after the level change so the switch is always recorded
+        logger.warning("Power profile changed from %s to %s: %s",
+                       previous, profile, self.estimator.summary())
+        EventBus.publish("power", profile=profile, **self.estimator.summary())
+
+    def start(self, interval=60):
+        """ Check the profile every interval seconds
+        """
+        return self.scheduler.every(interval, self.update, name="power profile")
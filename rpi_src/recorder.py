@@ -0,0 +1,165 @@
+""" Module to record what the gate receives to a compact binary trace, for replay.py.
+The trace holds the voltage frames and other lines from the Arduino, the FIFO and command socket
+commands and the open triggers, each stamped with the milliseconds since the start of its segment.
+Every time recording starts a new segment is appended, beginning with the wall clock time. Once the
+file reaches its size limit it is moved to <path>.1, replacing the previous one, and a new file is
+started, so at most twice the limit is kept.
+"""
+import os
+import struct
+import threading
+import time
+
+from events import EventBus
+
+
+class TraceWriter:
+    """ Writes trace records to a binary file object opened for appending
+    """
+    # pylint: disable=too-few-public-methods
+    MAGIC = b"SGT1"
+    # Record: milliseconds since the segment started, type code, payload length
+    RECORD = struct.Struct("<IBH")
+    SEGMENT = struct.Struct("<d")
+    TYPES = ["segment", "frame", "serial", "fifo", "command", "trigger"]
+    # Longest segment before a new one is started, the millisecond stamps are 32 bits
+    MAX_OFFSET = 0xFFFFFFFF
+
+    def __init__(self, trace_file, wall, monotonic):
+        self.trace_file = trace_file
+        if trace_file.tell() == 0:
+            trace_file.write(self.MAGIC)
+        self._start = None
+        self._segment(wall, monotonic)
+
+    def _segment(self, wall, monotonic):
+        self._start = monotonic
+        self._write(0, "segment", self.SEGMENT.pack(wall))
+
+    def _write(self, offset, kind, payload):
+        self.trace_file.write(self.RECORD.pack(offset, self.TYPES.index(kind), len(payload)))
+        self.trace_file.write(payload)
+
+    def write(self, wall, monotonic, kind, value):
+        """ Append a record of kind at the given time, value is the list of voltages of a frame
+        and the text of anything else
+        """
+        offset = int(round((monotonic - self._start) * 1000))
+        if offset > self.MAX_OFFSET:
+            self._segment(wall, monotonic)
+            offset = 0
+        if kind == "frame":
+            payload = struct.pack("<{}f".format(len(value)), *value)
+        else:
+            payload = value.encode("ascii", errors="replace")[:0xFFFF]
+        self._write(offset, kind, payload)
+
+
+def read_trace(path):
+    """ Yield (wall clock time, kind, value) for each record in the trace file at path
+    """
+    with open(path, "rb") as trace_file:
+        if trace_file.read(len(TraceWriter.MAGIC)) != TraceWriter.MAGIC:
+            raise ValueError("{} is not a gate trace".format(path))
+        start = None
+        while True:
+            header = trace_file.read(TraceWriter.RECORD.size)
+            if len(header) < TraceWriter.RECORD.size:
+                # A trace cut short by a power cut ends with a partial record
+                return
+            offset, code, length = TraceWriter.RECORD.unpack(header)
+            payload = trace_file.read(length)
+            if len(payload) < length:
+                return
+            kind = TraceWriter.TYPES[code]
+            if kind == "segment":
+                start = TraceWriter.SEGMENT.unpack(payload)[0]
+                continue
+            if kind == "frame":
+                value = list(struct.unpack("<{}f".format(length // 4), payload))
+            else:
+                value = payload.decode("ascii", errors="replace")
+            yield start + offset / 1000, kind, value
+
+
+class Recorder:
+    """ Records to a trace file while started, recording calls are cheap no-ops otherwise
+    """
+    path = None
+    max_bytes = None
+    _writer = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def start(cls, path, max_bytes=None):
+        """ Start appending a new segment to the trace file at path, rotating it once it is
+        max_bytes long
+        """
+        cls.stop()
+        with cls._lock:
+            cls.path = path
+            cls.max_bytes = max_bytes
+            cls._writer = TraceWriter(open(path, "ab"), time.time(), time.monotonic())
+        EventBus.add_listener(cls._on_event)
+
+    @classmethod
+    def stop(cls):
+        """ Stop recording and close the trace file
+        """
+        with cls._lock:
+            if cls._writer is not None:
+                cls._writer.trace_file.close()
+                cls._writer = None
+
+    @classmethod
+    def flush(cls):
+        """ Write the buffered records to the file
+        """
+        with cls._lock:
+            if cls._writer is not None:
+                cls._writer.trace_file.flush()
+
+    @classmethod
+    def record(cls, kind, value):
+        """ Append a record of kind, see TraceWriter.write
+        """
+        if cls._writer is None:
+            return
+        with cls._lock:
+            if cls._writer is not None:
+                cls._writer.write(time.time(), time.monotonic(), kind, value)
+                if cls.max_bytes and cls._writer.trace_file.tell() >= cls.max_bytes:
+                    cls._rotate()
+
+    @classmethod
+    def _rotate(cls):
+        """ Move the full trace file to <path>.1 and start a new one, called with the lock held
+        """
+        cls._writer.trace_file.close()
+        os.replace(cls.path, cls.path + ".1")
+        cls._writer = TraceWriter(open(cls.path, "ab"), time.time(), time.monotonic())
+
+    @classmethod
+    def frame(cls, voltages):
+        """ Record a voltage frame from the Arduino """
+        cls.record("frame", voltages)
+
+    @classmethod
+    def serial(cls, line):
+        """ Record a line from the Arduino that isn't part of a voltage frame """
+        cls.record("serial", line)
+
+    @classmethod
+    def fifo(cls, command):
+        """ Record a command read from the FIFO """
+        cls.record("fifo", command)
+
+    @classmethod
+    def command(cls, command):
+        """ Record a job sent over the command socket """
+        cls.record("command", command)
+
+    @classmethod
+    def _on_event(cls, event):
+        if event.event_type == "trigger":
+            cls.record("trigger", event.data["source"])
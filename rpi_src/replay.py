@@ -0,0 +1,330 @@
+""" Module to replay a trace recorded by recorder.py through the gate, to load test busy days and
+check for changes in behaviour before deploying.
+The gate and job queue run on a virtual clock against ArduinoInterface in mock mode. The recorded
+voltage frames become the mock voltages, lines from the Arduino (buttons and the radio) go through
+ArduinoInterface.handle_message, FIFO commands through JobQueue.handle_fifo and command socket jobs
+onto the job queue, each at the time it was recorded. By default a motor model drives the shunt
+voltage, as the recorded shunt voltages only match the gate runs of the recording. Hits recorded by
+the Arduino are not replayed for the same reason.
+The report counts the gate cycles and states, the DB writes and the camera queue. Replaying the same
+trace always gives the same report, so a report saved before a change can be compared with one
+after.
+
+Usage:
+    python replay.py trace.bin --speed 10 --save report.json
+    python replay.py trace.bin --compare report.json
+"""
+import argparse
+import collections
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+
+from clock import ClockIdle, VirtualClock
+from config import Config as config
+from db import DB
+from emulator import MotorModel, drive_mock_shunt, pin_direction
+from events import EventBus
+from gate import Gate
+from job_queue import JobQueue
+import main
+from recorder import read_trace
+from serial_analog import ArduinoInterface
+from state_store import StateStore
+from tracing import Tracer
+
+
+class ReplaySerial:
+    """ Serial port that reads the recorded lines from the Arduino in order, writes are dropped
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.position = 0
+        self.timeout = 1
+
+    def readline(self):
+        """ Next recorded line, empty once they have all been read """
+        if self.position >= len(self.lines):
+            return b""
+        self.position += 1
+        return (self.lines[self.position - 1] + "\r\n").encode("ascii", errors="replace")
+
+    @staticmethod
+    def write(data):
+        """ Nothing is sent """
+        return len(data)
+
+    def flushInput(self):  # pylint: disable=invalid-name
+        """ Skip the recorded lines already due """
+
+
+class CameraModel:
+    """ Camera queue worked through in virtual time, each picture takes capture_time seconds (the
+    preview and the capture)
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, clock, entry_db, capture_time=6.0):
+        self.clock = clock
+        self.entry_db = entry_db
+        self.capture_time = capture_time
+        # ArduinoInterface puts (button, datetime) requests on camera_q
+        self.camera_q = self
+        self.enabled = True
+        self._waiting = collections.deque()
+        self._taking = None
+        self.requested = 0
+        self.taken = 0
+        self.max_queue = 0
+        self.max_wait = 0.0
+        clock.add_listener(self._step)
+
+    def put(self, job):
+        """ Request a picture """
+        self.requested += 1
+        self._waiting.append((self.clock.monotonic(), job))
+        self.max_queue = max(self.max_queue, len(self._waiting))
+
+    def _step(self):
+        now = self.clock.monotonic()
+        if self._taking is not None:
+            if now < self._taking[0]:
+                return
+            _, (_, entry_dt) = self._taking
+            self._taking = None
+            self.taken += 1
+            if self.entry_db is not None:
+                self.entry_db.add_media_filename(entry_dt, "{:%Y%m%d%H%M%S}.jpg".format(entry_dt))
+        if self._waiting and self.enabled:
+            requested, job = self._waiting.popleft()
+            self.max_wait = max(self.max_wait, now - requested)
+            self._taking = (now + self.capture_time, job)
+
+    def report(self):
+        """ Summary of the pictures requested and taken """
+        return {"requested": self.requested, "taken": self.taken, "max_queue": self.max_queue,
+                "max_wait_seconds": round(self.max_wait, 2)}
+
+
+class RecordingConnection:
+    """ DB connection and cursor that count the writes to each table instead of executing them
+    """
+    closed = 0
+
+    def __init__(self):
+        self.writes = collections.Counter()
+
+    def execute(self, sql, values=None):  # pylint: disable=unused-argument
+        """ Count the statement by its verb and table """
+        match = re.search(r"(INSERT INTO|UPDATE)\s+(\w+)", sql, re.IGNORECASE)
+        if match:
+            self.writes["{} {}".format(match.group(1).split()[0], match.group(2)).lower()] += 1
+
+    def commit(self):
+        """ Nothing to commit """
+
+
+class Replay:
+    """ Replays a trace through the gate on a virtual clock
+    speed: 1 for real time, 10 for ten times faster, None to run as fast as possible
+    motor: MotorModel behind the shunt voltage, None to use the recorded shunt voltages
+    poll_interval: time each pass of the gate's shunt reading loop takes
+    """
+    # pylint: disable=too-many-instance-attributes
+    # Lines of a hit message, 'H' and the voltage
+    HIT_LINES = 2
+
+    def __init__(self, path, speed=None, motor="model", poll_interval=0.01):
+        self.path = path
+        self.speed = speed
+        self.motor = MotorModel() if motor == "model" else motor
+        self.clock = None
+        self.gate = None
+        self.job_q = None
+        self.serial = None
+        self.camera = None
+        self.connection = None
+        self.poll_interval = poll_interval
+        self.recorded = {"records": collections.Counter(), "triggers": collections.Counter()}
+        self.events = collections.Counter()
+        self.states = collections.Counter()
+        self.triggers = collections.Counter()
+        self._real_start = None
+
+    def run(self):
+        """ Replay the whole trace and return the report
+        """
+        records = list(read_trace(self.path))
+        if not records:
+            raise ValueError("{} has no records".format(self.path))
+        origin = records[0][0]
+        self.clock = VirtualClock(wall=origin, poll_interval=self.poll_interval)
+        lines = [value for _, kind, value in records if kind == "serial"]
+        self.serial = ReplaySerial(lines)
+        line = 0
+        for wall, kind, value in records:
+            self.recorded["records"][kind] += 1
+            if kind == "trigger":
+                self.recorded["triggers"][value] += 1
+            elif kind == "serial":
+                self.clock.call_at(wall - origin, self._serial, line)
+                line += 1
+            else:
+                self.clock.call_at(wall - origin, getattr(self, "_" + kind), value)
+        with tempfile.TemporaryDirectory(prefix="replay") as workdir, mock.patch.multiple(
+                config, SAVED_MODE_FILE=os.path.join(workdir, "mode.txt"),
+                SERIAL_PORT=os.path.join(workdir, "ttyNONE")):
+            self._run_gate(workdir, records[-1][0] - origin)
+        return self.report()
+
+    def _run_gate(self, workdir, end):
+        """ Run the gate's mode loops until the last record has been replayed and the jobs it
+        left on the queue are done
+        """
+        Device.pin_factory = MockFactory()
+        self.job_q = JobQueue(config.COMMANDS + config.MODES, os.path.join(workdir, "pipe"),
+                              self.clock)
+        self.gate = Gate(self.job_q, StateStore(), self.clock)
+        self.gate.position = 0.0
+        self.gate.current_state = "closed"
+        ArduinoInterface.initialize(self.gate, self.job_q)
+        ArduinoInterface.ser = self.serial
+        database = DB.__new__(DB)
+        self.connection = database.connection = database.cursor = RecordingConnection()
+        database.db_running = True
+        self.camera = CameraModel(self.clock, database)
+        ArduinoInterface.attach(self.camera, database)
+        if self.motor is not None:
+            drive_mock_shunt(self.clock, self.motor, pin_direction(self.gate))
+        if self.speed:
+            self._real_start = time.monotonic()
+            self.clock.add_listener(self._pace)
+        subscription = EventBus.subscribe(size=10000)
+        main.gate, main.job_q = self.gate, self.job_q
+        try:
+            while self.clock.monotonic() < end or not self.job_q.empty():
+                try:
+                    self._mode_loop()
+                except ClockIdle:
+                    break
+                finally:
+                    self._count_events(subscription)
+        finally:
+            EventBus.unsubscribe(subscription)
+            self.job_q.cleanup()
+
+    def _mode_loop(self):
+        """ One pass of the loop for the gate's mode, as in main.py
+        """
+        if self.gate.current_mode.startswith("normal"):
+            main.main_loop()
+        elif self.gate.current_mode == "lock_closed":
+            main.lock_closed_loop(self.gate, self.job_q)
+        elif self.gate.current_mode == "lock_open":
+            main.lock_open_loop(self.gate, self.job_q)
+
+    def _count_events(self, subscription):
+        for event in subscription.get(timeout=0):
+            self.events[event.event_type] += 1
+            if event.event_type == "state":
+                self.states[event.data["state"]] += 1
+            elif event.event_type == "trigger":
+                self.triggers[event.data["source"]] += 1
+
+    def _pace(self):
+        """ Hold the virtual clock back to speed times real time """
+        delay = self._real_start + self.clock.monotonic() / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _frame(self, voltages):
+        for pin, voltage in enumerate(voltages[:len(ArduinoInterface.mock_voltages)]):
+            if self.motor is None or pin != config.SHUNT_PIN:
+                ArduinoInterface.mock_voltages[pin] = round(voltage, ArduinoInterface.precision)
+
+    def _serial(self, line):
+        """ Act on the recorded line from the Arduino, unless it was read as part of a message """
+        if self.serial.position != line:
+            return
+        if self.serial.lines[line] == "H":
+            self.serial.position += self.HIT_LINES
+            return
+        ArduinoInterface.handle_message(self.serial.readline().decode().rstrip())
+
+    def _fifo(self, command):
+        if command not in ("kill", "dump_traces"):
+            self.job_q.handle_fifo(command)
+
+    def _command(self, command):
+        if command == "open":
+            Tracer.trigger("socket")
+        self.job_q.validate_and_put(command)
+
+    def report(self):
+        """ What the trace held and how the gate, the DB writer and the camera queue behaved
+        """
+        counters = self.gate.state_store.state["counters"]
+        return {
+            "trace": {"seconds": round(self.clock.monotonic(), 1),
+                      "records": dict(self.recorded["records"]),
+                      "triggers": dict(self.recorded["triggers"])},
+            "gate": {"cycles": dict(counters), "states": dict(self.states),
+                     "triggers": dict(self.triggers), "stalls": self.events["stall"],
+                     "final_state": self.gate.current_state,
+                     "final_mode": self.gate.current_mode},
+            "db": dict(self.connection.writes),
+            "camera": self.camera.report(),
+        }
+
+
+def compare(report, baseline, prefix=""):
+    """ List the differences between two reports as "key: baseline -> report"
+    """
+    differences = []
+    for key in sorted(set(report) | set(baseline)):
+        name = prefix + str(key)
+        new, old = report.get(key), baseline.get(key)
+        if isinstance(new, dict) and isinstance(old, dict):
+            differences.extend(compare(new, old, name + "."))
+        elif new != old:
+            differences.append("{}: {} -> {}".format(name, old, new))
+    return differences
+
+
+def cli():
+    """ Replay a trace, print the report and compare it with a saved one
+    """
+    parser = argparse.ArgumentParser(description="Replay a recorded trace through the gate")
+    parser.add_argument("trace", help="trace file recorded by the gate")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="times faster than real time, as fast as possible if not given")
+    parser.add_argument("--recorded-shunt", action="store_true",
+                        help="use the recorded shunt voltages instead of the motor model")
+    parser.add_argument("--save", help="write the report to this file")
+    parser.add_argument("--compare", help="report to compare with, exits 1 if they differ")
+    args = parser.parse_args()
+    start = time.monotonic()
+    report = Replay(args.trace, args.speed, None if args.recorded_shunt else "model").run()
+    print(json.dumps(report, indent=2, sort_keys=True))
+    print("Replayed {:.0f}s of gate activity in {:.1f}s".format(
+        report["trace"]["seconds"], time.monotonic() - start))
+    if args.save:
+        with open(args.save, "w") as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            differences = compare(report, json.load(baseline_file))
+        for difference in differences:
+            print("Changed {}".format(difference))
+        if differences:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,230 @@
+""" Module for the internal job scheduler.
+Jobs are kept in a heap ordered by their next deadline and a single thread sleeps on a condition
+variable until the earliest deadline, so there are no wakeups between jobs. Interval and cron like
+(minute/hour) jobs are supported, with optional jitter and a policy for runs that were missed.
+On a virtual clock there is no thread, each deadline is set as a timer on the clock instead.
+"""
+import datetime
+import heapq
+import itertools
+import logging
+import random
+import threading
+
+from clock import SYSTEM_CLOCK
+
+logger = logging.getLogger("root")
+
+
+class Job:
+    """ A scheduled job
+    missed: what to do when the scheduler falls behind by one or more whole periods
+        "run_once" - run the job once then continue from the next deadline in the future
+        "skip" - do not run the late job, continue from the next deadline in the future
+        "catch_up" - run the job once for every missed deadline
+    """
+    # pylint: disable=too-many-instance-attributes
+    __slots__ = ("name", "function", "interval", "minute", "hour", "jitter", "missed",
+                 "deadline", "cancelled", "runs")
+
+    def __init__(self, name, function, **kwargs):
+        self.name = name
+        self.function = function
+        self.interval = kwargs.get("interval")
+        self.minute = kwargs.get("minute")
+        self.hour = kwargs.get("hour")
+        self.jitter = kwargs.get("jitter", 0)
+        self.missed = kwargs.get("missed", "run_once")
+        if self.missed not in ("run_once", "skip", "catch_up"):
+            raise ValueError("Invalid missed run policy: {}".format(self.missed))
+        self.deadline = None
+        self.cancelled = False
+        self.runs = 0
+
+    def period(self):
+        """ Nominal time between runs in seconds
+        """
+        if self.interval is not None:
+            return self.interval
+        return 3600 if self.hour is None else 24 * 3600
+
+    def next_deadline(self, after, clock):
+        """ Monotonic time of the first run after the monotonic time after
+        """
+        if self.interval is not None:
+            deadline = after + self.interval
+        else:
+            # Cron like jobs are due at a wall clock time, convert it to a monotonic deadline
+            wall = datetime.datetime.fromtimestamp(clock.time() + (after - clock.monotonic()))
+            due = wall.replace(minute=self.minute, second=0, microsecond=0)
+            if self.hour is not None:
+                due = due.replace(hour=self.hour)
+            while due <= wall:
+                due += datetime.timedelta(seconds=self.period())
+            deadline = after + (due - wall).total_seconds()
+        return deadline + random.uniform(0, self.jitter)
+
+
+class Scheduler:
+    """ Runs jobs at their deadlines on a single thread.
+    Jobs run one at a time, so they should not block for long.
+    """
+    def __init__(self, clock=SYSTEM_CLOCK):
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def every(self, interval, function, name=None, jitter=0, missed="run_once", delay=None):
+        """ Run function every interval seconds, first after delay seconds (default interval)
+        """
+        # pylint: disable=too-many-arguments
+        job = Job(name or function.__name__, function, interval=interval, jitter=jitter,
+                  missed=missed)
+        start = self.clock.monotonic()
+        first = start + delay if delay is not None else job.next_deadline(start, self.clock)
+        self._push(job, first)
+        return job
+
+    def cron(self, function, minute=0, hour=None, name=None, jitter=0, missed="run_once"):
+        """ Run function at minute past every hour, or at hour:minute every day if hour is given
+        """
+        # pylint: disable=too-many-arguments
+        job = Job(name or function.__name__, function, minute=minute, hour=hour, jitter=jitter,
+                  missed=missed)
+        self._push(job, job.next_deadline(self.clock.monotonic(), self.clock))
+        return job
+
+    def cancel(self, job):
+        """ Stop a job from running again
+        """
+        with self._condition:
+            job.cancelled = True
+            self._condition.notify()
+
+    def reschedule(self, job, interval):
+        """ Change the interval of an interval job, taking effect from now
+        """
+        with self._condition:
+            job.interval = interval
+            job.deadline = job.next_deadline(self.clock.monotonic(), self.clock)
+            self._heap = [(entry_job.deadline, order, entry_job)
+                          for _, order, entry_job in self._heap]
+            heapq.heapify(self._heap)
+            self._condition.notify()
+        if self._running and self._virtual():
+            self.clock.call_at(job.deadline, self._wake)
+
+    def jobs(self):
+        """ List of the scheduled jobs, soonest first
+        """
+        with self._condition:
+            return [job for _, _, job in sorted(self._heap) if not job.cancelled]
+
+    def _push(self, job, deadline):
+        with self._condition:
+            job.deadline = deadline
+            heapq.heappush(self._heap, (deadline, next(self._counter), job))
+            self._condition.notify()
+        if self._running and self._virtual():
+            self.clock.call_at(deadline, self._wake)
+
+    def _virtual(self):
+        return getattr(self.clock, "virtual", False)
+
+    def _wake(self):
+        """ Timer on a virtual clock, runs the jobs that are due """
+        if self._running:
+            self.run_pending()
+
+    def start(self):
+        """ Start the scheduler thread, or set timers for the jobs on a virtual clock
+        """
+        self._running = True
+        if self._virtual():
+            for deadline, _, _ in self._heap:
+                self.clock.call_at(deadline, self._wake)
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the scheduler thread once the running job has finished
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _next_due(self):
+        """ Wait until a job is due and return it, or None if the scheduler was stopped
+        """
+        with self._condition:
+            while self._running:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                deadline, _, job = self._heap[0]
+                now = self.clock.monotonic()
+                if deadline > now:
+                    self._condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self._heap)
+                return job, now
+            return None
+
+    def run_pending(self):
+        """ Run every job that is due now without the scheduler thread, returns the number of runs.
+        This is for tests and simulations that control the clock.
+        """
+        runs = 0
+        while True:
+            with self._condition:
+                if not self._heap or self._heap[0][0] > self.clock.monotonic():
+                    return runs
+                _, _, job = heapq.heappop(self._heap)
+                now = self.clock.monotonic()
+            if not job.cancelled:
+                runs += self._run_job(job, now)
+
+    def _run(self):
+        while True:
+            due = self._next_due()
+            if due is None:
+                return
+            self._run_job(*due)
+
+    def _run_job(self, job, now):
+        """ Run a due job according to its missed run policy and schedule its next run
+        """
+        missed = int((now - job.deadline) // job.period())
+        if missed < 1 or job.missed == "run_once":
+            count = 1
+        elif job.missed == "skip":
+            count = 0
+            logger.debug("Skipping late run of scheduled job %s", job.name)
+        else:
+            count = missed + 1
+        for _ in range(count):
+            try:
+                job.function()
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning("Scheduled job %s failed: %s", job.name, err)
+            job.runs += 1
+        if not job.cancelled:
+            self._push(job, job.next_deadline(self._next_base(job), self.clock))
+        return count
+
+    def _next_base(self, job):
+        """ Time to schedule the next run from. Interval jobs keep to their original cadence unless
+        they have fallen behind, cron like jobs are always due at the next matching time
+        """
+        now = self.clock.monotonic()
+        if job.interval is not None and job.deadline + job.interval > now:
+            return job.deadline
+        return now
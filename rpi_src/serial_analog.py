@@ -1,27 +1,70 @@
 """ Module to communicate with Arduino
 """
+import glob
 import logging
 import datetime
 import time
 import queue
+import termios
 import threading
 import serial
+import firmware
 from config import Config as config
+from events import EventBus
+from log_storage import LogStorage
+from metrics import Metrics
+from recorder import Recorder
+from tracing import Tracer
 
 logger = logging.getLogger("root")
 
+SERIAL_ROUND_TRIP = Metrics.histogram(
+    "serial_round_trip_seconds", "Time from requesting voltages until all values are received")
+SERIAL_ERRORS = Metrics.counter(
+    "serial_errors", "Voltage requests that timed out or failed the checksum")
+SERIAL_RECONNECTS = Metrics.counter(
+    "serial_reconnects", "Times the Arduino link was lost and restored")
+
 class ArduinoInterfaceError(Exception):
     """ Class of errors to be raised if something goes wrong with the serial ardiuno interface
     """
 
 class ArduinoInterface:
     """ Class to manage the communication with the arduino.
-    The arduino is presumed to be plugged into /dev/ttyUSB0 and serial is enabled on the RPi
+    The arduino is presumed to be plugged into the serial_port in conf.ini (/dev/ttyUSB* by
+    default, or the emulator's pty) and serial is enabled on the RPi
     The arduino then takes the analog readings and sends them over serial upon recieveing a packet,
     from the RPi
 
-    The handshake must be called prior to any values being returned
+    The handshake must be called prior to any values being returned.
+    If the link drops or stalls the serial thread reopens the port and resyncs with the arduino,
+    voltage requests fail straight away until it is back.
     """
+    RECONNECT_INTERVAL = 1
+    # Longest wait for the arduino to answer after reconnecting, long enough for it to reset
+    SYNC_TIMEOUT = 5
+    # Consecutive voltage requests that time out before the link is treated as stalled
+    STALL_ERRORS = 3
+    # Default deadline for each attempt at a voltage request and the number of requests sent again
+    # after the first times out, a request never takes longer than READ_TIMEOUT * (READ_RETRIES + 1)
+    READ_TIMEOUT = 0.2
+    READ_RETRIES = 1
+    # Sketches from before the firmware hash was added don't answer the query
+    FIRMWARE_QUERY_TIMEOUT = 1
+    # Most recent voltages received and the monotonic time they were received
+    last_voltages = None
+    last_voltages_time = None
+    link_up = True
+    port = None
+    # Hash of the sketch the arduino is running, None if it didn't say
+    firmware_hash = None
+    # The gate and the battery sampler both request voltages, only one request can be in flight
+    _request_lock = threading.Lock()
+    _failed_requests = 0
+    _resync_requested = False
+    _down_since = None
+    _running = False
+    _thread = None
 
     @classmethod
     def initialize(cls, gate=None, job_q=None, cam=None, entry_db=None):
@@ -33,13 +76,10 @@ class ArduinoInterface:
 
         # Create a class rotating file logger for all arduino messages
         cls.arduino_logger = logging.getLogger(__name__)
-        cls.arduino_logger.setLevel(logging.DEBUG)
-        file_handler = logging.handlers.TimedRotatingFileHandler(
-            config.ARDUINO_LOG, when="W0", backupCount=50
-        )
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(logging.Formatter("%(asctime)s : %(message)s"))
-        cls.arduino_logger.addHandler(file_handler)
+        cls.arduino_logger.setLevel(config.ARDUINO_LOG_LEVEL)
+        if not cls.arduino_logger.handlers:
+            cls.arduino_logger.addHandler(LogStorage.file_handler(
+                config.ARDUINO_LOG, logging.DEBUG, "%(asctime)s : %(message)s"))
 
         # Number of analog channels on the arduino
         cls.number_of_inputs = 6
@@ -47,59 +87,164 @@ class ArduinoInterface:
         cls.precision = 4
         cls.mock_mode = False
         cls.handshake_lock = False
+        cls.last_voltages = None
+        cls.last_voltages_time = None
+        cls.link_up = True
+        cls._failed_requests = 0
+        cls._resync_requested = False
+        cls._running = True
         # Give cls.read_serial access to the global job_q
         if job_q is not None:
             cls.job_q = job_q
         else:
             logger.warning("Job Queue was not passed to ArduinoInterface,\
 Arduino will not be able to trigger the gate opening")
+        cls.arduino_queue = queue.Queue()
+        # The camera and db may still be starting up, they are attached when ready
+        cls.attach(cam, entry_db)
         # Initiate the serial connection
         try:
-            cls.ser = serial.Serial("/dev/ttyUSB0", baudrate=115200, timeout=1)
+            cls.ser = cls._open_port()
             cls.ser.flush()
+            cls._keep_arduino_running()
             # Start the serial thread
             cls.handshake()
-            threading.Thread(target=cls.read_serial, daemon=True).start()
+            cls._check_firmware()
+            cls._thread = threading.Thread(target=cls.read_serial, daemon=True)
+            cls._thread.start()
         except serial.serialutil.SerialException as error:
             logger.warning("Serial device not found: %s", error)
             logger.info("Entering mock analog mode")
             cls.mock_mode = True
             cls.mock_voltages = [0] * cls.number_of_inputs
             cls.handshake()
-        cls.arduino_queue = queue.Queue()
+
+    @classmethod
+    def attach(cls, cam=None, entry_db=None):
+        """ Give the class access to the camera queue and the db, entries are not logged to the
+        db until it is attached
+        """
         cls.camera_queue = cam.camera_q if cam is not None else None
-        # Give class access to the db
-        cls.db = entry_db if entry_db is not None else \
-                logger.warning("DB was not passed to ArduinoInterface")
+        cls.db = entry_db
 
     @classmethod
-    def get_analog_voltages(cls, index="all"):
+    def _open_port(cls):
+        """ Open the first serial device that matches the serial_port pattern, the arduino can come
+        back as a different ttyUSB device after being unplugged
+        """
+        ports = sorted(glob.glob(config.SERIAL_PORT))
+        if not ports:
+            raise serial.serialutil.SerialException(
+                "No serial device matches {}".format(config.SERIAL_PORT))
+        error = None
+        for port in ports:
+            try:
+                ser = serial.Serial(port, baudrate=115200, timeout=1)
+            except serial.serialutil.SerialException as err:
+                error = err
+                continue
+            cls.port = port
+            return ser
+        raise error
+
+    @classmethod
+    def _keep_arduino_running(cls):
+        """ Stop the port dropping DTR when it is closed. Dropping DTR resets the Arduino, so
+        without this every restart of the gate would wait for the Arduino to reboot before the
+        handshake
+        """
+        try:
+            attributes = termios.tcgetattr(cls.ser.fileno())
+            attributes[2] &= ~termios.HUPCL
+            termios.tcsetattr(cls.ser.fileno(), termios.TCSANOW, attributes)
+        except (termios.error, OSError) as err:
+            logger.debug("Could not clear HUPCL on the serial port: %s", err)
+
+    @classmethod
+    def get_analog_voltages(cls, index="all", timeout=None, retries=None):
         """ Get the voltage message from the arduino and return that value specified by index
         index: should be an integer to specify which analog pin value to return
+        timeout: seconds to wait for all the values of each attempt (default READ_TIMEOUT)
+        retries: attempts after the first times out (default READ_RETRIES)
+        Raises ArduinoInterfaceError if every attempt times out
         """
         if not cls.handshake_lock:
             raise ValueError("Serial Handshake has not been initiated")
+        if not cls.link_up:
+            raise ArduinoInterfaceError("The Arduino link is down")
 
         if cls.mock_mode:
+            cls._update_last_voltages(cls.mock_voltages)
             if index == "all":
                 return cls.mock_voltages
             return cls.mock_voltages[index]
 
-        # Request serial package from arduino by sending capital V
+        timeout = cls.READ_TIMEOUT if timeout is None else timeout
+        retries = cls.READ_RETRIES if retries is None else retries
+        with cls._request_lock:
+            for _ in range(retries + 1):
+                voltages = cls._request_voltages(timeout)
+                if voltages is not None:
+                    break
+                SERIAL_ERRORS.inc()
+            else:
+                cls._failed_requests += 1
+                if cls._failed_requests >= cls.STALL_ERRORS:
+                    # The serial thread resyncs the link
+                    cls._resync_requested = True
+                raise ArduinoInterfaceError(
+                    "No voltages from the Arduino within {}s".format(timeout * (retries + 1)))
+            cls._failed_requests = 0
+            cls._update_last_voltages(voltages)
+        if index == "all":
+            return voltages
+        return voltages[index]
+
+    @classmethod
+    def _request_voltages(cls, timeout):
+        """ Request serial package from arduino by sending capital V, returns None if all the
+        values did not arrive within timeout seconds
+        """
+        # Values left by a request that timed out would be taken as part of this one
+        while not cls.arduino_queue.empty():
+            cls.arduino_queue.get_nowait()
+        start = time.monotonic()
+        deadline = start + timeout
         cls.ser.write("V".encode())
+        voltages = []
         try:
-            voltages = [cls.arduino_queue.get(timeout=0.5) for _ in range(cls.number_of_inputs)]
-            if index == "all":
-                return voltages
-            return voltages[index]
+            for _ in range(cls.number_of_inputs):
+                voltages.append(cls.arduino_queue.get(timeout=max(0, deadline - time.monotonic())))
         except queue.Empty:
-            raise ArduinoInterfaceError('Arduino Queue was empty when trying to get voltages') \
-                    from None
+            return None
+        SERIAL_ROUND_TRIP.observe(time.monotonic() - start)
+        return voltages
+
+    @classmethod
+    def _update_last_voltages(cls, voltages):
+        """ Keep the most recent voltages so status queries don't need a serial round trip
+        """
+        cls.last_voltages = list(voltages)
+        cls.last_voltages_time = time.monotonic()
+
+    @classmethod
+    def recent_voltages(cls, max_age):
+        """ Voltages received within the last max_age seconds, or None if there are none.
+        Lets periodic readers share the readings the gate is already taking instead of adding
+        serial round trips.
+        """
+        voltages, received = cls.last_voltages, cls.last_voltages_time
+        if voltages is None or time.monotonic() - received > max_age:
+            return None
+        return voltages
 
     @classmethod
     def handshake(cls):
         """ Performes a serial handshake with the Arduino by waiting for an 'A',
         then confirms handshake by send an 'A' back.
+        A voltage request is sent first as a probe. An Arduino that is already running (the gate
+        restarted without resetting it) answers with voltages, so there is no need to wait for a
+        reset, and one waiting to handshake takes it as the reply and asks for the button pins.
         Handshake must be called prior to getting any values
         """
         if cls.handshake_lock:
@@ -110,45 +255,219 @@ Arduino will not be able to trigger the gate opening")
             cls.handshake_lock = True
             return
 
-        while cls.ser.readline().decode("ascii").rstrip() != "A":
-            logger.debug("Waiting for serial handshake")
-            time.sleep(0.1)
-        cls.ser.write("A".encode())
+        cls._sync()
         logger.info("Serial handshake achieved")
         cls.handshake_lock = True
 
+    @classmethod
+    def _sync(cls, deadline=None):
+        """ Probe the arduino with a voltage request and answer whatever it is waiting for.
+        Returns False if there was no answer by the monotonic time deadline (never if None)
+        """
+        cls.ser.write("V".encode())
+        while deadline is None or time.monotonic() < deadline:
+            line = cls.ser.readline().decode("ascii", errors="replace").rstrip()
+            if line == "A":
+                # The firmware hash follows each 'A'
+                cls.firmware_hash = cls._read_hash()
+                cls.ser.write("A".encode())
+                return True
+            if line == "V":
+                # Already running, discard the voltages and checksum
+                for _ in range(cls.number_of_inputs + 1):
+                    cls.ser.readline()
+                logger.info("Arduino was already running")
+                cls._query_firmware()
+                cls._send_oversampling()
+                return True
+            if line == "B":
+                cls._arduino_requesting_buttons()
+                cls._query_firmware()
+                return True
+            logger.debug("Waiting for serial handshake")
+        return False
+
+    @classmethod
+    def _read_hash(cls):
+        """ Read the firmware hash line, None if the sketch sent something else
+        """
+        line = cls.ser.readline().decode("ascii", errors="replace").rstrip()
+        return line if line not in ("", "A", "B", "V") else None
+
+    @classmethod
+    def _query_firmware(cls):
+        """ Ask a running arduino for its firmware hash
+        """
+        cls.firmware_hash = None
+        cls.ser.write("F".encode())
+        deadline = time.monotonic() + cls.FIRMWARE_QUERY_TIMEOUT
+        while time.monotonic() < deadline:
+            if cls.ser.readline().decode("ascii", errors="replace").rstrip() == "F":
+                cls.firmware_hash = cls._read_hash()
+                return
+        logger.info("Arduino did not report a firmware hash")
+
+    @classmethod
+    def _check_firmware(cls):
+        """ Upload the bundled sketch if the arduino is running a different one, then handshake
+        with the new sketch
+        """
+        bundled = firmware.sketch_hash()
+        if bundled is None or cls.firmware_hash == bundled:
+            logger.info("Arduino firmware: %s", cls.firmware_hash)
+            return
+        logger.warning("Arduino firmware %s is not the bundled sketch %s",
+                       cls.firmware_hash, bundled)
+        if not firmware.can_flash():
+            logger.warning("arduino-cli is not installed, the sketch can't be uploaded")
+            return
+        cls.ser.close()
+        uploaded = firmware.flash(cls.port)
+        cls.ser = cls._open_port()
+        cls._keep_arduino_running()
+        cls._sync()
+        if uploaded and cls.firmware_hash != bundled:
+            logger.error("Arduino reports firmware %s after uploading %s", cls.firmware_hash,
+                         bundled)
+        elif uploaded:
+            logger.info("Uploaded Arduino firmware %s", bundled)
+
     @classmethod
     def read_serial(cls):
         """ Indefinite serial reading
         This is done with a blocking command to reduce cpu usage.
         """
-        while True:
+        while cls._running:
             # Catch serial errors
             try:
+                if cls._resync_requested:
+                    cls._recover("voltage requests are timing out", reopen=False)
                 cls.ser.timeout = 1
-                data = cls.ser.readline().decode("ascii").rstrip()
-                if data == 'V':
-                    # Arduino is sending analog voltages
-                    cls._arduino_receive_voltages()
-
-                elif data == 'O':
-                    # Arduino has requested the gate to open
-                    cls.arduino_logger.debug(data)
-                    cls._arduino_receive_trigger()
-
-                elif data == 'R':
-                    # Arduino is requesting the 433MHz radio secret key
-                    cls.arduino_logger.debug(data)
-                    cls._arduino_requesting_radiokey()
-
-                elif data == 'B':
-                    # Arduino is requesting the button pins
-                    cls.arduino_logger.debug(data)
-                    cls._arduino_requesting_buttons()
+                data = cls._readline(record=False)
+                cls._handle_line(data)
 
-            except serial.serialutil.SerialException as err:
-                logger.critical('Shutting down gate due to serial error %s', err)
-                return
+            except (serial.serialutil.SerialException, OSError) as err:
+                if not cls._running:
+                    return
+                cls._recover(err)
+
+    @classmethod
+    def _handle_line(cls, data):
+        """ Act on a line read by the serial thread. Port errors are raised for read_serial to
+        recover the link, any other error is logged so the serial thread keeps running
+        """
+        try:
+            if data == 'V':
+                # Arduino is sending analog voltages
+                cls._arduino_receive_voltages()
+            elif data:
+                Recorder.serial(data)
+                cls.handle_message(data)
+        except (serial.serialutil.SerialException, OSError):
+            raise
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error("Failed to handle the Arduino message %r: %s", data, err)
+
+    @classmethod
+    def _readline(cls, record=True):
+        """ Read a line from the Arduino, recorded to the trace if record is set
+        """
+        line = cls.ser.readline().decode("ascii", errors="replace").rstrip()
+        if record and line:
+            Recorder.serial(line)
+        return line
+
+    @classmethod
+    def handle_message(cls, data):
+        """ Act on a message line from the Arduino, other than a voltage frame. Any lines that
+        follow it are read from the serial port
+        """
+        if data == 'O':
+            # Arduino has requested the gate to open
+            cls.arduino_logger.debug(data)
+            cls._arduino_receive_trigger()
+
+        elif data == 'R':
+            # Arduino is requesting the 433MHz radio secret key
+            cls.arduino_logger.debug(data)
+            cls._arduino_requesting_radiokey()
+
+        elif data == 'B':
+            # Arduino is requesting the button pins
+            cls.arduino_logger.debug(data)
+            cls._arduino_requesting_buttons()
+
+        elif data == 'H':
+            # Arduino has seen the shunt voltage cross the hit threshold
+            cls.arduino_logger.debug(data)
+            cls._arduino_receive_hit()
+
+    @classmethod
+    def stop(cls):
+        """ Stop the serial thread and close the port
+        """
+        cls._running = False
+        if cls._thread is not None:
+            cls._thread.join(timeout=5)
+            cls._thread = None
+        if not cls.mock_mode:
+            try:
+                cls.ser.close()
+            except (serial.serialutil.SerialException, OSError):
+                pass
+
+    @classmethod
+    def _recover(cls, reason, reopen=True):
+        """ Take the link down and bring it back, retrying until the arduino answers.
+        A stalled link is first resynced on the open port, a failed one is reopened
+        """
+        cls.link_up = False
+        cls._down_since = time.monotonic()
+        logger.critical("Arduino link lost: %s", reason)
+        EventBus.publish("link", up=False, reason=str(reason))
+        cls._resync_requested = False
+        synced = False
+        if not reopen:
+            try:
+                cls.ser.flushInput()
+                synced = cls._sync(time.monotonic() + cls.SYNC_TIMEOUT)
+            except (serial.serialutil.SerialException, OSError) as err:
+                logger.debug("Resync failed: %s", err)
+        while not synced and cls._running:
+            try:
+                cls.ser.close()
+            except (serial.serialutil.SerialException, OSError):
+                pass
+            time.sleep(cls.RECONNECT_INTERVAL)
+            try:
+                cls.ser = cls._open_port()
+                cls._keep_arduino_running()
+                cls.ser.flushInput()
+                synced = cls._sync(time.monotonic() + cls.SYNC_TIMEOUT)
+            except (serial.serialutil.SerialException, OSError) as err:
+                logger.debug("Reconnecting to the Arduino failed: %s", err)
+        if synced:
+            cls._link_restored()
+
+    @classmethod
+    def _link_restored(cls):
+        """ Mark the link as up again and finish a gate cycle that was stopped when it went down
+        """
+        # Voltages from before the link went down are stale
+        while not cls.arduino_queue.empty():
+            cls.arduino_queue.get_nowait()
+        cls._failed_requests = 0
+        cls.link_up = True
+        SERIAL_RECONNECTS.inc()
+        downtime = time.monotonic() - cls._down_since
+        logger.warning("Arduino link restored on %s after %.1fs", cls.port, downtime)
+        EventBus.publish("link", up=True, port=cls.port, downtime=round(downtime, 3))
+        gate = cls.gate
+        if gate is not None and gate.current_state.endswith("link error"):
+            logger.info("Finishing the gate cycle that was stopped by the link going down")
+            # A lock mode moves the gate into position again when the mode is sent again
+            cls.job_q.validate_and_put(
+                "open" if gate.current_mode.startswith("normal") else gate.current_mode)
 
     @classmethod
     def _arduino_receive_voltages(cls):
@@ -158,21 +477,23 @@ Arduino will not be able to trigger the gate opening")
         # Remove serial timeout so it doesn't hang in here
         cls.ser.timeout = 0
         # Arduino is sending analog voltages, collect and put on queue
-        voltages = [cls.ser.readline().decode("ascii").rstrip()
-                    for _ in range(cls.number_of_inputs)]
-        checksum = cls.ser.readline().decode("ascii").rstrip()
+        # Line noise can garble the values, they then fail the float conversion or the checksum
+        voltages = [cls._readline(record=False) for _ in range(cls.number_of_inputs)]
+        checksum = cls._readline(record=False)
         try:
             # Check that the voltages are valid floats
             voltages = [float(voltage) for voltage in voltages]
             checksum = float(checksum)
             # Check that the voltage checksum matches the data received
             if round(sum(voltages), cls.precision) == checksum:
+                Recorder.frame(voltages)
                 for voltage in voltages:
                     cls.arduino_queue.put(voltage)
             else:
                 raise ValueError("Sum of voltages {} does not match checksum {}".format(
                     sum(voltages), checksum))
         except ValueError as err:
+            SERIAL_ERRORS.inc()
             logger.warning(err)
             time.sleep(0.001)
             cls.ser.flushInput()
@@ -180,16 +501,55 @@ Arduino will not be able to trigger the gate opening")
             cls.ser.write("V".encode())
         cls.ser.timeout = 1
 
+    @classmethod
+    def arm_hit_detection(cls, pin, threshold, blanking):
+        """ Have the arduino watch the voltage on pin and send a hit event as soon as it goes over
+        threshold, ignoring the first blanking seconds for the motor start up spike
+        """
+        cls._send_command("T{} {:.4f} {}\n".format(pin, threshold, int(blanking * 1000)))
+
+    @classmethod
+    def disarm_hit_detection(cls):
+        """ Stop the arduino watching for a hit
+        """
+        cls._send_command("X")
+
+    @classmethod
+    def _send_command(cls, command):
+        """ Send a command that has no reply, commands are not sent while the link is down
+        """
+        if cls.mock_mode or not cls.link_up:
+            return
+        with cls._request_lock:
+            try:
+                cls.ser.write(command.encode())
+            except (serial.serialutil.SerialException, OSError) as err:
+                logger.debug("Failed to send %s to the Arduino: %s", command.strip(), err)
+
+    @classmethod
+    def _arduino_receive_hit(cls):
+        """ Arduino has seen the hit threshold crossed, the gate stops the motor straight away
+        """
+        message = cls._readline()
+        try:
+            voltage = float(message)
+        except ValueError:
+            voltage = float("nan")
+        cls.arduino_logger.info("Hit threshold crossed: %s", message)
+        if cls.gate is not None:
+            cls.gate.arduino_hit(voltage)
+
     @classmethod
     def _arduino_receive_trigger(cls):
         """ Arduino has sent a request to open the gate. This method handles the serial and
         logging of either the button or 433MHz radio that triggered the Arduino.
         """
         # pylint: disable=too-many-branches
-        message = cls.ser.readline().decode("ascii").rstrip()
+        Tracer.trigger("arduino")
+        message = cls._readline()
         message_dt = datetime.datetime.now()
         logger.debug("Arduino: %s", message)
-        cls.arduino_logger.debug(message)
+        cls.arduino_logger.info(message)
         # Check what button triggered the arduino and send email if in away mode
         try:
             pin = int(message)
@@ -221,7 +581,9 @@ Arduino will not be able to trigger the gate opening")
                 button = "unknown"
                 logger.warning("Unknown button pressed")
             cls.job_q.validate_and_put('open')
-            cls.db.add_entry(button, message_dt)
+            EventBus.publish("entry", button=button, time=message_dt.isoformat())
+            if cls.db is not None:
+                cls.db.add_entry(button, message_dt)
         except AttributeError:
             logger.debug("Arduino tried to open gate, but didn't have access to queue")
         except ValueError:
@@ -253,3 +615,11 @@ Arduino will not be able to trigger the gate opening")
         logger.debug("Finished sending button pins to Arduino")
         # Arduino expects to get a "B" back when all button pins are sent
         cls.ser.write("B".encode())
+        cls._send_oversampling()
+
+    @classmethod
+    def _send_oversampling(cls):
+        """ Set the number of samples the arduino takes the median of for each voltage, only once
+        it is past the handshake, before then the digits would be taken as button pins
+        """
+        cls.ser.write("D{}\n".format(config.ADC_OVERSAMPLING).encode())
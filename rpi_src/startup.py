@@ -0,0 +1,93 @@
+""" Module to time the phases of start up.
+Each phase is timed from when the process started, including phases run in parallel on other
+threads, and the report shows where the time went and when the gate was ready to open.
+"""
+import os
+import threading
+import time
+
+from metrics import Metrics
+
+STARTUP_TIME = Metrics.gauge(
+    "startup_seconds", "Time from the process starting until the gate was ready to open")
+
+
+def _process_start():
+    """ Monotonic time the process started (both count from boot on Linux), or now if it can't be
+    read, so the interpreter start up is included
+    """
+    now = time.monotonic()
+    try:
+        with open("/proc/self/stat") as stat:
+            # Fields after the command name, the start time is field 22 of the whole line
+            fields = stat.read().rsplit(")", 1)[1].split()
+        start = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return now
+    return start if 0 <= now - start < 60 else now
+
+
+class StartupProfiler:
+    """ Records (name, start, duration) of each start up phase relative to the process start
+    """
+    origin = _process_start()
+    phases = []
+    ready_at = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def phase(cls, name):
+        """ Context manager that times a phase
+        """
+        return _Phase(cls, name)
+
+    @classmethod
+    def timed(cls, name, function, *args):
+        """ Call function(*args) as a timed phase, for running phases in a thread pool
+        """
+        with cls.phase(name):
+            return function(*args)
+
+    @classmethod
+    def record(cls, name, start, end):
+        """ Record a phase that ran from monotonic time start to end
+        """
+        with cls._lock:
+            cls.phases.append((name, start - cls.origin, end - start))
+
+    @classmethod
+    def ready(cls):
+        """ Record that the gate can now open
+        """
+        cls.ready_at = time.monotonic() - cls.origin
+        STARTUP_TIME.set(cls.ready_at)
+
+    @classmethod
+    def report(cls):
+        """ Text table of the phases ordered by start time
+        """
+        with cls._lock:
+            phases = sorted(cls.phases, key=lambda phase: phase[1])
+        lines = ["Startup phases (seconds since start):"]
+        for name, start, duration in phases:
+            lines.append("  {:<16} {:>7.3f} +{:.3f}".format(name, start, duration))
+        if cls.ready_at is not None:
+            lines.append("  {:<16} {:>7.3f}".format("ready to open", cls.ready_at))
+        return "\n".join(lines)
+
+
+class _Phase:
+    """ Times the body of a with statement
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.monotonic())
@@ -0,0 +1,104 @@
+""" Module to keep the runtime state of the gate on disk.
+The state (last known gate state, estimated position, the command in progress, cycle counters and
+the learned travel times) is written to a temporary file which is then renamed over the old one, so
+a crash or power cut leaves either the old or the new state on disk, never a partial file.
+"""
+import copy
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("root")
+
+
+def atomic_write(path, text):
+    """ Replace the contents of path with text, the file is never left half written
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as temp_file:
+        temp_file.write(text)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+    # Make the rename itself durable
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class StateStore:
+    """ Gate runtime state that survives a restart, only kept in memory if there is no path
+    """
+    VERSION = 1
+    DEFAULT = {
+        "version": VERSION,
+        # Gate state and estimated position (0 closed, 1 open, None if not known)
+        "state": "unknown",
+        "position": None,
+        # "open" or "close" while a gate cycle is in progress
+        "in_flight": None,
+        "counters": {"opened": 0, "closed": 0, "hits": 0, "timeouts": 0},
+        # Learned full travel times in seconds
+        "calibration": {"open": None, "close": None},
+        "saved_at": None,
+    }
+
+    def __init__(self, path=None):
+        self.path = path
+        self.state = self.load()
+
+    def load(self):
+        """ Read the saved state, the defaults are used for anything missing or unreadable
+        """
+        state = copy.deepcopy(self.DEFAULT)
+        if self.path is None:
+            return state
+        try:
+            with open(self.path, "r") as state_file:
+                saved = json.load(state_file)
+        except FileNotFoundError:
+            logger.info("No saved gate state found")
+            return state
+        except (OSError, ValueError) as err:
+            logger.warning("Saved gate state could not be read: %s", err)
+            return state
+        if not isinstance(saved, dict) or saved.get("version") != self.VERSION:
+            logger.warning("Ignoring saved gate state with unknown version")
+            return state
+        for key in ("counters", "calibration"):
+            if isinstance(saved.get(key), dict):
+                state[key].update(saved.pop(key))
+        state.update({key: value for key, value in saved.items() if key in state})
+        return state
+
+    def count(self, name):
+        """ Increment a counter, it is saved with the next update
+        """
+        self.state["counters"][name] = self.state["counters"].get(name, 0) + 1
+
+    def calibrate(self, phase, travel_time, weight=0.2):
+        """ Blend a measured full travel time into the learned travel time of the phase
+        """
+        learned = self.state["calibration"].get(phase)
+        self.state["calibration"][phase] = round(
+            travel_time if learned is None else learned + weight * (travel_time - learned), 3)
+
+    def update(self, **fields):
+        """ Change some of the state and save it
+        """
+        self.state.update(fields)
+        self.save()
+
+    def save(self):
+        """ Write the state to disk
+        """
+        if self.path is None:
+            return
+        self.state["saved_at"] = time.time()
+        try:
+            atomic_write(self.path, json.dumps(self.state))
+        except OSError as err:
+            logger.error("Failed to save the gate state: %s", err)
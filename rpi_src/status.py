@@ -0,0 +1,90 @@
+""" Module for the in memory status snapshot.
+The snapshot is kept current from the event bus and the values the other modules already hold, so
+building it never touches the serial port, the DB or the disk and it is safe to poll frequently.
+"""
+import json
+import time
+
+from config import Config as config
+from events import EventBus
+from serial_analog import ArduinoInterface
+
+
+class StatusSnapshot:
+    """ Always current summary of the gate status
+    """
+    start_time = time.monotonic()
+    gate = None
+    job_q = None
+    camera_q = None
+    last_entry = None
+    last_cycle = None
+    last_battery = None
+    last_alert = None
+    power = None
+
+    @classmethod
+    def initialize(cls, gate, job_q, cam=None):
+        """ Give the snapshot access to the gate and queues and start following events
+        """
+        cls.gate = gate
+        cls.job_q = job_q
+        cls.camera_q = cam.camera_q if cam is not None else None
+        EventBus.add_listener(cls._on_event)
+
+    @classmethod
+    def _on_event(cls, event):
+        """ Keep the most recent event of each interesting type
+        """
+        summary = dict(event.data, time=event.timestamp)
+        if event.event_type == "entry":
+            cls.last_entry = summary
+        elif event.event_type == "cycle":
+            cls.last_cycle = summary
+        elif event.event_type == "battery":
+            cls.last_battery = summary
+        elif event.event_type == "alert":
+            cls.last_alert = summary
+        elif event.event_type == "power":
+            cls.power = summary
+
+    @staticmethod
+    def _voltages(now):
+        """ Most recent analog voltages and their age in seconds
+        """
+        voltages = ArduinoInterface.last_voltages
+        if voltages is None:
+            return None
+        # pylint: disable=unsubscriptable-object
+        return {"shunt": voltages[config.SHUNT_PIN],
+                "battery": voltages[config.BATTERY_VOLTAGE_PIN],
+                "age": round(now - ArduinoInterface.last_voltages_time, 3)}
+
+    @classmethod
+    def render(cls):
+        """ Build the snapshot as a dictionary
+        """
+        now = time.monotonic()
+        return {
+            "mode": cls.gate.current_mode if cls.gate is not None else None,
+            "state": cls.gate.current_state if cls.gate is not None else None,
+            "voltages": cls._voltages(now),
+            "arduino_link": {"up": ArduinoInterface.link_up, "port": ArduinoInterface.port},
+            "last_battery": cls.last_battery,
+            "last_entry": cls.last_entry,
+            "last_cycle": cls.last_cycle,
+            "last_alert": cls.last_alert,
+            "power": cls.power,
+            "uptime": round(now - cls.start_time, 3),
+            "queues": {
+                "jobs": cls.job_q.qsize() if cls.job_q is not None else None,
+                "camera": cls.camera_q.qsize() if cls.camera_q is not None else None,
+                "log": config.log_queue_handler.queue.qsize(),
+            },
+        }
+
+    @classmethod
+    def render_json(cls):
+        """ Build the snapshot as JSON
+        """
+        return json.dumps(cls.render())
@@ -0,0 +1,162 @@
+""" Unit tests for the email alert handler, using a stand-in for the SMTP server
+"""
+import glob
+import logging
+import os
+import smtplib
+import time
+
+from alerts import AlertHandler
+
+
+class FakeSMTP:
+    """ Stand-in for smtplib.SMTP that records the emails sent and can simulate an outage
+    """
+    sent = []
+    connections = 0
+    available = True
+    # Emails containing this text are refused by the server
+    refuse = None
+
+    def __init__(self, host, port, timeout=None):
+        # pylint: disable=unused-argument
+        if not FakeSMTP.available:
+            raise OSError("Connection refused")
+        FakeSMTP.connections += 1
+
+    def ehlo(self):
+        """ Stand-in """
+
+    def starttls(self):
+        """ Stand-in """
+
+    def login(self, user, key):
+        """ Stand-in """
+
+    def noop(self):
+        """ Stand-in """
+        if not FakeSMTP.available:
+            raise OSError("Connection lost")
+
+    def quit(self):
+        """ Stand-in """
+
+    @staticmethod
+    def sendmail(fromaddr, toaddrs, raw):
+        """ Record the email """
+        # pylint: disable=unused-argument
+        if FakeSMTP.refuse is not None and FakeSMTP.refuse in raw.decode():
+            raise smtplib.SMTPDataError(554, b"Message rejected")
+        FakeSMTP.sent.append(raw.decode())
+
+    @classmethod
+    def reset(cls):
+        """ Clear the recorded emails """
+        cls.sent = []
+        cls.connections = 0
+        cls.available = True
+        cls.refuse = None
+
+
+def _alert_logger(tmp_path, name, **kwargs):
+    """ Create a logger that only sends to an AlertHandler using FakeSMTP
+    """
+    handler = AlertHandler(("localhost", 25), "gate@example.com", ["me@example.com"], "GATE",
+                           ("id", "key"), os.path.join(str(tmp_path), "spool"),
+                           smtp_factory=FakeSMTP, **kwargs)
+    handler.setLevel(logging.WARNING)
+    alert_logger = logging.getLogger(name)
+    alert_logger.propagate = False
+    alert_logger.addHandler(handler)
+    return alert_logger, handler
+
+
+def test_digest_and_dedupe(tmp_path):
+    """ Test warnings are collected into one digest with repeats suppressed, and critical alerts
+    are sent straight away over the same session
+    """
+    logging.disable(logging.NOTSET)
+    FakeSMTP.reset()
+    alert_logger, handler = _alert_logger(tmp_path, "test_alerts_digest", digest_interval=60)
+    for _ in range(5):
+        alert_logger.warning("Outside button pressed")
+    alert_logger.warning("Inside button pressed")
+    alert_logger.critical("Open security timer has elapsed")
+    handler.close()
+    logging.disable(level=logging.CRITICAL)
+
+    assert len(FakeSMTP.sent) == 2
+    assert "Open security timer has elapsed" in FakeSMTP.sent[0]
+    digest = FakeSMTP.sent[1]
+    assert "GATE (3 alerts)" in digest
+    assert digest.count("Outside button pressed") == 2
+    assert "Repeated 4 more times: Outside button pressed" in digest
+    # The session was reused for both emails
+    assert FakeSMTP.connections == 1
+
+
+def test_repeated_critical(tmp_path):
+    """ Test repeats of a critical alert are reported in a digest
+    """
+    logging.disable(logging.NOTSET)
+    FakeSMTP.reset()
+    alert_logger, handler = _alert_logger(tmp_path, "test_alerts_repeats", digest_interval=0.1)
+    for _ in range(3):
+        alert_logger.critical("Gate hit something while closing")
+    # The digest is sent when it is due, without a flush
+    deadline = time.monotonic() + 5
+    while len(FakeSMTP.sent) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    sent = list(FakeSMTP.sent)
+    handler.close()
+    logging.disable(level=logging.CRITICAL)
+    assert len(sent) == 2
+    assert "Repeated 2 more times: Gate hit something while closing" in sent[1]
+
+
+def test_spool_and_retry(tmp_path):
+    """ Test alerts are spooled while the server is down and sent once it is back
+    """
+    logging.disable(logging.NOTSET)
+    FakeSMTP.reset()
+    FakeSMTP.available = False
+    alert_logger, handler = _alert_logger(tmp_path, "test_alerts_spool")
+    alert_logger.critical("Battery voltage: 22v")
+    handler.flush()
+    handler.close()
+    assert not FakeSMTP.sent
+    assert len(glob.glob(os.path.join(handler.spool_dir, "*.eml"))) == 1
+
+    FakeSMTP.available = True
+    alert_logger, handler = _alert_logger(tmp_path, "test_alerts_retry")
+    alert_logger.critical("Close security timer has elapsed")
+    handler.close()
+    logging.disable(level=logging.CRITICAL)
+    assert len(FakeSMTP.sent) == 2
+    assert "Battery voltage: 22v" in FakeSMTP.sent[0]
+    assert not glob.glob(os.path.join(handler.spool_dir, "*.eml"))
+
+
+def test_rejected_and_spool_limit(tmp_path):
+    """ Test the spool keeps only the newest emails, and a spooled email the server rejects is set
+    aside without stopping the others or the new alert from being sent
+    """
+    logging.disable(logging.NOTSET)
+    FakeSMTP.reset()
+    FakeSMTP.available = False
+    alert_logger, handler = _alert_logger(tmp_path, "test_alerts_limit", spool_limit=3)
+    for number in range(5):
+        alert_logger.critical("Battery voltage: %sv", 20 + number)
+    handler.close()
+    assert len(glob.glob(os.path.join(handler.spool_dir, "*.eml"))) == 3
+
+    FakeSMTP.available = True
+    FakeSMTP.refuse = "Battery voltage: 22v"
+    alert_logger, handler = _alert_logger(tmp_path, "test_alerts_rejected", spool_limit=3)
+    alert_logger.critical("Close security timer has elapsed")
+    handler.close()
+    logging.disable(level=logging.CRITICAL)
+    assert [("23v" in sent, "24v" in sent, "timer" in sent) for sent in FakeSMTP.sent] == [
+        (True, False, False), (False, True, False), (False, False, True)]
+    assert not glob.glob(os.path.join(handler.spool_dir, "*.eml"))
+    assert len(glob.glob(os.path.join(handler.rejected_dir, "*.eml"))) == 1
@@ -0,0 +1,55 @@
+""" Unit tests for the battery internal resistance module
+"""
+import pytest
+
+from config import Config as config
+from battery_health import BatteryHealth, LoadFit
+from events import EventBus
+
+
+def test_load_fit():
+    """ Test the fit recovers the internal resistance from synchronised current and voltage
+    """
+    fit = LoadFit()
+    for current in (0, 4, 5, 6, 8):
+        fit.add(current, 25.6 - 0.05 * current)
+    assert fit.resistance() == pytest.approx(0.05)
+    # Raw analog readings are converted with the shunt resistance and correction factor
+    fit = LoadFit()
+    fit.add_reading(0, 2.4)
+    fit.add_reading(config.SHUNT_RESISTANCE * 10, 2.3)
+    assert fit.resistance() == pytest.approx(0.1 * config.BATTERY_VOLTAGE_CORRECTION_FACTOR / 10)
+
+
+def test_load_fit_needs_current_spread():
+    """ Test no estimate is made when the current hardly changed
+    """
+    fit = LoadFit()
+    for voltage in (25.1, 25.0, 24.9):
+        fit.add(5, voltage)
+    assert fit.resistance() is None
+
+
+def test_rising_trend_alert():
+    """ Test an alert is raised once when the recent resistance rises past the baseline
+    """
+    BatteryHealth.initialize()
+    subscription = EventBus.subscribe(500)
+
+    def run(resistance):
+        fit = LoadFit()
+        fit.add(0, 25.6)
+        fit.add(5, 25.6 - 5 * resistance)
+        BatteryHealth.record("open", fit)
+
+    for _ in range(30):
+        run(0.05)
+    for _ in range(BatteryHealth.RECENT_RUNS + 5):
+        run(0.05 * (1 + config.RESISTANCE_ALERT_RISE) * 1.2)
+    events = subscription.get(timeout=0)
+    EventBus.unsubscribe(subscription)
+    assert len([event for event in events if event.event_type == "resistance"]) == 45
+    assert len([event for event in events if event.event_type == "resistance_alert"]) == 1
+    assert len(BatteryHealth.pending) == 45
+    BatteryHealth.flush()
+    assert not BatteryHealth.pending
@@ -0,0 +1,127 @@
+""" Unit tests for the battery voltage sampling module
+"""
+import os
+import statistics
+
+import pytest
+
+from config import Config as config
+from battery_voltage_log import BatteryVoltageLog, VoltageWindow
+from events import EventBus
+from serial_analog import ArduinoInterface
+
+
+class FakeDB:
+    """ Records the voltages that would be written to the db
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.rows = []
+
+    def log_voltage(self, *args):
+        """ Record the row """
+        self.rows.append(args)
+
+
+def test_window_statistics():
+    """ Test the incremental statistics match the statistics of all samples
+    """
+    samples = [26.1, 25.7, 24.9, 26.3, 27.0, 25.2]
+    window = VoltageWindow()
+    for sample in samples:
+        window.add(sample)
+    assert window.count == len(samples)
+    assert window.mean == pytest.approx(statistics.mean(samples))
+    assert window.stddev() == pytest.approx(statistics.pstdev(samples))
+    assert (window.minimum, window.maximum) == (min(samples), max(samples))
+
+
+def test_sampling_and_summary(tmp_path):
+    """ Test samples are summarised into one db row and log line per window
+    """
+    ArduinoInterface.initialize()
+    database = FakeDB()
+    log_path = os.path.join(str(tmp_path), "battery.log")
+    battery_log = BatteryVoltageLog(log_path, config.BATTERY_VOLTAGE_PIN, database)
+    subscription = EventBus.subscribe()
+    for analog in (2.4, 2.5, 2.6):
+        ArduinoInterface.mock_voltages[config.BATTERY_VOLTAGE_PIN] = analog
+        # The gate reads the voltages, the sample reuses them rather than asking again
+        ArduinoInterface.get_analog_voltages()
+        ArduinoInterface.mock_voltages[config.BATTERY_VOLTAGE_PIN] = 0
+        battery_log.sample()
+    battery_log.scheduled_job()
+    assert len(database.rows) == 1
+    voltage, minimum, maximum, _, samples = database.rows[0]
+    factor = config.BATTERY_VOLTAGE_CORRECTION_FACTOR
+    assert voltage == pytest.approx(2.5 * factor, abs=0.01)
+    assert (minimum, maximum, samples) == (round(2.4 * factor, 2), round(2.6 * factor, 2), 3)
+    battery_events = [event for event in subscription.get(timeout=0)
+                      if event.event_type == "battery"]
+    assert battery_events[0].data["samples"] == 3
+    EventBus.unsubscribe(subscription)
+    # A new window was started
+    assert not battery_log.window.count
+
+
+def test_alert_within_samples(tmp_path):
+    """ Test an alert is raised once the recent samples are low and only once until it recovers
+    """
+    database = FakeDB()
+    battery_log = BatteryVoltageLog(os.path.join(str(tmp_path), "battery.log"),
+                                    config.BATTERY_VOLTAGE_PIN, database)
+    subscription = EventBus.subscribe()
+    normal = (config.BATTERY_LOWER_ALERT + config.BATTERY_UPPER_ALERT) / 2
+    low = config.BATTERY_LOWER_ALERT - 0.2
+
+    def alerts():
+        return [event for event in subscription.get(timeout=0)
+                if event.event_type == "battery_alert"]
+
+    for _ in range(config.BATTERY_ALERT_SAMPLES):
+        battery_log.add_sample(normal)
+    # A single low sample (e.g. motor start) is averaged out
+    battery_log.add_sample(low)
+    assert not alerts()
+    for _ in range(config.BATTERY_ALERT_SAMPLES):
+        battery_log.add_sample(low)
+    assert len(alerts()) == 1
+    # Recover then drop again
+    for _ in range(config.BATTERY_ALERT_SAMPLES):
+        battery_log.add_sample(normal)
+    for _ in range(config.BATTERY_ALERT_SAMPLES):
+        battery_log.add_sample(low)
+    assert len(alerts()) == 1
+    EventBus.unsubscribe(subscription)
+
+
+def test_motor_run_samples(gate, tmp_path):
+    """ Test readings taken under motor load don't raise alerts or go into the window statistics
+    """
+    # pylint: disable=protected-access
+    battery_log = BatteryVoltageLog(os.path.join(str(tmp_path), "battery.log"),
+                                    config.BATTERY_VOLTAGE_PIN, FakeDB(), gate)
+    subscription = EventBus.subscribe()
+    factor = config.BATTERY_VOLTAGE_CORRECTION_FACTOR
+    rest = (config.BATTERY_LOWER_ALERT + config.BATTERY_UPPER_ALERT) / 2 / factor
+    loaded = (config.BATTERY_LOWER_ALERT - 1) / factor
+    ArduinoInterface.mock_voltages[config.BATTERY_VOLTAGE_PIN] = rest
+    for _ in range(config.BATTERY_ALERT_SAMPLES):
+        battery_log.sample()
+
+    # A long run, every sample reuses a reading the gate took under load
+    gate._motor_started("close")
+    ArduinoInterface.mock_voltages[config.BATTERY_VOLTAGE_PIN] = loaded
+    for _ in range(2 * config.BATTERY_ALERT_SAMPLES):
+        ArduinoInterface.get_analog_voltages()
+        battery_log.sample()
+    gate._motor_stopped()
+
+    # The last loaded reading is recent but from before the motor stopped
+    ArduinoInterface.mock_voltages[config.BATTERY_VOLTAGE_PIN] = rest
+    battery_log.sample()
+    assert not [event for event in subscription.get(timeout=0)
+                if event.event_type == "battery_alert"]
+    EventBus.unsubscribe(subscription)
+    assert battery_log.window.count == config.BATTERY_ALERT_SAMPLES + 1
+    assert battery_log.window.minimum == round(rest * factor, 2)
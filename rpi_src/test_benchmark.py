@@ -0,0 +1,32 @@
+""" Test module for the benchmark suite
+"""
+import os
+
+import benchmark
+
+
+def test_compare():
+    """ Test only results worse than the baseline by more than the tolerance are regressions
+    """
+    baseline = {"serial_frames_per_second": 100, "trigger_to_motor_on_ms": 1.0}
+    assert not benchmark.compare({"serial_frames_per_second": 75, "trigger_to_motor_on_ms": 1.9,
+                                  "job_queue_jobs_per_second": 1}, baseline)
+    assert benchmark.compare({"serial_frames_per_second": 65, "trigger_to_motor_on_ms": 2.1},
+                             baseline) == ["serial_frames_per_second", "trigger_to_motor_on_ms"]
+
+
+def test_baseline(tmp_path):
+    """ Test baselines are stored per machine type without losing the others
+    """
+    path = os.path.join(str(tmp_path), "baseline.json")
+    assert benchmark.load_baseline(path) == {}
+    benchmark.save_baseline({"db_inserts_per_second": 1234.5678}, path)
+    assert benchmark.load_baseline(path) == {"db_inserts_per_second": 1234.568}
+
+
+def test_run():
+    """ Test every benchmark runs against the mock hardware and the emulator
+    """
+    results = benchmark.run(scale=0.01, repeats=1)
+    assert list(results) == list(benchmark.BENCHMARKS)
+    assert all(value > 0 for value in results.values())
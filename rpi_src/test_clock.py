@@ -0,0 +1,59 @@
+""" Unit tests for the clock module
+"""
+import datetime
+
+import pytest
+
+from clock import ClockIdle, VirtualClock
+from scheduler import Scheduler
+
+
+def test_timers():
+    """ Test timers run in order at their time as the clock moves, and sleeping moves the clock
+    """
+    clock = VirtualClock(wall=datetime.datetime(2021, 3, 1, 10, 0).timestamp())
+    runs = []
+    clock.call_later(2, lambda: runs.append(("b", clock.monotonic())))
+    clock.call_later(1, lambda: runs.append(("a", clock.monotonic())))
+    clock.call_later(2, lambda: runs.append(("c", clock.monotonic())))
+    clock.advance(1.5)
+    assert runs == [("a", 1)]
+    clock.sleep(10)
+    assert runs == [("a", 1), ("b", 2), ("c", 2)]
+    assert clock.monotonic() == 11.5
+    assert datetime.datetime.fromtimestamp(clock.time()).strftime("%H:%M:%S") == "10:00:11"
+    assert not clock.pending()
+
+
+def test_wait_until():
+    """ Test waiting runs timers until the condition is met or the timeout passes
+    """
+    clock = VirtualClock()
+    done = []
+    clock.call_later(5, done.append, True)
+    clock.call_later(60, done.append, True)
+    assert clock.wait_until(lambda: done)
+    assert clock.monotonic() == 5
+    assert clock.wait_until(lambda: len(done) == 2, timeout=10)
+    assert clock.monotonic() == 15 and len(done) == 1
+    assert clock.wait_until(lambda: len(done) == 2)
+    assert clock.monotonic() == 60
+    with pytest.raises(ClockIdle):
+        clock.wait_until(lambda: len(done) == 3)
+
+
+def test_scheduler():
+    """ Test a started scheduler runs its jobs as a virtual clock moves, without a thread
+    """
+    clock = VirtualClock(wall=datetime.datetime(2021, 3, 1, 9, 30).timestamp())
+    scheduler = Scheduler(clock)
+    hourly = scheduler.cron(lambda: None, minute=0)
+    frequent = scheduler.every(60, lambda: None)
+    scheduler.start()
+    assert scheduler._thread is None  # pylint: disable=protected-access
+    clock.advance(24 * 3600)
+    assert hourly.runs == 24
+    assert frequent.runs == 24 * 60
+    scheduler.stop()
+    clock.advance(3600)
+    assert hourly.runs == 24
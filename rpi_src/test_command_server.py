@@ -0,0 +1,40 @@
+""" Unit tests for the command socket server and its client
+"""
+import json
+import os
+import threading
+
+from command_server import CommandServer
+from status import StatusSnapshot
+from gatectl import send_commands
+
+
+def test_pipelined_commands(gate, tmp_path):
+    """ Test several commands on one connection are answered in order with the resulting state
+    """
+    test_q = gate.job_q
+
+    # Act on mode changes like the main loop does
+    def consume():
+        job = test_q.get()
+        gate.mode_change(job)
+    threading.Thread(target=consume, daemon=True).start()
+
+    socket_path = os.path.join(str(tmp_path), 'gate.sock')
+    StatusSnapshot.initialize(gate, test_q)
+    CommandServer.initialize(gate, test_q)
+    CommandServer.start(socket_path)
+    try:
+        responses = send_commands(['status', 'normal_away', 'bogus', 'battery'], socket_path)
+    finally:
+        CommandServer.stop()
+    responses = [json.loads(response) for response in responses]
+
+    assert [response['ok'] for response in responses] == [True, True, False, True]
+    assert responses[0]['mode'] == 'normal_home'
+    assert responses[0]['state'] == 'unknown'
+    assert responses[1]['mode'] == 'normal_away'
+    assert responses[1]['applied']
+    assert responses[2]['error'] == 'unknown command'
+    assert responses[3]['battery_voltage'] == 0
+    assert not os.path.exists(socket_path)
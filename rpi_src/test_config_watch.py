@@ -0,0 +1,111 @@
+""" Unit tests for config reloading and the config file watcher
+"""
+import json
+import os
+import threading
+
+from config import Config as config
+from config_watch import ConfigWatcher
+
+CONFIG_PATH = config.CONFIG_PATH
+
+
+def write_conf(path, replacements):
+    """ Write a copy of the current conf.ini to path with some lines replaced
+    """
+    with open(os.path.join(CONFIG_PATH, "conf.ini"), "r") as conf:
+        text = conf.read()
+    for old, new in replacements.items():
+        assert old in text
+        text = text.replace(old, new)
+    with open(path, "w") as conf:
+        conf.write(text)
+
+
+def reload_from(tmp_path, replacements):
+    """ Reload the config from a modified copy of conf.ini
+    """
+    write_conf(os.path.join(str(tmp_path), "conf.ini"), replacements)
+    config.CONFIG_PATH = str(tmp_path)
+    try:
+        return config.reload()
+    finally:
+        config.CONFIG_PATH = CONFIG_PATH
+
+
+def test_reload_applies_runtime_settings(tmp_path):
+    """ Test changed runtime parameters are swapped in
+    """
+    hold_open_time = config.HOLD_OPEN_TIME
+    try:
+        report = reload_from(tmp_path, {"hold_open_time = {}".format(hold_open_time):
+                                        "hold_open_time = {}".format(hold_open_time + 5)})
+        assert report == {"applied": {"HOLD_OPEN_TIME": hold_open_time + 5}, "rejected": None}
+        assert config.HOLD_OPEN_TIME == hold_open_time + 5
+    finally:
+        reload_from(tmp_path, {})
+    assert config.HOLD_OPEN_TIME == hold_open_time
+
+
+def test_reload_rejects_pin_changes(tmp_path):
+    """ Test a file that changes a pin is rejected as a whole
+    """
+    hold_open_time = config.HOLD_OPEN_TIME
+    report = reload_from(tmp_path, {
+        "motor_pin_0 = {}".format(config.MOTORPIN0):
+        "motor_pin_0 = {}".format(config.MOTORPIN0 + 1),
+        "hold_open_time = {}".format(hold_open_time):
+        "hold_open_time = {}".format(hold_open_time + 5)})
+    assert not report["applied"]
+    assert "MOTORPIN0" in report["rejected"]
+    assert config.HOLD_OPEN_TIME == hold_open_time
+
+
+def test_reload_rejects_invalid_file(tmp_path):
+    """ Test an invalid value leaves every setting unchanged
+    """
+    threshold = config.SHUNT_THRESHOLD
+    report = reload_from(tmp_path, {"shunt_threshold = ": "shunt_threshold = high #"})
+    assert not report["applied"]
+    assert report["rejected"]
+    assert config.SHUNT_THRESHOLD == threshold
+
+
+def test_reload_email_rejects_incomplete_file(tmp_path, monkeypatch):
+    """ Test an email config missing a key leaves the current email settings unchanged
+    """
+    email_json = os.path.join(str(tmp_path), "email_keys.json")
+    with open(email_json, "w") as email_file:
+        json.dump({"smtp": "smtp.changed.example", "port": 587, "fromaddr": "gate@example.com",
+                   "toaddrs": ["me@example.com"], "subject": "GATE"}, email_file)
+    monkeypatch.setattr(config, "EMAIL_KEY_JSON", email_json)
+    smtp = getattr(config, "SMTP", None)
+    report = config.reload_email()
+    assert not report["applied"]
+    assert "credentials" in report["rejected"]
+    assert getattr(config, "SMTP", None) == smtp
+
+
+def test_watcher(tmp_path, monkeypatch):
+    """ Test the watcher notices a file being written and a file being replaced, with inotify and
+    by polling
+    """
+    monkeypatch.setattr(ConfigWatcher, "POLL_INTERVAL", 0.1)
+    monkeypatch.setattr(ConfigWatcher, "SETTLE_TIME", 0.05)
+    for polling in (False, True):
+        changed = threading.Event()
+        watcher = ConfigWatcher(str(tmp_path), {"conf.ini": changed.set})
+        if polling:
+            watcher._inotify = lambda: None  # pylint: disable=protected-access
+        watcher.start()
+        try:
+            with open(os.path.join(str(tmp_path), "other.txt"), "w") as other:
+                other.write("ignored")
+            assert not changed.wait(0.3)
+            new_file = os.path.join(str(tmp_path), "conf.ini.new")
+            with open(new_file, "w") as conf:
+                conf.write("[parameters]\n" + "x" * (10 if polling else 1))
+            os.replace(new_file, os.path.join(str(tmp_path), "conf.ini"))
+            assert changed.wait(2)
+        finally:
+            watcher.stop()
@@ -0,0 +1,104 @@
+""" Test module for the Arduino emulator, these run the real serial path over a pty
+"""
+import os
+
+import pytest
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+
+from config import Config as config
+from emulator import ArduinoEmulator, MotorModel, pin_direction
+from gate import Gate
+from job_queue import JobQueue
+from recorder import Recorder, read_trace
+from serial_analog import ArduinoInterface, ArduinoInterfaceError
+
+
+@pytest.fixture(name="gate")
+def fixture_gate(tmp_path, monkeypatch):
+    """ Gate connected to an emulated Arduino that sees its motor pins
+    """
+    factory = MockFactory()
+    Device.pin_factory = factory
+    factory.reset()
+    monkeypatch.setattr(config, "SAVED_MODE_FILE", os.path.join(str(tmp_path), 'mode.txt'))
+    monkeypatch.setattr(config, "SHUNT_READ_DELAY", 0.1)
+    monkeypatch.setattr(config, "SERIAL_PORT", os.path.join(str(tmp_path), 'ttyGATE'))
+    test_q = JobQueue(config.COMMANDS, os.path.join(str(tmp_path), 'pipe'))
+    gate = Gate(test_q)
+    gate.emulator = ArduinoEmulator(config.SERIAL_PORT, latency=0.001, jitter=0.001,
+                                    motor=MotorModel(travel_time=0.6, inrush_time=0.05),
+                                    motor_direction=pin_direction(gate), seed=1).start()
+    ArduinoInterface.initialize(gate, test_q)
+    yield gate
+    ArduinoInterface.stop()
+    gate.emulator.stop()
+    test_q.cleanup()
+
+
+def test_handshake(gate):
+    """ Test the handshake and button pins go through and the voltages come back checked
+    """
+    assert not ArduinoInterface.mock_mode
+    assert ArduinoInterface.firmware_hash == gate.emulator.firmware_hash
+    voltages = ArduinoInterface.get_analog_voltages()
+    assert voltages[config.SHUNT_PIN] == 0
+    assert voltages[config.BATTERY_VOLTAGE_PIN] == pytest.approx(
+        26.0 / config.BATTERY_VOLTAGE_CORRECTION_FACTOR, abs=0.01)
+    assert sorted(gate.emulator.button_pins) == sorted(
+        [config.BUTTON_OUTSIDE_PIN, config.BUTTON_INSIDE_PIN, config.BUTTON_BOX_PIN])
+    assert gate.emulator.oversampling == config.ADC_OVERSAMPLING
+
+    gate.emulator.press(config.BUTTON_OUTSIDE_PIN)
+    assert gate.job_q.get(timeout=2) == "open"
+
+
+def test_gate_cycle(gate):
+    """ Test the arduino stops the motor at the end of travel and when the closing gate is
+    obstructed
+    """
+    gate.open()
+    assert gate.current_state == "opened"
+    assert gate.emulator.motor.position == 1.0
+    assert gate.motor_pin1.value == 0
+
+    gate.emulator.motor.obstruct(0.5)
+    gate.close()
+    assert gate.emulator.motor.position == 0.5
+    assert gate.in_flight == "open"
+    assert gate.job_q.get(timeout=1) == "open"
+
+
+def test_corruption(gate):
+    """ Test corrupted voltage frames are never taken as readings
+    """
+    gate.emulator.corruption = 0.02
+    read = 0
+    for _ in range(30):
+        try:
+            voltages = ArduinoInterface.get_analog_voltages()
+        except ArduinoInterfaceError:
+            continue
+        assert voltages[config.SHUNT_PIN] == 0
+        assert voltages[config.BATTERY_VOLTAGE_PIN] == pytest.approx(
+            26.0 / config.BATTERY_VOLTAGE_CORRECTION_FACTOR, abs=0.01)
+        read += 1
+    assert gate.emulator.lines_corrupted
+    assert read >= 25
+
+
+def test_recording(gate, tmp_path):
+    """ Test the voltage frames, the messages from the Arduino and the triggers are recorded
+    """
+    path = os.path.join(str(tmp_path), "trace.bin")
+    Recorder.start(path)
+    ArduinoInterface.get_analog_voltages()
+    gate.emulator.press(config.BUTTON_OUTSIDE_PIN)
+    assert gate.job_q.get(timeout=2) == "open"
+    Recorder.stop()
+    records = [(kind, value) for _, kind, value in read_trace(path)]
+    frames = [value for kind, value in records if kind == "frame"]
+    assert frames[0][config.BATTERY_VOLTAGE_PIN] == pytest.approx(
+        26.0 / config.BATTERY_VOLTAGE_CORRECTION_FACTOR, abs=0.01)
+    assert [record for record in records if record[0] != "frame"] == [
+        ("serial", "O"), ("trigger", "arduino"), ("serial", str(config.BUTTON_OUTSIDE_PIN))]
@@ -0,0 +1,76 @@
+""" Unit tests for the event bus and the Server-Sent Events stream
+"""
+import json
+import urllib.request
+
+from events import EventBus
+from http_api import HttpApi
+
+
+def test_fan_out():
+    """ Test every subscriber receives each event and a slow subscriber only loses its own events
+    """
+    fast = EventBus.subscribe(size=10)
+    slow = EventBus.subscribe(size=2)
+    for i in range(5):
+        EventBus.publish("test", number=i)
+        assert [event.data["number"] for event in fast.get(timeout=0)] == [i]
+    assert [event.data["number"] for event in slow.get(timeout=0)] == [3, 4]
+    assert slow.dropped == 3
+    assert fast.dropped == 0
+    EventBus.unsubscribe(fast)
+    EventBus.unsubscribe(slow)
+    # Nothing to get returns an empty list once the timeout passes
+    assert not slow.get(timeout=0.01)
+
+
+def test_failing_listener():
+    """ Test a listener that raises is skipped without losing the event for the others
+    """
+    received = []
+
+    def failing(event):
+        raise ValueError(event.event_type)
+    EventBus.add_listener(failing)
+    EventBus.add_listener(received.append)
+    subscription = EventBus.subscribe()
+    try:
+        EventBus.publish("test", number=1)
+    finally:
+        EventBus.remove_listener(failing)
+        EventBus.remove_listener(received.append)
+        EventBus.unsubscribe(subscription)
+    assert [event.data["number"] for event in received] == [1]
+    assert [event.data["number"] for event in subscription.get(timeout=0)] == [1]
+
+
+def test_gate_events(gate):
+    """ Test the gate publishes its state transitions and mode changes
+    """
+    subscription = EventBus.subscribe()
+    gate.open()
+    gate.mode_change('normal_away')
+    EventBus.unsubscribe(subscription)
+    events = [(event.event_type, event.data) for event in subscription.get(timeout=0)]
+    assert events == [('state', {'state': 'opening'}),
+                      ('state', {'state': 'opened'}),
+                      ('mode', {'mode': 'normal_away'})]
+
+
+def test_sse_stream():
+    """ Test events are streamed to a client over HTTP
+    """
+    HttpApi.add_stream_route('/events', 'text/event-stream', EventBus.sse_stream)
+    HttpApi.start('127.0.0.1', 0)
+    try:
+        url = 'http://127.0.0.1:{}/events'.format(HttpApi.server.server_port)
+        with urllib.request.urlopen(url, timeout=2) as response:
+            assert response.headers['Content-Type'] == 'text/event-stream'
+            assert response.readline() == b'retry: 2000\n'
+            assert response.readline() == b'\n'
+            EventBus.publish('battery', voltage=26.1)
+            lines = [response.readline() for _ in range(3)]
+    finally:
+        HttpApi.stop()
+    assert lines[1] == b'event: battery\n'
+    assert json.loads(lines[2][len(b'data: '):])['data'] == {'voltage': 26.1}
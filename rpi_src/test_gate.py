@@ -7,10 +7,13 @@ import pytest
 from gpiozero import Device
 from gpiozero.pins.mock import MockFactory
 
+from clock import VirtualClock
 from config import Config as config
-from serial_analog import ArduinoInterface
+from events import EventBus
+from serial_analog import ArduinoInterface, ArduinoInterfaceError
 from gate import Gate
 from job_queue import JobQueue
+from state_store import StateStore
 
 logging.disable(level=logging.CRITICAL)
 
@@ -50,21 +53,21 @@ def test_open_timeout(tmp_path):
     Device.pin_factory = factory
     factory.reset()
 
-    # Alter safety timer to make test faster
     config.MAX_TIME_TO_OPEN_CLOSE = 2
 
     fifo_file = os.path.join(str(tmp_path), 'pipe')
-    test_q = JobQueue([], fifo_file)
+    clock = VirtualClock()
+    test_q = JobQueue([], fifo_file, clock)
     ArduinoInterface.initialize()
-    gate = Gate(test_q)
+    gate = Gate(test_q, clock=clock)
 
-    start = time.monotonic()
+    start = clock.monotonic()
     gate.open()
     # Check that the gate is stopped
     assert gate.motor_pin0.value == 0
     assert gate.motor_pin1.value == 0
     # Check that the time matches the time in config.MAX_TIME_TO_OPEN_CLOSE
-    time_taken = time.monotonic()-start
+    time_taken = clock.monotonic()-start
     assert time_taken == pytest.approx(config.MAX_TIME_TO_OPEN_CLOSE, 0.2)
     test_q.cleanup()
     del test_q
@@ -78,21 +81,21 @@ def test_close_timeout(tmp_path):
     Device.pin_factory = factory
     factory.reset()
 
-    # Alter safety timer to make test faster
     config.MAX_TIME_TO_OPEN_CLOSE = 2
 
     fifo_file = os.path.join(str(tmp_path), 'pipe')
-    test_q = JobQueue([], fifo_file)
+    clock = VirtualClock()
+    test_q = JobQueue([], fifo_file, clock)
     ArduinoInterface.initialize()
-    gate = Gate(test_q)
+    gate = Gate(test_q, clock=clock)
 
-    start = time.monotonic()
+    start = clock.monotonic()
     gate.close()
     # Check that the gate is stopped
     assert gate.motor_pin0.value == 0
     assert gate.motor_pin1.value == 0
     # Check that the time matches the time in config.MAX_TIME_TO_OPEN_CLOSE
-    time_taken = time.monotonic()-start
+    time_taken = clock.monotonic()-start
     assert time_taken == pytest.approx(config.MAX_TIME_TO_OPEN_CLOSE, 0.2)
     test_q.cleanup()
     del test_q
@@ -239,3 +242,213 @@ def test_mode_changing(tmp_path):
     # Cleanup
     test_q.cleanup()
     del test_q
+
+
+def test_resume(gate, tmp_path, monkeypatch):
+    """ Test a restarted gate keeps a resting state and finishes an interrupted cycle
+    """
+    state_file = os.path.join(str(tmp_path), 'state.json')
+    test_q = gate.job_q
+
+    def restart():
+        Device.pin_factory.reset()
+        return Gate(test_q, StateStore(state_file))
+
+    gate = restart()
+    gate.position = 0.0
+    gate.open()
+    assert gate.current_state == "opened"
+    # Restarted part way through the cycle, the open is put back on the queue
+    gate = restart()
+    assert gate.current_state == "unknown"
+    assert gate.position == 1.0
+    gate.resume()
+    assert test_q.get_nonblocking() == 'open'
+
+    # Restarted while closing, the close is finished
+    monkeypatch.setattr(config, "MIN_TIME_TO_OPEN_CLOSE", 0)
+    gate.in_flight = "close"
+    gate.current_state = "closing"
+    gate = restart()
+    gate.resume()
+    assert gate.current_state == "closed"
+    assert gate.position == 0.0
+    assert gate.state_store.state["counters"] == {"opened": 1, "closed": 1, "hits": 0,
+                                                   "timeouts": 0}
+
+    # Restarted after the cycle completed, nothing moves
+    gate = restart()
+    assert gate.current_state == "closed"
+    gate.resume()
+    assert gate.motor_pin0.value == 0
+    assert gate.motor_pin1.value == 0
+    assert test_q.empty()
+
+
+def test_degraded_mode(tmp_path, monkeypatch):
+    """ Test failed shunt reads switch to timing the gate and missing readings stop it
+    """
+    factory = MockFactory()
+    Device.pin_factory = factory
+    factory.reset()
+    monkeypatch.setattr(config, "SAVED_MODE_FILE", os.path.join(str(tmp_path), 'mode.txt'))
+    monkeypatch.setattr(config, "EXPECTED_TIME_TO_OPEN_CLOSE", 1)
+    monkeypatch.setattr(config, "MAX_TIME_TO_OPEN_CLOSE", 2)
+    monkeypatch.setattr(config, "SHUNT_STALE_TIME", 0.3)
+    clock = VirtualClock()
+    test_q = JobQueue(config.COMMANDS, os.path.join(str(tmp_path), 'pipe'), clock)
+    ArduinoInterface.initialize()
+    ArduinoInterface.mock_voltages[config.SHUNT_PIN] = 0
+    gate = Gate(test_q, clock=clock)
+    reads = []
+    read_voltages = ArduinoInterface.get_analog_voltages
+
+    def flaky_read(*args):
+        reads.append(clock.monotonic())
+        # Every third read fails
+        if len(reads) % 3 == 0:
+            clock.sleep(0.01)
+            raise ArduinoInterfaceError("timed out")
+        return read_voltages(*args)
+
+    subscription = EventBus.subscribe(size=1000)
+    monkeypatch.setattr(ArduinoInterface, "get_analog_voltages", flaky_read)
+    start = clock.monotonic()
+    gate.open()
+    assert gate.current_state == "opened"
+    assert gate.degraded
+    assert clock.monotonic() - start == pytest.approx(1, abs=0.1)
+    stalls = [event for event in subscription.get(timeout=0) if event.event_type == "stall"]
+    assert stalls and all(stall.data["failures"] == 1 for stall in stalls)
+
+    # No readings at all, the motor is stopped once they have been missing for too long
+    def failed_read(*_):
+        clock.sleep(0.01)
+        raise ArduinoInterfaceError("timed out")
+    monkeypatch.setattr(ArduinoInterface, "get_analog_voltages", failed_read)
+    start = clock.monotonic()
+    gate.close()
+    assert gate.current_state == "Close link error"
+    assert gate.motor_pin0.value == 0
+    assert clock.monotonic() - start == pytest.approx(config.SHUNT_READ_DELAY + 0.3, abs=0.1)
+    stall = [event for event in subscription.get(timeout=0) if event.event_type == "stall"][-1]
+    assert stall.data["duration"] == pytest.approx(0.3, abs=0.05)
+    EventBus.unsubscribe(subscription)
+    test_q.cleanup()
+
+
+class HitMessage:
+    """ Serial port with the voltage line of a hit event waiting to be read
+    """
+    # pylint: disable=too-few-public-methods
+    @staticmethod
+    def readline():
+        """ The voltage the threshold was crossed at """
+        return b"0.0500\r\n"
+
+
+def test_arduino_hit(tmp_path, monkeypatch):
+    """ Test a hit event from the Arduino stops the motor without waiting for the gate's own
+    shunt readings
+    """
+    factory = MockFactory()
+    Device.pin_factory = factory
+    factory.reset()
+    monkeypatch.setattr(config, "SAVED_MODE_FILE", os.path.join(str(tmp_path), 'mode.txt'))
+    monkeypatch.setattr(config, "MAX_TIME_TO_OPEN_CLOSE", 5)
+    monkeypatch.setattr(config, "MIN_TIME_TO_OPEN_CLOSE", 3)
+    clock = VirtualClock()
+    test_q = JobQueue(config.COMMANDS, os.path.join(str(tmp_path), 'pipe'), clock)
+    gate = Gate(test_q, clock=clock)
+    ArduinoInterface.initialize(gate, test_q)
+    ArduinoInterface.mock_voltages[config.SHUNT_PIN] = 0
+
+    def hit():
+        # The serial thread receives 'H' followed by the voltage
+        ArduinoInterface.ser = HitMessage()
+        ArduinoInterface._arduino_receive_hit()  # pylint: disable=protected-access
+        motor_values.append((gate.motor_pin0.value, gate.motor_pin1.value))
+
+    motor_values = []
+    clock.call_later(config.SHUNT_READ_DELAY + 0.2, hit)
+    start = clock.monotonic()
+    gate.open()
+    assert gate.current_state == "opened"
+    assert motor_values == [(0, 0)]
+    assert clock.monotonic() - start == pytest.approx(config.SHUNT_READ_DELAY + 0.2, abs=0.1)
+
+    # Before the minimum time to close it is a hit, the gate reopens
+    clock.call_later(config.SHUNT_READ_DELAY + 0.2, hit)
+    gate.close()
+    assert test_q.get_nonblocking() == 'open'
+
+    # A hit sent before the last run was disarmed doesn't stop the next one
+    gate._open()  # pylint: disable=protected-access
+    gate.arduino_hit(0.05)
+    assert gate.motor_pin1.value == 1
+    gate._stop()  # pylint: disable=protected-access
+    test_q.cleanup()
+
+
+def test_arduino_hit_after_stop(gate):
+    """ Test a hit that arrives as the gate thread stops the motor is handled on the serial thread
+    without an error
+    """
+    # pylint: disable=protected-access
+    gate._open()
+    gate._motor_start_time -= config.SHUNT_READ_DELAY
+    clock = gate.clock
+
+    class StoppingClock:
+        """ Clock that lets the gate thread stop the motor part way through arduino_hit """
+        # pylint: disable=too-few-public-methods
+        @staticmethod
+        def monotonic():
+            """ Stop the motor, then read the time """
+            gate.clock = clock
+            gate._stop()
+            return clock.monotonic()
+
+    gate.clock = StoppingClock()
+    gate.arduino_hit(0.05)
+    assert gate._motor_start_time is None
+    # Once stopped a late hit is ignored
+    gate._arduino_hit = None
+    gate.arduino_hit(0.05)
+    assert gate._arduino_hit is None
+
+
+@pytest.mark.usefixtures("cycle_timings")
+def test_partial_close_hit(gate):
+    """ Test an obstruction during a partial close is still a hit when the estimated position is
+    lower than the gate really is open
+    """
+    clock = VirtualClock()
+    gate.clock = clock
+    # The gate is really most of the way open
+    gate.position = 0.2
+    ArduinoInterface.mock_voltages[config.SHUNT_PIN] = 0
+
+    def obstruction():
+        ArduinoInterface.mock_voltages[config.SHUNT_PIN] = 10
+
+    clock.call_later(5, obstruction)
+    gate.close()
+    assert gate.in_flight == "open"
+    assert gate.job_q.get_nonblocking() == 'open'
+
+
+def test_rest_point_after_reversal(gate):
+    """ Test the no load point of the resistance fit isn't taken from the reading of a run that
+    just ended
+    """
+    # pylint: disable=protected-access
+    ArduinoInterface.get_analog_voltages()
+    gate._close()
+    assert gate._load_fit.count == 1
+    gate._read_shunt()
+    gate._stop()
+    # Reversed straight away, the last reading was under load
+    gate._open()
+    assert gate._load_fit.count == 0
+    gate._stop()
@@ -0,0 +1,50 @@
+""" Unit tests for the recent event journal
+"""
+import datetime
+import os
+import types
+
+import events
+from events import EventBus
+from journal import Journal
+
+
+def test_ring_and_index(tmp_path):
+    """ Test records are indexed by type, the oldest are overwritten and queries are newest first
+    """
+    path = os.path.join(str(tmp_path), 'journal.bin')
+    Journal.open(path, capacity=8)
+    for i in range(10):
+        Journal.record('entry' if i % 2 else 'hit', 1000 + i, i, 'detail{}'.format(i))
+    records = Journal.query()
+    assert len(records) == 8
+    assert [record['value'] for record in records] == [9, 8, 7, 6, 5, 4, 3, 2]
+    hits = Journal.query('hit', limit=2)
+    assert [(record['value'], record['detail']) for record in hits] == [(8, 'detail8'),
+                                                                         (6, 'detail6')]
+    assert len(Journal.query('hit')) == 4
+    assert [record['value'] for record in Journal.query('entry', since=1006)] == [9, 7]
+    Journal.close()
+
+
+def test_survives_restart(tmp_path, monkeypatch):
+    """ Test the journal is reloaded from its file and follows the event bus
+    """
+    # Events are published at noon today, so "since HH:MM" doesn't depend on the time of the run
+    noon = datetime.datetime.combine(datetime.date.today(), datetime.time(12, 0)).timestamp()
+    monkeypatch.setattr(events, "time", types.SimpleNamespace(time=lambda: noon))
+    path = os.path.join(str(tmp_path), 'journal.bin')
+    Journal.open(path, capacity=16)
+    EventBus.publish('mode', mode='normal_away')
+    EventBus.publish('entry', button='outside', time='')
+    Journal.close()
+
+    Journal.open(path, capacity=16)
+    assert [record['type'] for record in Journal.query()] == ['entry', 'mode']
+    assert Journal.command(['entries'])['records'][0]['detail'] == 'outside'
+    assert len(Journal.command(['modes', 'since', '11:59'])['records']) == 1
+    assert not Journal.command(['modes', 'since', '12:01'])['records']
+    # A different capacity starts a new journal
+    Journal.open(path, capacity=32)
+    assert not Journal.query()
+    Journal.close()
@@ -0,0 +1,45 @@
+""" Unit tests for the bounded log queue
+"""
+import logging
+
+from log_queue import BoundedQueueHandler
+
+
+def test_drop_policy():
+    """ Test DEBUG records are shed first and CRITICAL records are never dropped
+    """
+    logging.disable(logging.NOTSET)
+    handler = BoundedQueueHandler(capacity=8)
+    test_logger = logging.getLogger("test_log_queue")
+    test_logger.propagate = False
+    test_logger.setLevel(logging.DEBUG)
+    test_logger.addHandler(handler)
+
+    # Nothing is listening so the queue fills up
+    for _ in range(10):
+        test_logger.debug("debug")
+    assert handler.queue.qsize() == 4
+    for _ in range(10):
+        test_logger.info("info")
+    assert handler.queue.qsize() == 6
+    for _ in range(10):
+        test_logger.warning("warning")
+    assert handler.queue.qsize() == 8
+    for _ in range(10):
+        test_logger.critical("critical")
+    assert handler.queue.qsize() == 18
+
+    assert handler.dropped == {"DEBUG": 6, "INFO": 8, "WARNING": 8}
+    assert handler.dropped_total == 22
+    logging.disable(level=logging.CRITICAL)
+
+
+def test_custom_policy():
+    """ Test a custom policy where INFO and below are never queued beyond a single record
+    """
+    handler = BoundedQueueHandler(capacity=10, policy={logging.DEBUG: 0.1,
+                                                       logging.WARNING: None})
+    assert handler.limit(logging.DEBUG) == 1
+    assert handler.limit(logging.INFO) == 1
+    assert handler.limit(logging.WARNING) is None
+    assert handler.limit(logging.CRITICAL) is None
@@ -0,0 +1,83 @@
+""" Unit tests for the log storage module
+"""
+import glob
+import gzip
+import logging
+import os
+
+from log_storage import LogStorage
+
+
+def _logger(path, name):
+    """ Create a logger that only writes to a LogStorage handler at path
+    """
+    test_logger = logging.getLogger(name)
+    test_logger.propagate = False
+    test_logger.setLevel(logging.DEBUG)
+    handler = LogStorage.file_handler(path, logging.DEBUG, "%(message)s")
+    test_logger.addHandler(handler)
+    return test_logger, handler
+
+
+def test_size_rotation_and_compression(tmp_path):
+    """ Test that logs rotate at the size limit and the rotated segments are gzipped
+    """
+    logging.disable(logging.NOTSET)
+    path = os.path.join(str(tmp_path), "test.log")
+    test_logger, handler = _logger(path, "test_log_storage_rotation")
+    handler.max_bytes = 1000
+    for i in range(100):
+        test_logger.info("log line number %s", i)
+    LogStorage.wait()
+    handler.close()
+
+    segments = glob.glob(path + ".*.gz")
+    assert segments
+    # No uncompressed segments are left behind
+    assert not [name for name in glob.glob(path + ".*") if not name.endswith(".gz")]
+    # All lines are kept between the segments and the current log
+    lines = []
+    for segment in sorted(segments, key=os.path.getmtime):
+        with gzip.open(segment, "rt") as segment_file:
+            lines.extend(segment_file.read().splitlines())
+    with open(path, "r") as log_file:
+        lines.extend(log_file.read().splitlines())
+    assert lines == ["log line number {}".format(i) for i in range(100)]
+    logging.disable(level=logging.CRITICAL)
+
+
+def test_disk_budget(tmp_path):
+    """ Test the oldest segments are deleted to keep the logs within the disk budget
+    """
+    path = os.path.join(str(tmp_path), "budget.log")
+    _, handler = _logger(path, "test_log_storage_budget")
+    for i in range(10):
+        with open("{}.2020010{}-000000.gz".format(path, i), "wb") as segment:
+            segment.write(b"x" * 100)
+        os.utime(segment.name, (i, i))
+    # Only account for this log in the budget
+    budget, handlers = LogStorage.budget_bytes, LogStorage.handlers
+    LogStorage.budget_bytes, LogStorage.handlers = 450, [handler]
+    try:
+        LogStorage.enforce_budget()
+    finally:
+        LogStorage.budget_bytes, LogStorage.handlers = budget, handlers
+    remaining = sorted(os.path.basename(name) for name in glob.glob(path + ".*.gz"))
+    assert remaining == ["budget.log.2020010{}-000000.gz".format(i) for i in range(6, 10)]
+    handler.close()
+
+
+def test_scheduled_flush(tmp_path):
+    """ Test records below warning stay buffered until LogStorage.flush writes them out
+    """
+    logging.disable(logging.NOTSET)
+    path = os.path.join(str(tmp_path), "test.log")
+    test_logger, handler = _logger(path, "test_log_storage_flush")
+    handler.flush_interval = 3600
+    test_logger.info("buffered line")
+    assert os.path.getsize(path) == 0
+    LogStorage.flush()
+    with open(path, "r") as log_file:
+        assert log_file.read() == "buffered line\n"
+    handler.close()
+    logging.disable(level=logging.CRITICAL)
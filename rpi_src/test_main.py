@@ -1,29 +1,21 @@
 """ Unit tests for the main.py module
 """
 import os
-import threading
-import time
+import random
 
 import pytest
 from gpiozero import Device
 from gpiozero.pins.mock import MockFactory
 
+from clock import VirtualClock
 from config import Config as config
+from emulator import MotorModel, drive_mock_shunt, pin_direction
 import main
+from scheduler import Scheduler
 from serial_analog import ArduinoInterface
 from gate import Gate
 from job_queue import JobQueue
-
-
-def delayed_put(delay, message, queue):
-    """ Function to be threaded that puts a message on a queue after a delay
-    Keyword arguments:
-        delay - delay in seconds to wait before putting message on queue
-        message - message to put
-        queue - queue to put to
-    """
-    time.sleep(delay)
-    queue.validate_and_put(message)
+from state_store import StateStore
 
 
 def test_lock_open_loop(tmp_path):
@@ -36,8 +28,9 @@ def test_lock_open_loop(tmp_path):
     # Setup gate dependencies
     ArduinoInterface.initialize()
     fifo_file = os.path.join(str(tmp_path), 'pipe')
-    test_queue = JobQueue(config.COMMANDS+config.MODES, fifo_file)
-    gate = Gate(test_queue)
+    clock = VirtualClock()
+    test_queue = JobQueue(config.COMMANDS+config.MODES, fifo_file, clock)
+    gate = Gate(test_queue, clock=clock)
 
     # Set gate mode to lock_open
     gate.current_mode = 'lock_open'
@@ -47,13 +40,13 @@ def test_lock_open_loop(tmp_path):
     # Set shunt voltage above threshold to indicate gate already in position
     ArduinoInterface.mock_voltages[config.SHUNT_PIN] = 10
 
-    start_time = time.monotonic()
+    start_time = clock.monotonic()
     # put a non mode message on the queue to ensure it ignores it
-    threading.Thread(target=lambda: delayed_put(0.2, 'open', test_queue)).start()
+    clock.call_later(0.2, test_queue.validate_and_put, 'open')
     # put a non lock_open mode message on the queue in 1 second
-    threading.Thread(target=lambda: delayed_put(1.5, 'lock_closed', test_queue)).start()
+    clock.call_later(1.5, test_queue.validate_and_put, 'lock_closed')
     main.lock_open_loop(gate, test_queue)
-    time_taken = time.monotonic()-start_time
+    time_taken = clock.monotonic()-start_time
     assert time_taken == pytest.approx(1.5, 0.2)
 
     #Cleanup
@@ -70,8 +63,9 @@ def test_lock_closed_loop(tmp_path):
     # Setup gate dependencies
     ArduinoInterface.initialize()
     fifo_file = os.path.join(str(tmp_path), 'pipe')
-    test_queue = JobQueue(config.COMMANDS+config.MODES, fifo_file)
-    gate = Gate(test_queue)
+    clock = VirtualClock()
+    test_queue = JobQueue(config.COMMANDS+config.MODES, fifo_file, clock)
+    gate = Gate(test_queue, clock=clock)
 
     # Set gate mode to lock_open
     gate.current_mode = 'lock_closed'
@@ -81,14 +75,100 @@ def test_lock_closed_loop(tmp_path):
     # Set shunt voltage above threshold to indicate gate already in position
     ArduinoInterface.mock_voltages[config.SHUNT_PIN] = 10
 
-    start_time = time.monotonic()
+    start_time = clock.monotonic()
     # put a non mode message on the queue to ensure it ignores it
-    threading.Thread(target=lambda: delayed_put(0.2, 'open', test_queue)).start()
+    clock.call_later(0.2, test_queue.validate_and_put, 'open')
     # put a non lock_closed mode message on the queue in 1 second
-    threading.Thread(target=lambda: delayed_put(1.5, 'lock_open', test_queue)).start()
+    clock.call_later(1.5, test_queue.validate_and_put, 'lock_open')
     main.lock_closed_loop(gate, test_queue)
-    time_taken = time.monotonic()-start_time
+    time_taken = clock.monotonic()-start_time
     assert time_taken == pytest.approx(1.5, 0.2)
 
     #Cleanup
     test_queue.cleanup()
+
+
+@pytest.fixture(name="sim")
+def fixture_sim(tmp_path, monkeypatch, cycle_timings):
+    """ Gate and job queue on a virtual clock, with a motor model behind the mock shunt voltage
+    """
+    factory = MockFactory()
+    Device.pin_factory = factory
+    factory.reset()
+    monkeypatch.setattr(config, "SAVED_MODE_FILE", os.path.join(str(tmp_path), 'mode.txt'))
+    ArduinoInterface.initialize()
+    clock = VirtualClock(poll_interval=0.05)
+    test_queue = JobQueue(config.COMMANDS+config.MODES, os.path.join(str(tmp_path), 'pipe'),
+                          clock)
+    gate = Gate(test_queue, StateStore(), clock)
+    gate.position = 0.0
+    gate.current_state = 'closed'
+    gate.motor = MotorModel(travel_time=cycle_timings)
+    drive_mock_shunt(clock, gate.motor, pin_direction(gate))
+    monkeypatch.setattr(main, "gate", gate, raising=False)
+    monkeypatch.setattr(main, "job_q", test_queue, raising=False)
+    yield gate
+    test_queue.cleanup()
+
+
+# (jobs as (seconds, job), obstruction, main loop runs, final state, counters, seconds taken)
+SCENARIOS = {
+    "cycle": ([(0, 'open')], None, 1, 'closed', (1, 1, 0, 0), 51),
+    "open_extends_hold": ([(0, 'open'), (25, 'open')], None, 1, 'closed', (1, 1, 0, 0), 56),
+    # A close from less than the hit window floor ends before it, so the gate reopens once
+    "close_while_opening": ([(0, 'open'), (5, 'close')], None, 2, 'closed', (1, 1, 1, 0), 60),
+    "open_while_closing": ([(0, 'open'), (35, 'open')], None, 2, 'closed', (2, 1, 0, 0), 70),
+    "hit_while_closing": ([(0, 'open')], 0.5, 2, 'closing', (2, 0, 2, 0), 70),
+    "mode_change": ([(0, 'lock_open')], None, 1, 'closed', (0, 0, 0, 0), 0),
+}
+
+
+@pytest.mark.parametrize("scenario", sorted(SCENARIOS))
+def test_state_machine(sim, scenario):
+    """ Test the normal mode gate cycle through each path of the state machine, in virtual time
+    """
+    jobs, obstruction, runs, state, counters, seconds = SCENARIOS[scenario]
+    for delay, job in jobs:
+        sim.clock.call_later(delay, sim.job_q.validate_and_put, job)
+    if obstruction is not None:
+        sim.motor.obstruct(obstruction)
+    for _ in range(runs):
+        main.main_loop()
+    assert sim.current_state == state
+    counts = sim.state_store.state["counters"]
+    assert (counts["opened"], counts["closed"], counts["hits"], counts["timeouts"]) == counters
+    assert sim.clock.monotonic() == pytest.approx(seconds, abs=1)
+    assert sim.motor_pin0.value == 0 and sim.motor_pin1.value == 0
+
+
+def test_timeout(sim):
+    """ Test a motor that never stalls at the end of travel is stopped by the security timer
+    """
+    sim.motor.stall_current = sim.motor.run_current
+    sim.job_q.validate_and_put('open')
+    main.main_loop()
+    assert sim.current_state == 'Open time error'
+    assert sim.state_store.state["counters"]["timeouts"] == 1
+    assert sim.clock.monotonic() == pytest.approx(config.MAX_TIME_TO_OPEN_CLOSE, abs=0.1)
+
+
+def test_simulated_day(sim):
+    """ Test a day of random triggers, with the scheduled jobs running alongside the gate
+    """
+    generator = random.Random(1)
+    triggers = sorted(generator.uniform(0, 24 * 3600) for _ in range(100))
+    for trigger in triggers:
+        sim.clock.call_at(trigger, sim.job_q.validate_and_put, 'open')
+    scheduler = Scheduler(sim.clock)
+    samples = scheduler.every(config.BATTERY_SAMPLE_INTERVAL, lambda: None)
+    scheduler.start()
+    while sim.clock.monotonic() < triggers[-1] or not sim.job_q.empty():
+        main.main_loop()
+    scheduler.stop()
+    assert sim.current_state == 'closed'
+    counts = sim.state_store.state["counters"]
+    # Triggers while opening or holding extend the cycle, while closing they reopen the gate
+    assert 0 < counts["closed"] < counts["opened"] <= len(triggers)
+    assert counts["hits"] == counts["timeouts"] == 0
+    assert samples.runs == pytest.approx(sim.clock.monotonic() / config.BATTERY_SAMPLE_INTERVAL,
+                                         abs=1)
@@ -0,0 +1,59 @@
+""" Unit tests for the metrics registry and its HTTP exporter
+"""
+import urllib.request
+
+import pytest
+
+from metrics import Metrics
+from http_api import HttpApi
+
+
+def test_counter_and_gauge():
+    """ Test counters accumulate and gauges report their set or computed value
+    """
+    counter = Metrics.counter("test_events", "Test counter")
+    counter.inc()
+    counter.inc(2)
+    assert counter.value == 3
+    # Requesting the same name returns the same metric
+    assert Metrics.counter("test_events", "Test counter") is counter
+
+    gauge = Metrics.gauge("test_depth", "Test gauge")
+    gauge.set(4)
+    assert gauge.value == 4
+    gauge.set_function(lambda: 7)
+    assert gauge.value == 7
+
+    # A name can not be reused for a different metric type
+    with pytest.raises(ValueError):
+        Metrics.gauge("test_events", "Wrong type")
+
+
+def test_histogram_buckets():
+    """ Test observations land in the correct cumulative buckets
+    """
+    histogram = Metrics.histogram("test_latency_seconds", "Test histogram", buckets=(0.1, 1))
+    for value in [0.05, 0.1, 0.5, 5]:
+        histogram.observe(value)
+    samples = {suffix + labels: value for suffix, labels, value in histogram.samples()}
+    assert samples['_bucket{le="0.1"}'] == 2
+    assert samples['_bucket{le="1"}'] == 3
+    assert samples['_bucket{le="+Inf"}'] == 4
+    assert samples["_count"] == 4
+    assert samples["_sum"] == pytest.approx(5.65)
+
+
+def test_exposition_over_http():
+    """ Test the metrics are served in the Prometheus text format
+    """
+    Metrics.counter("test_scraped", "Scraped counter").inc()
+    HttpApi.add_route("/metrics", "text/plain; version=0.0.4", Metrics.exposition)
+    HttpApi.start("127.0.0.1", 0)
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(HttpApi.server.server_port)
+        with urllib.request.urlopen(url, timeout=2) as response:
+            body = response.read().decode()
+    finally:
+        HttpApi.stop()
+    assert "# TYPE test_scraped counter" in body
+    assert "test_scraped_total 1" in body
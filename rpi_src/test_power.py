@@ -0,0 +1,83 @@
+""" Unit tests for the state of charge estimator and power profile
+"""
+import datetime
+import logging
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from config import Config as config
+from battery_voltage_log import BatteryVoltageLog
+from power import ChargeEstimator, PowerProfile
+from scheduler import Scheduler
+
+
+def test_state_of_charge_and_sag():
+    """ Test the charge comes from the rest voltage and samples under load give the sag
+    """
+    gate = SimpleNamespace(current_state="closed")
+    estimator = ChargeEstimator(gate)
+    assert estimator.state_of_charge() is None
+    estimator.add_sample(24.12)
+    assert estimator.state_of_charge() == 50
+    gate.current_state = "opening"
+    estimator.add_sample(23.12)
+    # The motor load doesn't change the charge estimate
+    assert estimator.state_of_charge() == 50
+    assert estimator.summary()["sag"] == pytest.approx(1.0)
+    gate.current_state = "closed"
+    estimator.rest_voltage = 28.0
+    assert estimator.state_of_charge() == 100
+    estimator.rest_voltage = 20.0
+    assert estimator.state_of_charge() == 0
+
+
+def test_trend():
+    """ Test the trend is the slope of the logged voltages per hour
+    """
+    estimator = ChargeEstimator()
+    start = datetime.datetime(2021, 6, 1, 12)
+    estimator.load_history([(start + datetime.timedelta(hours=hour), 25.0 - 0.1 * hour)
+                            for hour in range(5)])
+    assert estimator.trend() == pytest.approx(-0.1)
+
+
+def test_profile_changes(tmp_path):
+    """ Test the profile drops with the charge, recovers past the hysteresis and applies settings
+    """
+    scheduler = Scheduler()
+    battery_log = BatteryVoltageLog(os.path.join(str(tmp_path), "battery.log"),
+                                    config.BATTERY_VOLTAGE_PIN)
+    battery_log.start(scheduler)
+    cam = SimpleNamespace(enabled=True)
+    profile = PowerProfile(ChargeEstimator(), battery_log, scheduler, cam)
+    logger = logging.getLogger("root")
+
+    rest_voltages = {soc: volt for volt, soc in ChargeEstimator.REST_VOLTAGE_CURVE}
+
+    def charge(soc):
+        profile.estimator.rest_voltage = rest_voltages[soc]
+        profile.update()
+
+    try:
+        charge(40)
+        assert profile.profile == "saver"
+        assert battery_log.sample_job.interval == config.BATTERY_SAMPLE_INTERVAL * 3
+        assert battery_log.windows_per_write == 2
+        assert logger.level == logging.INFO
+        charge(10)
+        assert profile.profile == "critical"
+        assert not cam.enabled
+        # Within the hysteresis of the critical threshold
+        charge(30)
+        assert profile.profile == "critical"
+        charge(40)
+        assert profile.profile == "saver"
+        assert cam.enabled == config.CAMERA_ENABLED
+        charge(60)
+        assert profile.profile == "normal"
+        assert battery_log.sample_job.interval == config.BATTERY_SAMPLE_INTERVAL
+        assert logger.level == profile.normal_log_level
+    finally:
+        logger.setLevel(profile.normal_log_level)
@@ -0,0 +1,65 @@
+""" Unit tests for the trace recorder module
+"""
+import os
+
+import pytest
+
+from events import EventBus
+from job_queue import JobQueue
+from recorder import Recorder, TraceWriter, read_trace
+
+
+def test_trace_file(tmp_path):
+    """ Test records read back in order with their times across segments, and a partial record
+    at the end of a trace cut short is ignored
+    """
+    path = os.path.join(str(tmp_path), "trace.bin")
+    with open(path, "ab") as trace_file:
+        writer = TraceWriter(trace_file, 1000.0, 50.0)
+        writer.write(1000.5, 50.5, "frame", [0.0125, 2.4312, 0, 0, 0, 0])
+        writer.write(1001.0, 51.0, "serial", "O")
+        writer.write(1001.001, 51.001, "serial", "7")
+    with open(path, "ab") as trace_file:
+        writer = TraceWriter(trace_file, 2000.0, 10.0)
+        writer.write(2002.0, 12.0, "fifo", "open")
+        trace_file.write(TraceWriter.RECORD.pack(0, 3, 10) + b"ope")
+    records = list(read_trace(path))
+    assert [(kind, value) for _, kind, value in records][1:] == [
+        ("serial", "O"), ("serial", "7"), ("fifo", "open")]
+    assert [round(wall, 3) for wall, _, _ in records] == [1000.5, 1001.0, 1001.001, 2002.0]
+    assert records[0][2] == pytest.approx([0.0125, 2.4312, 0, 0, 0, 0], abs=1e-6)
+    # Each record is 7 bytes and its payload
+    assert os.path.getsize(path) == 4 + 2 * 15 + 31 + 2 * 8 + 11 + 10
+
+
+def test_recorder(tmp_path):
+    """ Test the FIFO commands and triggers are recorded while recording and not after
+    """
+    path = os.path.join(str(tmp_path), "trace.bin")
+    test_q = JobQueue(["open"], os.path.join(str(tmp_path), "pipe"))
+    Recorder.start(path)
+    Recorder.fifo("open")
+    test_q.handle_fifo("open")
+    Recorder.stop()
+    EventBus.publish("trigger", source="arduino")
+    Recorder.fifo("close")
+    assert [(kind, value) for _, kind, value in read_trace(path)] == [
+        ("fifo", "open"), ("trigger", "pipe")]
+    assert test_q.get_nonblocking() == "open"
+    test_q.cleanup()
+
+
+def test_rotation(tmp_path):
+    """ Test a full trace file is moved aside and a new one started, keeping only the last two
+    """
+    path = os.path.join(str(tmp_path), "trace.bin")
+    Recorder.start(path, max_bytes=100)
+    for number in range(30):
+        Recorder.command("open {}".format(number))
+    Recorder.stop()
+    assert os.path.getsize(path + ".1") >= 100
+    assert os.path.getsize(path) < 100
+    assert sorted(os.listdir(str(tmp_path))) == ["trace.bin", "trace.bin.1"]
+    commands = [value for _, _, value in read_trace(path + ".1")] + [
+        value for _, _, value in read_trace(path)]
+    assert commands == ["open {}".format(number) for number in range(30 - len(commands), 30)]
@@ -0,0 +1,65 @@
+""" Unit tests for the trace replay module
+"""
+import datetime
+import os
+
+import pytest
+
+from config import Config as config
+from recorder import TraceWriter
+import replay
+
+
+@pytest.fixture(name="trace")
+def fixture_trace(tmp_path):
+    """ Two hours of battery voltage frames with buttons, FIFO and socket commands and a hit
+    """
+    path = os.path.join(str(tmp_path), "trace.bin")
+    start = datetime.datetime(2021, 3, 1, 8, 0).timestamp()
+    battery = 26.0 / config.BATTERY_VOLTAGE_CORRECTION_FACTOR
+    events = [
+        # Two presses during one cycle, the second picture waits for the first, then one press
+        (600, "serial", "O"), (600.001, "serial", str(config.BUTTON_OUTSIDE_PIN)),
+        (603, "serial", "O"), (603.001, "serial", str(config.BUTTON_INSIDE_PIN)),
+        (900, "serial", "O"), (900.001, "serial", str(config.BUTTON_OUTSIDE_PIN)),
+        (900, "trigger", "arduino"),
+        # A hit from the recorded gate run is not replayed
+        (920, "serial", "H"), (920.001, "serial", "0.0500"),
+        (1800, "fifo", "open"), (1800, "trigger", "pipe"),
+        (3000, "command", "lock_open"), (3600, "command", "normal_home"),
+    ]
+    frames = [(seconds, "frame", [0.0, battery, 0, 0, 0, 0]) for seconds in range(0, 7200, 2)]
+    with open(path, "ab") as trace_file:
+        writer = TraceWriter(trace_file, start, 0.0)
+        for seconds, kind, value in sorted(events + frames, key=lambda record: record[0]):
+            writer.write(start + seconds, seconds, kind, value)
+    return path
+
+
+@pytest.mark.usefixtures("cycle_timings")
+def test_replay(trace):
+    """ Test the recorded day drives the gate, the DB writer and the camera queue
+    """
+    report = replay.Replay(trace, poll_interval=0.05).run()
+    assert report["trace"]["records"] == {"frame": 3600, "serial": 8, "fifo": 1, "command": 2,
+                                          "trigger": 2}
+    assert report["trace"]["seconds"] == pytest.approx(7198, abs=1)
+    gate = report["gate"]
+    # The buttons, the FIFO and lock_open open the gate, leaving lock_open cycles it again
+    assert gate["cycles"] == {"opened": 5, "closed": 4, "hits": 0, "timeouts": 0}
+    assert gate["triggers"] == {"arduino": 3, "pipe": 1}
+    assert gate["final_state"] == "closed" and gate["final_mode"] == "normal_home"
+    assert report["db"] == {"insert entrytable": 3, "update entrytable": 3}
+    camera = report["camera"]
+    assert (camera["requested"], camera["taken"], camera["max_queue"]) == (3, 3, 1)
+    assert camera["max_wait_seconds"] == pytest.approx(3, abs=0.1)
+
+
+@pytest.mark.usefixtures("cycle_timings")
+def test_compare(trace):
+    """ Test replaying the same trace gives the same report and changes are listed
+    """
+    report = replay.Replay(trace, poll_interval=0.05).run()
+    assert not replay.compare(report, replay.Replay(trace, poll_interval=0.05).run())
+    changed = dict(report, camera=dict(report["camera"], taken=2))
+    assert replay.compare(changed, report) == ["camera.taken: 3 -> 2"]
@@ -0,0 +1,130 @@
+""" Unit tests for the job scheduler module
+"""
+import datetime
+import threading
+
+from scheduler import Scheduler
+
+
+class FakeClock:
+    """ Clock that only moves when told to
+    """
+    def __init__(self):
+        # Start a few seconds before 10:00 local time
+        self.wall = datetime.datetime(2021, 3, 1, 9, 59, 50).timestamp()
+        self.mono = 1000.0
+
+    def monotonic(self):
+        """ Monotonic time """
+        return self.mono
+
+    def time(self):
+        """ Wall clock time """
+        return self.wall
+
+    def advance(self, seconds):
+        """ Move both clocks forward """
+        self.mono += seconds
+        self.wall += seconds
+
+
+def test_interval_cadence():
+    """ Test interval jobs run once per interval and keep their cadence
+    """
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    runs = []
+    scheduler.every(10, lambda: runs.append(clock.monotonic()))
+    assert scheduler.run_pending() == 0
+    for _ in range(5):
+        clock.advance(10.5)
+        scheduler.run_pending()
+    assert len(runs) == 5
+    # The next deadline is on the original cadence, not 10s after the last (late) run
+    assert scheduler.jobs()[0].deadline == 1060.0
+
+
+def test_cron_alignment():
+    """ Test cron jobs run at the requested minute past the hour
+    """
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    runs = []
+    job = scheduler.cron(lambda: runs.append(clock.time()), minute=0)
+    assert job.deadline == clock.monotonic() + 10
+    clock.advance(9)
+    scheduler.run_pending()
+    assert not runs
+    clock.advance(1)
+    scheduler.run_pending()
+    assert datetime.datetime.fromtimestamp(runs[0]).strftime("%H:%M:%S") == "10:00:00"
+    assert job.deadline == clock.monotonic() + 3600
+
+
+def test_missed_policies():
+    """ Test jobs that fall behind by several periods run according to their policy
+    """
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    runs = {"run_once": 0, "skip": 0, "catch_up": 0}
+
+    def counter(policy):
+        def count():
+            runs[policy] += 1
+        return count
+
+    for policy in runs:
+        scheduler.every(10, counter(policy), name=policy, missed=policy)
+    clock.advance(35)
+    scheduler.run_pending()
+    assert runs == {"run_once": 1, "skip": 0, "catch_up": 3}
+    # All of them continue from the next deadline in the future
+    assert all(job.deadline > clock.monotonic() for job in scheduler.jobs())
+
+
+def test_cancel_and_reschedule():
+    """ Test cancelled jobs stop running and rescheduled jobs take the new interval
+    """
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    runs = []
+    cancelled = scheduler.every(5, lambda: runs.append("cancelled"))
+    kept = scheduler.every(5, lambda: runs.append("kept"))
+    scheduler.cancel(cancelled)
+    scheduler.reschedule(kept, 20)
+    clock.advance(10)
+    scheduler.run_pending()
+    assert not runs
+    clock.advance(10)
+    scheduler.run_pending()
+    assert runs == ["kept"]
+    assert scheduler.jobs() == [kept]
+
+
+def test_failing_job():
+    """ Test an exception in a job is logged and the job stays scheduled
+    """
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+
+    def fail():
+        raise RuntimeError("failed")
+
+    job = scheduler.every(1, fail)
+    clock.advance(1)
+    scheduler.run_pending()
+    assert job.runs == 1
+    assert scheduler.jobs() == [job]
+
+
+def test_scheduler_thread():
+    """ Test the scheduler thread runs a job at its deadline and stops cleanly
+    """
+    scheduler = Scheduler()
+    ran = threading.Event()
+    scheduler.every(0.05, ran.set)
+    scheduler.start()
+    try:
+        assert ran.wait(2)
+    finally:
+        scheduler.stop()
@@ -2,7 +2,39 @@
 """
 import time
 import logging
-from serial_analog import ArduinoInterface
+
+import pytest
+
+from config import Config as config
+from events import EventBus
+import firmware
+from serial_analog import ArduinoInterface, ArduinoInterfaceError
+
+
+class FakeSerial:
+    """ Serial port that replays the lines an Arduino would send
+    """
+    def __init__(self, lines):
+        self.lines = [line.encode() for line in lines]
+        self.written = b""
+
+    def readline(self):
+        """ Next line, or nothing like a timeout """
+        return self.lines.pop(0) if self.lines else b""
+
+    def write(self, data):
+        """ Record what was sent """
+        self.written += data
+
+    def fileno(self):
+        """ Not a real port """
+        raise OSError("fake serial port")
+
+    def flushInput(self):  # pylint: disable=invalid-name
+        """ Nothing is buffered """
+
+    def close(self):
+        """ Nothing to close """
 
 
 def test_setup_lock(caplog):
@@ -38,3 +70,129 @@ def test_mock_input():
 
     # Test that the values are returned
     assert ArduinoInterface.get_analog_voltages(0) == voltage
+
+
+def test_handshake_with_running_arduino():
+    """ Test the handshake doesn't wait for a reset when the Arduino is already running
+    """
+    ArduinoInterface.initialize()
+    ArduinoInterface.mock_mode = False
+    ArduinoInterface.handshake_lock = False
+    ArduinoInterface.ser = FakeSerial(["V"] + ["1.0000"] * 6 + ["6.0000", "F", "0123abcd"])
+    ArduinoInterface.handshake()
+    assert ArduinoInterface.handshake_lock
+    assert ArduinoInterface.ser.written == "VFD{}\n".format(config.ADC_OVERSAMPLING).encode()
+    assert not ArduinoInterface.ser.lines
+    assert ArduinoInterface.firmware_hash == "0123abcd"
+
+
+def test_handshake_after_reset():
+    """ Test the handshake replies to a freshly reset Arduino
+    """
+    ArduinoInterface.initialize()
+    ArduinoInterface.mock_mode = False
+    ArduinoInterface.handshake_lock = False
+    ArduinoInterface.ser = FakeSerial(["", "A", "0123abcd"])
+    ArduinoInterface.handshake()
+    assert ArduinoInterface.handshake_lock
+    assert ArduinoInterface.ser.written == b"VA"
+    assert ArduinoInterface.firmware_hash == "0123abcd"
+
+
+def test_link_recovery(gate, monkeypatch):
+    """ Test a lost link stops the gate, requests fail fast until the port is reopened and the
+    stopped cycle is finished once the arduino answers
+    """
+    ArduinoInterface.initialize(gate, gate.job_q)
+
+    # Stalled requests ask the serial thread to resync
+    ArduinoInterface.mock_mode = False
+    ArduinoInterface.ser = FakeSerial([])
+    monkeypatch.setattr(ArduinoInterface, "STALL_ERRORS", 1)
+    with pytest.raises(ArduinoInterfaceError):
+        ArduinoInterface.get_analog_voltages()
+    assert ArduinoInterface._resync_requested  # pylint: disable=protected-access
+
+    # While the link is down the gate doesn't move
+    ArduinoInterface.link_up = False
+    gate.open()
+    assert gate.current_state == "Open link error"
+    assert gate.motor_pin1.value == 0
+
+    # The port is reopened and the arduino, reset by being plugged back in, handshakes
+    subscription = EventBus.subscribe()
+    ports = [FakeSerial(["A"])]
+    monkeypatch.setattr(ArduinoInterface, "RECONNECT_INTERVAL", 0)
+    monkeypatch.setattr(ArduinoInterface, "_open_port", ports.pop)
+    ArduinoInterface._recover("unplugged")  # pylint: disable=protected-access
+    assert ArduinoInterface.link_up
+    assert [event.data["up"] for event in subscription.get(timeout=0)
+            if event.event_type == "link"] == [False, True]
+    EventBus.unsubscribe(subscription)
+    assert gate.job_q.get_nonblocking() == "open"
+
+
+def test_message_errors(monkeypatch):
+    """ Test an error handling one message is logged and the serial thread reads the next
+    """
+    handled = []
+
+    def handle_message(data):
+        if data == "B":
+            raise TypeError("unsupported operand")
+        handled.append(data)
+
+    class LastLines(FakeSerial):
+        """ Stops the serial thread once the lines have been read """
+        def readline(self):
+            if not self.lines:
+                ArduinoInterface._running = False  # pylint: disable=protected-access
+            return super().readline()
+
+    ArduinoInterface.initialize()
+    ArduinoInterface.mock_mode = False
+    ArduinoInterface.ser = LastLines(["B", "O"])
+    monkeypatch.setattr(ArduinoInterface, "handle_message", handle_message)
+    monkeypatch.setattr(ArduinoInterface, "_running", True)
+    ArduinoInterface.read_serial()
+    assert handled == ["O"]
+
+
+def test_read_deadline():
+    """ Test a voltage request gives up once its retry budget is spent
+    """
+    ArduinoInterface.initialize()
+    ArduinoInterface.mock_mode = False
+    ArduinoInterface.ser = FakeSerial([])
+    with pytest.raises(ArduinoInterfaceError):
+        ArduinoInterface.get_analog_voltages(timeout=0.1, retries=2)
+    # One request and two retries before giving up
+    assert ArduinoInterface.ser.written == b"VVV"
+    # Values arriving after a request gave up are not taken as the answer to the next one
+    for value in range(ArduinoInterface.number_of_inputs):
+        ArduinoInterface.arduino_queue.put(value)
+    with pytest.raises(ArduinoInterfaceError):
+        ArduinoInterface.get_analog_voltages(timeout=0.05, retries=0)
+
+
+def test_flash_only_when_changed(monkeypatch):
+    """ Test the sketch is only uploaded when the arduino reports a different firmware hash
+    """
+    bundled = firmware.sketch_hash()
+    assert len(bundled) == 16
+    uploads = []
+    monkeypatch.setattr(firmware, "can_flash", lambda: True)
+    monkeypatch.setattr(firmware, "flash", lambda port: uploads.append(port) or True)
+    ArduinoInterface.initialize()
+    monkeypatch.setattr(ArduinoInterface, "_open_port", lambda: FakeSerial(["A", bundled]))
+    ArduinoInterface.port = "/dev/ttyUSB0"
+    ArduinoInterface.ser = FakeSerial([])
+
+    ArduinoInterface.firmware_hash = bundled
+    ArduinoInterface._check_firmware()  # pylint: disable=protected-access
+    assert not uploads
+
+    ArduinoInterface.firmware_hash = "0123abcd"
+    ArduinoInterface._check_firmware()  # pylint: disable=protected-access
+    assert uploads == ["/dev/ttyUSB0"]
+    assert ArduinoInterface.firmware_hash == bundled
@@ -0,0 +1,25 @@
+""" Unit tests for the start up profiler
+"""
+import time
+
+from startup import StartupProfiler
+
+
+def test_phases_and_report():
+    """ Test phases are timed, including those run on other threads, and reported in start order
+    """
+    StartupProfiler.phases = []
+    with StartupProfiler.phase("serial"):
+        time.sleep(0.02)
+    assert StartupProfiler.timed("db", lambda value: value * 2, 21) == 42
+    StartupProfiler.ready()
+
+    names = [name for name, _, _ in StartupProfiler.phases]
+    assert names == ["serial", "db"]
+    _, start, duration = StartupProfiler.phases[0]
+    assert start >= 0
+    assert duration >= 0.02
+    report = StartupProfiler.report().splitlines()
+    assert "serial" in report[1]
+    assert "db" in report[2]
+    assert "ready to open" in report[-1]
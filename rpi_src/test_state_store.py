@@ -0,0 +1,47 @@
+""" Unit tests for the gate state store
+"""
+import json
+import os
+
+from state_store import StateStore, atomic_write
+
+
+def test_atomic_write(tmp_path):
+    """ Test the file is replaced and no temporary file is left behind
+    """
+    path = os.path.join(str(tmp_path), "state.json")
+    atomic_write(path, "first")
+    atomic_write(path, "second")
+    with open(path, "r") as state_file:
+        assert state_file.read() == "second"
+    assert os.listdir(str(tmp_path)) == ["state.json"]
+
+
+def test_save_and_load(tmp_path):
+    """ Test the state, counters and calibration are restored by a new store
+    """
+    path = os.path.join(str(tmp_path), "state.json")
+    store = StateStore(path)
+    assert store.state["state"] == "unknown"
+    store.count("opened")
+    store.calibrate("open", 20)
+    store.calibrate("open", 25)
+    store.update(state="opened", position=1.0)
+    restored = StateStore(path).state
+    assert restored["state"] == "opened"
+    assert restored["position"] == 1.0
+    assert restored["counters"]["opened"] == 1
+    assert restored["counters"]["hits"] == 0
+    assert restored["calibration"] == {"open": 21.0, "close": None}
+
+
+def test_unreadable_state(tmp_path):
+    """ Test a corrupt or unknown state file gives the defaults
+    """
+    path = os.path.join(str(tmp_path), "state.json")
+    with open(path, "w") as state_file:
+        state_file.write('{"state": "ope')
+    assert StateStore(path).state == StateStore.DEFAULT
+    with open(path, "w") as state_file:
+        json.dump({"version": 0, "state": "opened"}, state_file)
+    assert StateStore(path).state["state"] == "unknown"
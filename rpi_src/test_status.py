@@ -0,0 +1,27 @@
+""" Unit tests for the in memory status snapshot
+"""
+import json
+
+from events import EventBus
+from status import StatusSnapshot
+
+
+def test_snapshot(gate):
+    """ Test the snapshot follows the gate and events without any serial reads
+    """
+    StatusSnapshot.initialize(gate, gate.job_q)
+
+    snapshot = StatusSnapshot.render()
+    assert snapshot['mode'] == 'normal_home'
+    assert snapshot['state'] == 'unknown'
+    assert snapshot['voltages'] is None
+
+    gate.open()
+    EventBus.publish('entry', button='outside', time='2020-01-01T00:00:00')
+    gate.job_q.validate_and_put('close')
+    snapshot = json.loads(StatusSnapshot.render_json())
+    assert snapshot['state'] == 'opened'
+    assert snapshot['voltages']['shunt'] == 10
+    assert snapshot['voltages']['age'] >= 0
+    assert snapshot['last_entry']['button'] == 'outside'
+    assert snapshot['queues']['jobs'] == 1
@@ -0,0 +1,82 @@
+""" Unit tests for the gate cycle tracing module
+"""
+import json
+import os
+import types
+
+import pytest
+
+import tracing
+from tracing import Tracer
+
+
+def test_timeline_spans(tmp_path):
+    """ Test a cycle is recorded with its trigger, marks and result, and can be exported
+    """
+    Tracer.reset()
+    # Marks outside of a cycle are ignored
+    Tracer.mark("ignored")
+    Tracer.trigger("arduino")
+    Tracer.begin()
+    Tracer.mark("open:motor_on")
+    Tracer.end("closed")
+
+    timelines = Tracer.export()
+    assert len(timelines) == 1
+    names = [span["name"] for span in timelines[0]["spans"]]
+    assert names == ["trigger:arduino", "dequeued", "open:motor_on", "end"]
+    assert timelines[0]["result"] == "closed"
+    # Spans are contiguous, each starts where the previous one finished
+    spans = timelines[0]["spans"]
+    for span, next_span in zip(spans, spans[1:]):
+        assert span["start"] + span["duration"] == pytest.approx(next_span["start"], abs=1e-5)
+
+    trace_file = os.path.join(str(tmp_path), "traces.json")
+    Tracer.export_json(trace_file)
+    with open(trace_file, "r") as exported:
+        assert json.load(exported) == timelines
+
+
+def test_stale_trigger(monkeypatch):
+    """ Test a trigger whose job was never dequeued is not added to a later cycle
+    """
+    Tracer.reset()
+    now = [100.0]
+    monkeypatch.setattr(tracing, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    Tracer.trigger("pipe")
+    now[0] += Tracer.pending_timeout + 1
+    Tracer.begin()
+    Tracer.end("closed")
+    now[0] += 60
+    Tracer.trigger("pipe")
+    now[0] += Tracer.pending_timeout + 1
+    Tracer.trigger("arduino")
+    Tracer.begin()
+    Tracer.end("closed")
+    names = [[span["name"] for span in timeline["spans"]] for timeline in Tracer.export()]
+    assert names == [["dequeued", "end"], ["trigger:arduino", "dequeued", "end"]]
+
+
+def test_ring_buffer_capacity():
+    """ Test only the most recent timelines are kept
+    """
+    Tracer.reset()
+    for _ in range(Tracer.capacity + 5):
+        Tracer.begin()
+        Tracer.end("closed")
+    timelines = Tracer.export()
+    assert len(timelines) == Tracer.capacity
+    assert timelines[-1]["cycle"] - timelines[0]["cycle"] == Tracer.capacity - 1
+    assert len(Tracer.export(last=3)) == 3
+
+
+def test_gate_marks(gate):
+    """ Test the gate records the motor and shunt marks when opening
+    """
+    Tracer.reset()
+    Tracer.begin()
+    gate.open()
+    Tracer.end(gate.current_state)
+    names = [span["name"] for span in Tracer.export()[0]["spans"]]
+    assert names == ["dequeued", "open:motor_on", "open:first_shunt_read",
+                     "open:threshold_crossed", "open:motor_stop", "end"]
@@ -0,0 +1,145 @@
+""" Module to trace the timeline of each gate cycle.
+A cycle starts when an open trigger is received and is marked at each step on the way to the
+motor stopping, using monotonic timestamps. Finished timelines are kept in a ring buffer and can be
+exported as JSON on demand.
+"""
+import collections
+import json
+import threading
+import time
+
+from events import EventBus
+
+
+class CycleTimeline:
+    """ Timeline of the marks recorded during a single gate cycle
+    """
+    __slots__ = ("cycle_id", "marks", "result")
+
+    def __init__(self, cycle_id):
+        self.cycle_id = cycle_id
+        # List of (name, monotonic timestamp) tuples in the order they were recorded
+        self.marks = []
+        self.result = None
+
+    def spans(self):
+        """ Convert the marks into spans, each lasting until the following mark
+        """
+        if not self.marks:
+            return []
+        origin = self.marks[0][1]
+        spans = []
+        for (name, timestamp), (_, next_timestamp) in zip(self.marks, self.marks[1:]):
+            spans.append({"name": name,
+                          "start": round(timestamp - origin, 6),
+                          "duration": round(next_timestamp - timestamp, 6)})
+        name, timestamp = self.marks[-1]
+        spans.append({"name": name, "start": round(timestamp - origin, 6), "duration": 0.0})
+        return spans
+
+    def to_dict(self):
+        """ Dictionary representation for exporting
+        """
+        return {"cycle": self.cycle_id,
+                "result": self.result,
+                "monotonic_start": self.marks[0][1] if self.marks else None,
+                "spans": self.spans()}
+
+
+class Tracer:
+    """ Records gate cycle timelines from the serial, pipe and gate threads.
+    Triggers that arrive while no cycle is running are held until the job is dequeued, so the
+    queueing latency is part of the timeline. A held trigger is dropped after pending_timeout
+    seconds, as its job was discarded (e.g. in a locked mode) if it still hasn't been dequeued.
+    """
+    capacity = 100
+    pending_timeout = 10
+    timelines = collections.deque(maxlen=capacity)
+    _current = None
+    _pending = []
+    _cycle_count = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def trigger(cls, source):
+        """ Record that an open trigger was received from source
+        """
+        mark = ("trigger:{}".format(source), time.monotonic())
+        with cls._lock:
+            if cls._current is not None:
+                cls._current.marks.append(mark)
+            else:
+                cls._expire_pending(mark[1])
+                if not cls._pending:
+                    cls._pending.append(mark)
+        EventBus.publish("trigger", source=source)
+
+    @classmethod
+    def begin(cls):
+        """ Start a new cycle timeline, called when the open job is dequeued
+        """
+        now = time.monotonic()
+        with cls._lock:
+            cls._expire_pending(now)
+            cls._cycle_count += 1
+            cls._current = CycleTimeline(cls._cycle_count)
+            cls._current.marks.extend(cls._pending)
+            cls._current.marks.append(("dequeued", now))
+            cls._pending = []
+
+    @classmethod
+    def _expire_pending(cls, now):
+        """ Drop a held trigger older than pending_timeout, called with the lock held
+        """
+        if cls._pending and now - cls._pending[0][1] > cls.pending_timeout:
+            cls._pending = []
+
+    @classmethod
+    def mark(cls, name):
+        """ Record a mark on the running cycle, ignored if no cycle is running
+        """
+        timestamp = time.monotonic()
+        with cls._lock:
+            if cls._current is not None:
+                cls._current.marks.append((name, timestamp))
+
+    @classmethod
+    def end(cls, result):
+        """ Finish the running cycle and store it in the ring buffer
+        """
+        with cls._lock:
+            if cls._current is None:
+                return
+            cls._current.marks.append(("end", time.monotonic()))
+            cls._current.result = result
+            cls.timelines.append(cls._current)
+            timeline, cls._current = cls._current, None
+        duration = timeline.marks[-1][1] - timeline.marks[0][1]
+        EventBus.publish("cycle", cycle=timeline.cycle_id, result=result,
+                         duration=round(duration, 3))
+
+    @classmethod
+    def export(cls, last=None):
+        """ Return the most recent timelines as a list of dictionaries, oldest first
+        """
+        with cls._lock:
+            timelines = list(cls.timelines)
+        if last is not None:
+            timelines = timelines[-last:]
+        return [timeline.to_dict() for timeline in timelines]
+
+    @classmethod
+    def export_json(cls, path):
+        """ Write the stored timelines to path as JSON
+        """
+        with open(path, "w") as trace_file:
+            json.dump(cls.export(), trace_file, indent=1)
+
+    @classmethod
+    def reset(cls):
+        """ Discard all timelines
+        """
+        with cls._lock:
+            cls.timelines.clear()
+            cls._current = None
+            cls._pending = []
@@ -13,7 +13,7 @@ setup(
     keywords=['IOT', 'RPi', 'smart', 'gate'],
     packages=['rpi_src'],
     include_package_data=True,
-    install_requires=['pyserial==3.4', 'pathlib==1.0.1', 'schedule==0.6.0', 'gpiozero==1.5.0',
+    install_requires=['pyserial==3.4', 'pathlib==1.0.1', 'gpiozero==1.5.0',
                       'picamera==1.13', 'jsonschema==3.0.0',
                       'psycopg2-binary>=2.8.0', 'tzlocal>=2.1'],
     extras_require={"dev": ["pytest==6.0.0", "pylint==2.6.0"]},